@@ -2,11 +2,35 @@ from flask import Flask
 from flask_cors import CORS
 from flask_httpauth import HTTPBasicAuth
 from flask_sqlalchemy import SQLAlchemy
-from lib.cache import build_cache_from_config
+from lib.cache import build_cache_from_config, EntityCache, MapsResultCache
+from lib.concurrency import FanOut
+from lib.fragments import FragmentCache
+from lib.ingest import LocationBuffer
+from lib.jobs import JobQueue
+from lib.maps import MapsGateway
+from lib.passwords import PasswordHasher
+from lib.routing import Routing
+from lib.stream import EventBroker
+from lib.timeseries import LocationHistory
+from lib.tokens import AuthTokens
+from lib.versions import VersionCounters
 
 
 db = SQLAlchemy()
 auth = HTTPBasicAuth()
+maps_cache = MapsResultCache()
+entity_cache = EntityCache()
+maps_pool = FanOut()
+maps_gateway = MapsGateway()
+routing = Routing()
+location_buffer = LocationBuffer()
+location_history = LocationHistory()
+shuttle_events = EventBroker()
+versions = VersionCounters()
+fragments = FragmentCache()
+auth_tokens = AuthTokens()
+passwords = PasswordHasher()
+jobs = JobQueue()
 
 
 def init_app(testing=False):
@@ -28,8 +52,21 @@ def init_app(testing=False):
     global cache
     cache = build_cache_from_config(app)
     cache.init_app(app)
+    maps_cache.init_app(app, cache)
+    entity_cache.init_app(app, cache)
+    versions.init_app(app, cache)
+    fragments.init_app(app, cache, versions)
+    auth_tokens.init_app(app, cache)
+    maps_pool.size = app.config.get('MAPS_FANOUT_WORKERS', maps_pool.size)
+    maps_gateway.init_app(app)
+    routing.init_app(app, maps_gateway)
+    location_buffer.init_app(app)
+    location_history.init_app(app)
+    shuttle_events.init_app(app)
+    passwords.init_app(app)
 
     db.init_app(app)
+    jobs.init_app(app)
 
     # blueprints
     from app.api.users.users import users, drivers
@@ -130,6 +130,49 @@ update_shuttle_location_schema = Draft4Validator(
     }
 )
 
+batch_update_shuttle_location_schema = Draft4Validator(
+    schema={
+        "title": "Batch update shuttle locations",
+        "type": "object",
+        "properties": {
+            "pings": {
+                "type": "array",
+                "minItems": 1,
+                "maxItems": 1000,
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "shuttle_id": {
+                            "type": "integer"
+                        },
+                        "driver_id": {
+                            "type": "integer"
+                        },
+                        "lat": {
+                            "type": "number",
+                            "minimum": -90,
+                            "maximum": 90
+                        },
+                        "lng": {
+                            "type": "number",
+                            "minimum": -180,
+                            "maximum": 180
+                        },
+                        "timestamp": {
+                            "description": "When the position was recorded, in seconds since the epoch",
+                            "type": "number",
+                            "minimum": 0,
+                            "maximum": 4102444800
+                        }
+                    },
+                    "required": ["shuttle_id", "driver_id", "lat", "lng", "timestamp"]
+                }
+            }
+        },
+        "required": ["pings"]
+    }
+)
+
 add_directions_schema = Draft4Validator(
     schema={
         "title": "Add directions to a location",
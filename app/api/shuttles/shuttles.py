@@ -1,20 +1,38 @@
-import googlemaps
-from googlemaps.distance_matrix import distance_matrix
-from googlemaps.directions import directions
+import json
+import math
+import time
+from datetime import datetime, timedelta
+from functools import partial
+from multiprocessing import TimeoutError
 
 from flask import (Blueprint,
+                   Response,
+                   g,
                    jsonify,
                    request,
                    make_response,
                    url_for,
                    current_app as app)
 
+from sqlalchemy import inspect, or_
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import joinedload
 
-from app import auth, db
+from app import (auth, db, fragments, jobs, location_buffer, location_history, maps_cache, maps_gateway, maps_pool,
+                 routing, shuttle_events, versions)
+from app.lib.distance import coordinate_arrays, rank_by_distance
+from app.lib.fragments import fragment_page_response, fragment_response
+from app.lib.geo import GridIndex, parse_coordinates
 from app.lib.validation import validate_schema
 from app.lib.helpers import convert_to_snake_case
-from app.models.shuttles import Shuttle, StatusEnum, Location, Directions
+from app.lib.maps import CircuitOpen
+from app.lib.pagination import page_args, page_response, paginate
+from app.lib.routing import distance_and_duration
+from app.lib.stream import event_in_bbox
+from app.lib.streaming import stream_chunks, stream_rows
+from app.lib.timeseries import MAX_TIMESTAMP
+from app.models.shuttles import (ChangeActionEnum, ChangeLog, Shuttle, StatusEnum, Location, LocationTypeEnum,
+                                 Directions, TravelTime)
 from app.models.users import User, AccountTypeEnum
 
 from app.api.shuttles.schemas import (
@@ -22,6 +40,7 @@ from app.api.shuttles.schemas import (
     add_location_schema,
     switch_shuttle_mode_schema,
     update_shuttle_location_schema,
+    batch_update_shuttle_location_schema,
     add_directions_schema,
     update_location_schema
 )
@@ -33,6 +52,9 @@ locations = Blueprint('locations', __name__, url_prefix='/locations')
 urls = URLS['shuttles']
 location_urls = URLS['locations']
 
+# Live shuttle positions, used to answer nearest-shuttle queries without scanning the whole fleet.
+shuttle_index = GridIndex()
+
 
 # with app.app_context():
 #     @app.errorhandler(404)
@@ -58,12 +80,15 @@ def create_shuttle(user_id):
 
     try:
         db.session.add(shuttle)
+        changes = record_change(shuttle, ChangeActionEnum.created)
         db.session.commit()
     except SQLAlchemyError as ex:
         unknown_error = "Could not add shuttle {0}: {1}".format(brand, ex)
         app.logger.error(unknown_error)
         return jsonify({'status': 'error', 'message': unknown_error, 'code': 500})
 
+    bump_versions(changes)
+
     return_obj = shuttle.serialize
     return_obj['uri'] = url_for('shuttles.get_shuttle',
                                 shuttle_id=shuttle.id,
@@ -73,15 +98,34 @@ def create_shuttle(user_id):
 
 
 @shuttles.route(urls['get'], methods=['GET'])
+@versions.conditional('shuttle', 'shuttle_id')
 def get_shuttle(shuttle_id):
-    shuttle = db.session.query(Shuttle).filter_by(id=int(shuttle_id)).first()
+
+    try:
+        fields = Shuttle.parse_fields(request.args.get('fields'))
+    except ValueError as ex:
+        return jsonify({'code': 400, 'status': 'error', 'message': str(ex)})
+
+    # an id that isn't a number can't match a shuttle
+    if not shuttle_id.isdigit():
+        shuttle = None
+    elif fields is None:
+        fragment = fragments.render('shuttle', Shuttle.id, int(shuttle_id),
+                                    db.session.query(Shuttle).options(*Shuttle.load_fields()))
+
+        if fragment is not None:
+            return fragment_response(fragment)
+
+        shuttle = None
+    else:
+        shuttle = db.session.query(Shuttle).options(*Shuttle.load_fields(fields)).filter_by(id=int(shuttle_id)).first()
 
     if shuttle is None:
         message = 'Shuttle {0} not found.'.format(shuttle_id)
         app.logger.info(message)
         return jsonify({'status': 'error', 'message': message, 'code': 400})
 
-    return jsonify(shuttle.serialize)
+    return jsonify(shuttle.serialize_fields(fields))
 
 
 @shuttles.route(urls['update'], methods=['PUT'])
@@ -107,13 +151,33 @@ def update_shuttle(shuttle_id):
     return jsonify({"status": 'success', 'data': shuttle.serialize})
 
 
+@shuttles.route(urls['changes'], methods=['GET'])
+def get_shuttle_changes():
+
+    return changes_response('shuttle', Shuttle)
+
+
 @shuttles.route(urls['get_all'], methods=['GET'])
+@versions.conditional('shuttle', skip_args=['user_location'])
 def get_all_shuttles():
 
     status_query = request.args.get('status') or StatusEnum.enabled
     en_route = request.args.get('en_route')
     user_id = request.args.get('user_id')
     user_location = request.args.get('user_location')
+    nearest = request.args.get('nearest', app.config.get('NEAREST_SHUTTLES_LIMIT', 10), type=int)
+    radius = request.args.get('radius', type=float)
+
+    try:
+        limit, after = page_args(request.args, app.config.get('PAGE_MAX_LIMIT', 100))
+        fields = Shuttle.parse_fields(request.args.get('fields'))
+    except ValueError as ex:
+        return jsonify({'code': 400, 'status': 'error', 'message': str(ex)})
+
+    if nearest < 1:
+        return jsonify({'code': 400, 'status': 'error', 'message': 'nearest must be at least 1.'})
+
+    nearest = min(nearest, app.config.get('NEAREST_SHUTTLES_MAX', 50))
 
     query_args = {
         'status': status_query
@@ -130,39 +194,147 @@ def get_all_shuttles():
     if user_id is not None:
         query_args['user_id'] = user_id
 
-    shuttles = db.session.query(Shuttle).filter_by(**query_args).all()
+    origin = parse_coordinates(user_location)
+    next_cursor = None
+
+    if origin is not None and limit is not None:
+        return jsonify({'code': 400, 'status': 'error',
+                        'message': 'Use nearest, not limit/after, to page shuttles near user_location.'})
+
+    # positions are needed to rank shuttles and get their distances
+    load_options = Shuttle.load_fields(fields, extra=['latitude', 'longitude'] if user_location else [])
+    query = db.session.query(Shuttle).options(*load_options).filter_by(**query_args)
+
+    # whole shuttles are stitched together from cached fragments; only their ids are queried
+    if user_location is None and fields is None:
+        ids_query = db.session.query(Shuttle.id).filter_by(**query_args)
+        render = partial(fragments.render_many, 'shuttle', Shuttle.id,
+                         query=db.session.query(Shuttle).options(*load_options))
+
+        if limit is None:
+            response = stream_chunks([shuttle_id for shuttle_id, in ids_query.order_by(Shuttle.id)], render,
+                                     app.config.get('LIST_CHUNK_SIZE', 500))
+        else:
+            rows, next_cursor = paginate(ids_query, Shuttle.id, limit, after)
+            response = fragment_page_response(render([row.id for row in rows]), limit, next_cursor) if rows else None
+
+        return response or jsonify({'code': 500, 'status': 'error', 'message': 'No shuttles were found.'})
+
+    # a plain listing needs no post-processing, so it is streamed rather than built up in memory
+    if user_location is None and limit is None:
+        response = stream_rows(query.order_by(Shuttle.id), lambda shuttle: shuttle.serialize_fields(fields),
+                               app.config.get('LIST_CHUNK_SIZE', 500))
+
+        return response or jsonify({'code': 500, 'status': 'error', 'message': 'No shuttles were found.'})
+
+    if origin is not None:
+        nearest_shuttles = find_nearest_shuttles(origin, query_args, nearest, radius, load_options)
+        shuttles = [shuttle for shuttle, distance, bearing in nearest_shuttles]
+    else:
+        shuttles, next_cursor = paginate(query, Shuttle.id, limit, after)
 
     if len(shuttles) <= 0:
         return jsonify({'code': 500, 'status': 'error', 'message': 'No shuttles were found.'})
 
-    serialized = [shuttle.serialize for shuttle in shuttles]
+    serialized = [shuttle.serialize_fields(fields) for shuttle in shuttles]
+    response = page_response(serialized, limit, next_cursor)
+
+    if origin is not None:
+        for shuttle, (_, distance, bearing) in zip(serialized, nearest_shuttles):
+            shuttle['straight_line_distance'] = round(distance, 3)
+            shuttle['bearing'] = round(bearing, 1)
 
     # get the distances of all the shuttles and determine the closest one (if the user's location is provided
     if user_location is not None:
 
-        shuttle_locations = ["{0}, {1}".format(shuttle["latitude"], shuttle["longitude"]) for shuttle in serialized]
+        shuttle_locations = ["{0}, {1}".format(shuttle.latitude, shuttle.longitude) for shuttle in shuttles]
 
         try:
-            gmaps = googlemaps.Client(key=app.config['GMAPS_KEY'])
+            elements = maps_cache.get_many('distance_matrix', 'driving',
+                                           [[location, user_location] for location in shuttle_locations])
+            missing = [index for index, element in enumerate(elements) if element is None]
 
-            distance_response = distance_matrix(gmaps, shuttle_locations, [user_location])
-            distance_result = distance_response['rows']
+            if missing:
+                origins = [shuttle_locations[index] for index in missing]
+                # riders near each other asking at once share the call
+                distance_response = call_maps(partial(
+                    maps_cache.load, 'distance_matrix', 'driving', origins + [user_location],
+                    partial(routing.distance_matrix, origins, [user_location])))
 
-            # attach the shuttles' individual distance matrices
-            for shuttle in serialized:
                 # get the corresponding result in the distance results array. This is assuming that the responses are
                 # in the order they are pushed
-                index = serialized.index(shuttle)
-                shuttle_result = distance_result[index]
+                for index, shuttle_result in zip(missing, distance_response['rows']):
+                    # The elements attribute is an array for some reason
+                    elements[index] = shuttle_result["elements"][0]
+                    maps_cache.set('distance_matrix', 'driving', [shuttle_locations[index], user_location],
+                                   elements[index])
 
-                # The elements attribute is an array for some reason
-                shuttle['distance_matrix'] = shuttle_result["elements"][0]
+            # attach the shuttles' individual distance matrices
+            for shuttle, element in zip(serialized, elements):
+                shuttle['distance_matrix'] = element
 
         except Exception as ex:
             message = 'Could not get distance matrix: {0}'.format(ex)
             app.logger.error(message)
 
-    return jsonify({'status': 'success', 'data': serialized})
+            # only the straight-line distances are there
+            response['degraded'] = True
+
+    return jsonify(response)
+
+
+def load_shuttle_index():
+    """
+    Rebuilds the shuttle index from the database once it is older than SHUTTLE_INDEX_MAX_AGE seconds.
+    The index lives in each worker process, so the rebuild also picks up pings handled by other workers.
+    :return:
+    """
+    if not shuttle_index.is_stale(app.config.get('SHUTTLE_INDEX_MAX_AGE', 30)):
+        return
+
+    positions = db.session.query(Shuttle.id, Shuttle.latitude, Shuttle.longitude).all()
+    shuttle_index.rebuild(positions, app.config.get('SHUTTLE_INDEX_CELL_SIZE', 0.01))
+
+
+def find_nearest_shuttles(origin, query_args, limit, radius_km=None, load_options=None):
+    """
+    Finds the shuttles closest to origin that match query_args, using the shuttle index to pick candidates
+    so only a handful of rows are loaded.
+    :param origin: (latitude, longitude)
+    :param query_args: filters for the shuttle query
+    :param limit: maximum number of shuttles to return
+    :param radius_km: maximum straight-line distance
+    :param load_options: query options for the shuttles, e.g. from Shuttle.load_fields
+    :return: list of (shuttle, distance_km, bearing) sorted by distance
+    """
+    load_shuttle_index()
+
+    found = []
+    checked = set()
+    fetch = limit * 4
+
+    # Candidates that fail the filters are skipped, so widen the search until enough shuttles match.
+    while True:
+        candidates = shuttle_index.nearest(origin[0], origin[1], limit=fetch, radius_km=radius_km)
+        ids = [key for key, _ in candidates if key not in checked]
+        checked.update(ids)
+
+        if ids:
+            found.extend(db.session.query(Shuttle).options(*(load_options or [joinedload(Shuttle.user)]))
+                         .filter_by(**query_args).filter(Shuttle.id.in_(ids)).all())
+
+        if len(found) >= limit or len(candidates) < fetch:
+            break
+
+        fetch *= 4
+
+    # The database has the latest coordinates, so rank on those rather than the index's copy.
+    by_id = dict((shuttle.id, shuttle) for shuttle in found)
+    ids, latitudes, longitudes = coordinate_arrays((shuttle.id, shuttle.latitude, shuttle.longitude)
+                                                   for shuttle in found)
+
+    return [(by_id[shuttle_id], distance, bearing)
+            for shuttle_id, distance, bearing in rank_by_distance(origin, ids, latitudes, longitudes, limit, radius_km)]
 
 
 @locations.route(location_urls['create'], methods=['POST'])
@@ -188,6 +360,7 @@ def add_location():
 
     try:
         db.session.add(location)
+        changes = record_change(location, ChangeActionEnum.created)
         db.session.commit()
 
         if directions is not None:
@@ -201,6 +374,9 @@ def add_location():
         app.logger.error(unknown_error)
         return jsonify({'status': 'error', 'message': unknown_error, 'code': 500})
 
+    bump_versions(changes)
+    queue_travel_times(location.id)
+
     return_obj = location.serialize
     return_obj['uri'] = url_for('locations.get_location',
                                 location_id=location.id,
@@ -210,16 +386,34 @@ def add_location():
 
 
 @locations.route(location_urls['get'], methods=['GET'])
+@versions.conditional('location', 'location_id')
 def get_location(location_id):
 
-    location = db.session.query(Location).filter_by(id=int(location_id)).first()
+    try:
+        fields = Location.parse_fields(request.args.get('fields'))
+    except ValueError as ex:
+        return jsonify({'code': 400, 'status': 'error', 'message': str(ex)})
+
+    # an id that isn't a number can't match a location
+    if not location_id.isdigit():
+        location = None
+    elif fields is None:
+        fragment = fragments.render('location', Location.id, int(location_id),
+                                    db.session.query(Location).options(*Location.load_fields()))
+
+        if fragment is not None:
+            return fragment_response(fragment)
+
+        location = None
+    else:
+        location = Location.get_location_by_id(location_id)
 
     if location is None:
         message = 'Location {0} not found.'.format(location_id)
         app.logger.info(message)
         return jsonify({'status': 'error', 'message': message, 'code': 400})
 
-    return jsonify(location.serialize)
+    return jsonify(location.serialize_fields(fields))
 
 
 @locations.route(location_urls['add_directions'], methods=['POST'])
@@ -228,7 +422,7 @@ def add_directions_to_location(location_id):
 
     payload = request.json
 
-    location = db.session.query(Location).filter_by(id=int(location_id)).first()
+    location = Location.get_location_by_id(location_id)
 
     if location is None:
         message = 'Location {0} not found.'.format(location_id)
@@ -246,6 +440,7 @@ def add_directions_to_location(location_id):
 
     try:
         db.session.add(directions_obj)
+        changes = record_change(directions_obj, ChangeActionEnum.updated)
         db.session.commit()
 
     except SQLAlchemyError as ex:
@@ -253,15 +448,25 @@ def add_directions_to_location(location_id):
         app.logger.error(unknown_error)
         return jsonify({'status': 'error', 'message': unknown_error, 'code': 500})
 
+    bump_versions(changes)
+
     return jsonify(location.serialize)
 
 
+@locations.route(location_urls['changes'], methods=['GET'])
+def get_location_changes():
+
+    return changes_response('location', Location)
+
+
 @locations.route(location_urls['get_all'], methods=['GET'])
+@versions.conditional('location', skip_args=['origin'])
 def get_all_locations():
 
     status_query = request.args.get('status') or StatusEnum.enabled
     location_type = request.args.get('type')
     origin = request.args.get('origin')
+    radius = request.args.get('radius', type=float)
 
     query_args = {
         'status': status_query
@@ -270,51 +475,376 @@ def get_all_locations():
     if location_type is not None:
         query_args['type'] = location_type
 
-    locations_obj = db.session.query(Location).filter_by(**query_args).all()
+    try:
+        limit, after = page_args(request.args, app.config.get('PAGE_MAX_LIMIT', 100))
+        fields = Location.parse_fields(request.args.get('fields'))
+    except ValueError as ex:
+        return jsonify({'code': 400, 'status': 'error', 'message': str(ex)})
+
+    origin_coordinates = parse_coordinates(origin)
+
+    # travel times are added to the directions
+    if origin is not None and fields is not None and 'directions' not in fields:
+        fields.append('directions')
+
+    if origin_coordinates is not None and limit is not None:
+        return jsonify({'code': 400, 'status': 'error',
+                        'message': 'Locations sorted by distance from origin are not paged; use radius instead.'})
+
+    load_options = Location.load_fields(fields, extra=['latitude', 'longitude'] if origin else [])
+    query = db.session.query(Location).options(*load_options).filter_by(**query_args)
+
+    # whole locations are stitched together from cached fragments; only their ids are queried
+    if origin is None and fields is None:
+        ids_query = db.session.query(Location.id).filter_by(**query_args)
+        render = partial(fragments.render_many, 'location', Location.id,
+                         query=db.session.query(Location).options(*load_options))
+
+        if limit is None:
+            response = stream_chunks([location_id for location_id, in ids_query.order_by(Location.id)], render,
+                                     app.config.get('LIST_CHUNK_SIZE', 500))
+        else:
+            rows, next_cursor = paginate(ids_query, Location.id, limit, after)
+            response = fragment_page_response(render([row.id for row in rows]), limit, next_cursor) if rows else None
+
+        return response or jsonify({'code': 500, 'status': 'error', 'message': 'No locations were found.'})
 
-    serialized = [location.serialize for location in locations_obj]
+    if origin is None and limit is None:
+        response = stream_rows(query.order_by(Location.id), lambda location: location.serialize_fields(fields),
+                               app.config.get('LIST_CHUNK_SIZE', 500))
+
+        return response or jsonify({'code': 500, 'status': 'error', 'message': 'No locations were found.'})
+
+    locations_obj, next_cursor = paginate(query, Location.id, limit, after)
+
+    # sort by straight-line distance and drop far away locations before asking for directions
+    ranked = []
+
+    if origin_coordinates is not None:
+        by_id = dict((location.id, location) for location in locations_obj)
+        ids, latitudes, longitudes = coordinate_arrays((location.id, location.latitude, location.longitude)
+                                                       for location in locations_obj)
+        ranked = rank_by_distance(origin_coordinates, ids, latitudes, longitudes, radius_km=radius)
+        locations_obj = [by_id[location_id] for location_id, distance, bearing in ranked]
+
+    serialized = [location.serialize_fields(fields) for location in locations_obj]
+
+    for location, (_, distance, bearing) in zip(serialized, ranked):
+        location['straight_line_distance'] = round(distance, 3)
+        location['bearing'] = round(bearing, 1)
 
     if len(locations_obj) <= 0:
         return jsonify({'code': 500, 'status': 'error', 'message': 'No locations were found.'})
 
-    # get the distances of all the shuttles and determine the closest one (if the user's location is provided
+    response = page_response(serialized, limit, next_cursor)
+
+    # get the travel times from the user's location to every location, if it is provided
     if origin is not None:
 
         try:
-            gmaps = googlemaps.Client(key=app.config['DIRECTIONS_KEY'])
+            errors = attach_travel_times(origin, locations_obj, serialized)
 
-            # TODO: Figure out how to avoid the multiple loops
-            for location in serialized:
-                location_str = "{0},{1}".format(location["latitude"], location["longitude"])
+            if errors:
+                response['incomplete'] = True
 
-                if not 'direcions' not in location.keys():
-                    location['directions'] = dict()
+            if any(isinstance(ex, (CircuitOpen, TimeoutError)) for ex in errors.values()):
+                response['degraded'] = True
 
-                for travel_mode in ['driving', 'walking', 'transit']:
+        except Exception as ex:
+            message = 'Could not get directions: {0}'.format(ex)
+            app.logger.error(message)
+            response['degraded'] = True
 
-                    if not location['directions'][travel_mode]:
-                        location['directions'][travel_mode] = dict()
+    return jsonify(response)
 
-                    # convert to object
-                    l_directions = location['directions'][travel_mode]
 
-                    location['directions'][travel_mode] = {'instructions': l_directions}
+def changes_response(collection, model):
+    """
+    Delta sync. Returns the entities created, updated or disabled after ?since=<version>, each once, in
+    their current state, plus the version to pass as `since` next time. Without `since` only the current
+    version is returned: take it before loading the full list, then sync from it. Location pings are not
+    logged, so shuttle positions come from the stream or the list instead. Changes show up once they are
+    CHANGES_SETTLE_SECONDS old, so versions never skip a change whose transaction was still committing.
+    :param collection: 'shuttle' or 'location'
+    :param model: Shuttle or Location
+    :return: response
+    """
+    since = request.args.get('since')
+    max_limit = app.config.get('PAGE_MAX_LIMIT', 100)
+    limit = request.args.get('limit', max_limit, type=int)
 
-                    direction_response = directions(gmaps, origin, location_str, travel_mode)
+    try:
+        fields = model.parse_fields(request.args.get('fields'))
+    except ValueError as ex:
+        return jsonify({'code': 400, 'status': 'error', 'message': str(ex)})
 
-                    for result in direction_response:
+    # a client looping on `more` would never get anywhere
+    if limit < 1:
+        return jsonify({'code': 400, 'status': 'error', 'message': 'limit must be at least 1.'})
 
-                        step = result['legs'][0]['steps'][0]
+    limit = min(limit, max_limit)
+    settled = datetime.now() - timedelta(seconds=app.config.get('CHANGES_SETTLE_SECONDS', 5))
 
-                        location['directions'][travel_mode]['duration'] = step["duration"]
+    if since is None:
+        return jsonify({'status': 'success', 'data': {'version': ChangeLog.latest(collection, settled),
+                                                      'changes': [], 'more': False}})
 
-                        location['directions'][travel_mode]['distance'] = step["distance"]
+    if not since.isdigit():
+        return jsonify({'code': 400, 'status': 'error', 'message': 'since must be a version number.'})
 
-        except Exception as ex:
-            message = 'Could not get directions: {0}'.format(ex)
-            app.logger.error(message)
+    changes = ChangeLog.since(collection, int(since), limit + 1, settled)
+    more = len(changes) > limit
+    changes = changes[:limit]
+
+    # only the latest change to each entity matters
+    latest = dict((change.entity_id, change) for change in changes)
+    entities = db.session.query(model).options(*model.load_fields(fields))\
+        .filter(model.id.in_(latest.keys())).all() if latest else []
+
+    data = [{
+        'version': latest[entity.id].id,
+        'action': latest[entity.id].action.value,
+        'data': entity.serialize_fields(fields)
+    } for entity in entities]
+
+    return jsonify({'status': 'success', 'data': {
+        'version': changes[-1].id if changes else int(since),
+        'changes': sorted(data, key=lambda change: change['version']),
+        'more': more
+    }})
+
+
+def attach_travel_times(origin, locations_obj, serialized):
+    """
+    Adds the driving, walking and transit duration and distance from origin to each serialized location.
+    When origin is at a bus stop, they are read from the precomputed travel times where there are some.
+    Uncached directions calls run concurrently; any that fail or miss the deadline (MAPS_FANOUT_DEADLINE or
+    what is left of the request's maps budget) are left out, and none are made while the maps circuit is open.
+    :param origin:
+    :param locations_obj: locations
+    :param serialized: the same locations, serialized
+    :return: dict of (destination, travel mode) -> error, for the travel times that are missing
+    """
+    travel_modes = TravelTime.modes
+    destinations = ["{0},{1}".format(location.latitude, location.longitude) for location in locations_obj]
+
+    precomputed = {}
+    stop_id = snap_to_stop(origin)
+
+    if stop_id is not None:
+        travel_times = TravelTime.from_origin(stop_id, [location.id for location in locations_obj])
+
+        for location, destination in zip(locations_obj, destinations):
+            if location.id not in travel_times:
+                continue
+
+            for travel_mode in travel_modes:
+                leg = travel_times[location.id].leg(travel_mode)
+
+                # a computed pair with no route for this mode is served as an empty leg, not looked up live
+                precomputed[(destination, travel_mode)] = distance_and_duration(*leg) if leg is not None else {}
+
+    responses = {}
+    calls = {}
+
+    for travel_mode in travel_modes:
+        pending = [destination for destination in destinations if (destination, travel_mode) not in precomputed]
+        cached = maps_cache.get_many('directions', travel_mode, [[origin, destination] for destination in pending])
+
+        for destination, direction_response in zip(pending, cached):
+            if direction_response is not None:
+                responses[(destination, travel_mode)] = direction_response
+            else:
+                # cached by load, which also shares the call with concurrent requests for the same trip
+                calls[(destination, travel_mode)] = partial(
+                    maps_cache.load, 'directions', travel_mode, [origin, destination],
+                    partial(routing.directions, origin, destination, travel_mode))
+
+    if routing.available:
+        fetched, errors = maps_pool.run(calls, min(app.config.get('MAPS_FANOUT_DEADLINE', 5), maps_time_left()))
+    else:
+        fetched, errors = {}, dict((call, CircuitOpen('The maps API is failing.')) for call in calls)
+
+    prefetches = []
+
+    for (destination, travel_mode), ex in errors.items():
+        app.logger.error('Could not get {0} directions to {1}: {2}'.format(travel_mode, destination, ex))
+
+        # too slow to wait for: fetch it in the background so the next request finds it cached
+        if isinstance(ex, TimeoutError) and maps_cache.backend is not None:
+            prefetches.append(({'origin': origin, 'destination': destination, 'mode': travel_mode},
+                               maps_cache.key('directions', travel_mode, [origin, destination])))
+
+    if prefetches:
+        try:
+            jobs.enqueue_many('prefetch_directions', prefetches)
+        except SQLAlchemyError as job_ex:
+            app.logger.error('Could not queue directions prefetches: {0}'.format(job_ex))
+
+    responses.update(fetched)
+
+    for location, destination in zip(serialized, destinations):
+        location_directions = location['directions'] or dict()
+
+        for travel_mode in travel_modes:
+            # convert to object
+            travel_directions = {'instructions': location_directions.get(travel_mode)}
+            travel_directions.update(precomputed.get((destination, travel_mode), {}))
+
+            for result in responses.get((destination, travel_mode), []):
+                step = result['legs'][0]['steps'][0]
+
+                travel_directions['duration'] = step["duration"]
+
+                travel_directions['distance'] = step["distance"]
+
+            location_directions[travel_mode] = travel_directions
+
+        location['directions'] = location_directions
+
+    return errors
+
+
+def snap_to_stop(origin):
+    """
+    :param origin: "lat,lng" string or address
+    :return: id of the enabled bus stop within TRAVEL_TIME_SNAP_RADIUS metres of origin, or None
+    """
+    coordinates = parse_coordinates(origin)
+
+    if coordinates is None:
+        return None
+
+    ids, latitudes, longitudes = coordinate_arrays(db.session.query(Location.id, Location.latitude, Location.longitude)
+                                                   .filter_by(type=LocationTypeEnum.bus_stop,
+                                                              status=StatusEnum.enabled))
+    nearest = rank_by_distance(coordinates, ids, latitudes, longitudes, limit=1,
+                               radius_km=app.config.get('TRAVEL_TIME_SNAP_RADIUS', 50) / 1000.0)
+
+    return int(nearest[0][0]) if nearest else None
+
+
+@jobs.handler('refresh_travel_times')
+def refresh_travel_times(location_id=None):
+    """
+    Recomputes the precomputed travel times from every enabled bus stop to every enabled building, with one
+    distance matrix call per stop, travel mode and batch of buildings. With location_id, only the pairs
+    to or from that location are recomputed (or dropped, if it is no longer an enabled stop or building).
+    :param location_id:
+    :return: number of pairs stored
+    """
+    enabled = db.session.query(Location).filter(Location.status == StatusEnum.enabled,
+                                                Location.latitude.isnot(None), Location.longitude.isnot(None))
+    stops = enabled.filter(Location.type == LocationTypeEnum.bus_stop).all()
+    buildings = enabled.filter(Location.type == LocationTypeEnum.building).all()
+
+    if location_id is None:
+        stale = db.session.query(TravelTime)
+
+        if stops and buildings:
+            stale = stale.filter(or_(TravelTime.origin_id.notin_([stop.id for stop in stops]),
+                                     TravelTime.destination_id.notin_([building.id for building in buildings])))
+    else:
+        location_id = int(location_id)
+        stale = db.session.query(TravelTime).filter(or_(TravelTime.origin_id == location_id,
+                                                        TravelTime.destination_id == location_id))
+
+        if location_id in [stop.id for stop in stops]:
+            stops = [stop for stop in stops if stop.id == location_id]
+        else:
+            buildings = [building for building in buildings if building.id == location_id]
+
+    stale.delete(synchronize_session=False)
+    db.session.commit()
+
+    count = 0
+
+    for stop in stops:
+        if not buildings:
+            break
 
-    return jsonify({'status': 'success', 'data': serialized})
+        rows = travel_times_from(stop, buildings)
+        db.session.query(TravelTime).filter(TravelTime.origin_id == stop.id,
+                                            TravelTime.destination_id.in_([row.destination_id for row in rows]))\
+            .delete(synchronize_session=False)
+        db.session.add_all(rows)
+        db.session.commit()
+        count += len(rows)
+
+    return count
+
+
+def travel_times_from(stop, buildings):
+    """
+    :param stop: bus stop
+    :param buildings:
+    :return: a TravelTime from stop to each building
+    """
+    origin = "{0},{1}".format(stop.latitude, stop.longitude)
+    legs = dict((building.id, {}) for building in buildings)
+    # the distance matrix API takes at most 25 destinations per call
+    batch_size = 25
+
+    for travel_mode in TravelTime.modes:
+        for start in range(0, len(buildings), batch_size):
+            batch = buildings[start:start + batch_size]
+            response = routing.distance_matrix(
+                [origin], ["{0},{1}".format(building.latitude, building.longitude) for building in batch], travel_mode)
+
+            for building, element in zip(batch, response['rows'][0]['elements']):
+                if element['status'] == 'OK':
+                    legs[building.id][travel_mode] = (element['duration']['value'], element['distance']['value'])
+
+    return [TravelTime(stop.id, building.id, legs[building.id]) for building in buildings]
+
+
+def queue_travel_times(location_id):
+    """
+    Queues a refresh of the precomputed travel times to and from a location. Call after committing.
+    :param location_id:
+    :return:
+    """
+    try:
+        jobs.enqueue('refresh_travel_times', {'location_id': location_id},
+                     key='refresh_travel_times:{0}'.format(location_id))
+    except SQLAlchemyError as ex:
+        app.logger.error('Could not queue travel times refresh: {0}'.format(ex))
+
+
+def maps_time_left():
+    """
+    Seconds left of this request's MAPS_REQUEST_BUDGET for maps calls. The clock starts at the first call.
+    :return:
+    """
+    if 'maps_deadline' not in g:
+        g.maps_deadline = time.time() + app.config.get('MAPS_REQUEST_BUDGET', 3)
+
+    return max(g.maps_deadline - time.time(), 0)
+
+
+def call_maps(func):
+    """
+    Makes a maps call, waiting for it no longer than the request's maps budget allows. A call that runs
+    over carries on in the background, so its result is still cached.
+    :param func: function taking no arguments
+    :return: what func returned
+    :raises CircuitOpen: without calling, while the maps circuit is open
+    :raises TimeoutError: when the budget runs out first
+    """
+    if not routing.available:
+        raise CircuitOpen('The maps API is failing.')
+
+    results, errors = maps_pool.run({'call': func}, maps_time_left())
+
+    if errors:
+        raise errors['call']
+
+    return results['call']
+
+
+@jobs.handler('prefetch_directions')
+def prefetch_directions(origin, destination, mode):
+    maps_cache.fetch('directions', mode, [origin, destination], partial(routing.directions, origin, destination, mode))
 
 
 @locations.route(location_urls['update'], methods=['PUT'])
@@ -323,13 +853,16 @@ def update_location(location_id):
 
     payload = request.json
 
-    location = db.session.query(Location).filter_by(id=location_id).first()
+    location = Location.get_location_by_id(location_id)
 
     if location is None:
         message = 'Location {0} not found.'.format(location_id)
         app.logger.info(message)
         return jsonify({'status': 'error', 'message': message, 'code': 400})
 
+    # the precomputed travel times only depend on these
+    placement = (location.type, location.status, location.latitude, location.longitude)
+
     try:
         update_entry(payload, location)
 
@@ -353,6 +886,9 @@ def update_location(location_id):
         app.logger.error(unknown_error)
         return jsonify({'status': 'error', 'message': unknown_error, 'code': 500})
 
+    if (location.type, location.status, location.latitude, location.longitude) != placement:
+        queue_travel_times(location.id)
+
     return jsonify({"status": 'success', 'data': location.serialize})
 
 
@@ -384,14 +920,29 @@ def switch_driver_mode(shuttle_id, driver_id):
 
     shuttle.latitude = current_location['latitude']
     shuttle.longitude = current_location['longitude']
+    shuttle.location_updated = datetime.now()
+
+    # a buffered ping flushed after this commit would overwrite the new position
+    location_buffer.discard(shuttle.id)
 
     try:
+        changes = record_change(shuttle, ChangeActionEnum.updated)
         db.session.commit()
     except SQLAlchemyError as ex:
         unknown_error = "Could not switch shuttle\'s mode: {0}".format(ex)
         app.logger.error(unknown_error)
         return jsonify({'status': 'error', 'message': unknown_error, 'code': 500})
 
+    bump_versions(changes)
+    shuttle_index.update(shuttle.id, shuttle.latitude, shuttle.longitude)
+    location_history.append(shuttle.id, shuttle.latitude, shuttle.longitude)
+    shuttle_events.publish('mode', {
+        'shuttle_id': shuttle.id,
+        'en_route': shuttle.en_route,
+        'latitude': shuttle.latitude,
+        'longitude': shuttle.longitude
+    })
+
     return jsonify({"status": 'success', 'data': shuttle.serialize})
 
 
@@ -399,6 +950,18 @@ def switch_driver_mode(shuttle_id, driver_id):
 @validate_schema(update_shuttle_location_schema)
 def update_shuttle_location(shuttle_id, driver_id):
 
+    latitude = request.json.get('lat')
+    longitude = request.json.get('lng')
+
+    if not shuttle_id.isdigit() or not driver_id.isdigit():
+        return jsonify({'code': 400, 'status': 'error', 'message': 'Shuttle and driver ids must be numbers.'})
+
+    shuttle_id, driver_id = int(shuttle_id), int(driver_id)
+
+    # pings from a driver we've recently verified go straight into the buffer without touching the database
+    if location_buffer.enabled and location_buffer.is_owner(shuttle_id, driver_id):
+        return buffer_shuttle_location(shuttle_id, latitude, longitude)
+
     driver = User.get_user(driver_id)
 
     if driver is None:
@@ -415,8 +978,13 @@ def update_shuttle_location(shuttle_id, driver_id):
     if shuttle.user_id != driver.user_id:
         return jsonify({'code': 400, 'status': 'error', 'message': 'This shuttle is not driven by this driver.'})
 
-    shuttle.longitude = request.json.get('lng')
-    shuttle.latitude = request.json.get('lat')
+    if location_buffer.enabled:
+        location_buffer.set_owner(shuttle.id, driver.user_id)
+        return buffer_shuttle_location(shuttle.id, latitude, longitude)
+
+    shuttle.longitude = longitude
+    shuttle.latitude = latitude
+    shuttle.location_updated = datetime.now()
 
     try:
         db.session.commit()
@@ -425,9 +993,198 @@ def update_shuttle_location(shuttle_id, driver_id):
         app.logger.error(unknown_error)
         return jsonify({'status': 'error', 'message': unknown_error, 'code': 500})
 
+    versions.bump('shuttle', shuttle.id)
+    shuttle_index.update(shuttle.id, shuttle.latitude, shuttle.longitude)
+    location_history.append(shuttle.id, shuttle.latitude, shuttle.longitude)
+    publish_position(shuttle.id, shuttle.latitude, shuttle.longitude)
+
     return jsonify({"status": 'success', 'data': shuttle.serialize})
 
 
+@shuttles.route(urls['batch_update_location'], methods=['PUT'])
+@validate_schema(batch_update_shuttle_location_schema)
+def batch_update_shuttle_locations():
+
+    pings = request.json.get('pings')
+    shuttle_ids = set(ping['shuttle_id'] for ping in pings)
+
+    # one query checks every shuttle in the batch, who drives it and that they are a driver
+    owners = dict(db.session.query(Shuttle.id, Shuttle.user_id)
+                  .join(User, User.user_id == Shuttle.user_id)
+                  .filter(Shuttle.id.in_(shuttle_ids),
+                          Shuttle.status == StatusEnum.enabled,
+                          User.account_type == AccountTypeEnum.driver)
+                  .all())
+
+    latest = {}
+    accepted = []
+    rejected = []
+
+    for index, ping in enumerate(pings):
+        shuttle_id = ping['shuttle_id']
+
+        if owners.get(shuttle_id) != ping['driver_id']:
+            rejected.append({'index': index, 'shuttle_id': shuttle_id,
+                             'message': 'This shuttle is not driven by this driver.'})
+            continue
+
+        # NaN gets past the schema's bounds
+        if any(math.isnan(ping[key]) for key in ('lat', 'lng', 'timestamp')):
+            rejected.append({'index': index, 'shuttle_id': shuttle_id,
+                             'message': 'lat, lng and timestamp must be numbers.'})
+            continue
+
+        accepted.append(ping)
+
+        if shuttle_id not in latest or ping['timestamp'] >= latest[shuttle_id]['timestamp']:
+            latest[shuttle_id] = ping
+
+    # clamp timestamps from fast device clocks, or they would block every later update
+    now = datetime.now()
+    positions = [{
+        'shuttle_id': shuttle_id,
+        'lat': ping['lat'],
+        'lng': ping['lng'],
+        'received': min(datetime.fromtimestamp(ping['timestamp']), now)
+    } for shuttle_id, ping in latest.items()]
+
+    written = []
+
+    if positions:
+        try:
+            written = Shuttle.update_locations(positions)
+        except SQLAlchemyError as ex:
+            unknown_error = "Could not update shuttle locations: {0}".format(ex)
+            app.logger.error(unknown_error)
+            return jsonify({'status': 'error', 'message': unknown_error, 'code': 500})
+
+        if written:
+            versions.bump('shuttle', *written)
+
+        for position in positions:
+            if position['shuttle_id'] not in written:
+                continue
+
+            shuttle_index.update(position['shuttle_id'], position['lat'], position['lng'])
+            publish_position(position['shuttle_id'], position['lat'], position['lng'])
+
+        # history keeps every ping, not just the latest
+        now = time.time()
+        for ping in accepted:
+            location_history.append(ping['shuttle_id'], ping['lat'], ping['lng'], min(ping['timestamp'], now))
+
+    # stale: the shuttle already has a newer position
+    return jsonify({'status': 'success', 'data': {'accepted': sorted(written), 'rejected': rejected,
+                                                  'stale': sorted(set(latest.keys()) - set(written))}})
+
+
+def buffer_shuttle_location(shuttle_id, latitude, longitude):
+    """
+    Accepts a ping into the write-behind buffer and acknowledges it straight away.
+    :param shuttle_id:
+    :param latitude:
+    :param longitude:
+    :return: 202 response
+    """
+    location_buffer.add(shuttle_id, latitude, longitude)
+    shuttle_index.update(shuttle_id, latitude, longitude)
+    location_history.append(shuttle_id, latitude, longitude)
+    publish_position(shuttle_id, latitude, longitude)
+
+    return jsonify({'status': 'success', 'data': {
+        'shuttle_id': shuttle_id,
+        'latitude': latitude,
+        'longitude': longitude,
+        'buffered': True
+    }}), 202
+
+
+def publish_position(shuttle_id, latitude, longitude):
+    shuttle_events.publish('position', {'shuttle_id': shuttle_id, 'latitude': latitude, 'longitude': longitude})
+
+
+@shuttles.route(urls['stream'], methods=['GET'])
+def stream_shuttle_events():
+    """
+    Server-sent events stream of shuttle position ('position') and mode ('mode') changes. Optional
+    bbox=min_lat,min_lng,max_lat,max_lng only sends changes inside the box. A 'reset' event means some
+    changes were missed and the client should reload the fleet from GET /shuttles/.
+    """
+    bbox = request.args.get('bbox')
+
+    if bbox is not None:
+        try:
+            bbox = [float(value) for value in bbox.split(',')]
+        except ValueError:
+            bbox = []
+
+        if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            return jsonify({'status': 'error', 'message': 'bbox must be min_lat,min_lng,max_lat,max_lng.',
+                            'code': 400})
+
+    # browsers send the id of the last event they saw when they reconnect
+    cursor = request.headers.get('Last-Event-ID') or shuttle_events.cursor
+
+    def generate(cursor):
+        yield 'retry: 3000\n\n'
+
+        while True:
+            cursor, events, missed = shuttle_events.wait(cursor)
+
+            if missed:
+                yield 'id: {0}\nevent: reset\ndata: {{}}\n\n'.format(cursor)
+                continue
+
+            messages = ['event: {0}\ndata: {1}\n\n'.format(event['type'], json.dumps(event['data']))
+                        for _, event in events if event_in_bbox(event, bbox)]
+
+            if messages:
+                yield ''.join(messages[:-1]) + 'id: {0}\n'.format(cursor) + messages[-1]
+            else:
+                yield ': keep-alive\n\n'
+
+    return Response(generate(cursor), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+@shuttles.route(urls['history'], methods=['GET'])
+def get_shuttle_history(shuttle_id):
+
+    try:
+        start = float(request.args['start']) if request.args.get('start') else None
+        end = float(request.args['end']) if request.args.get('end') else None
+        max_points = int(request.args['max_points']) if request.args.get('max_points') else None
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'start and end must be epoch seconds and max_points a number.',
+                        'code': 400})
+
+    if max_points is not None and max_points < 1:
+        return jsonify({'status': 'error', 'message': 'max_points must be at least 1.', 'code': 400})
+
+    # also false for NaN
+    if any(value is not None and not 0 <= value <= MAX_TIMESTAMP for value in (start, end)):
+        return jsonify({'status': 'error', 'message': 'start and end must be epoch seconds.', 'code': 400})
+
+    if start is not None and end is not None and start > end:
+        return jsonify({'status': 'error', 'message': 'start must be before end.', 'code': 400})
+
+    shuttle = Shuttle.get_shuttle_by_id(shuttle_id)
+
+    if shuttle is None:
+        return jsonify({'code': 400, 'status': 'error', 'message': 'We could not find this shuttle.'})
+
+    points, stats = location_history.query(shuttle.id, start, end, max_points)
+
+    stats.update({
+        'shuttle_id': shuttle.id,
+        'points': [list(point) for point in points]
+    })
+
+    return jsonify({'status': 'success', 'data': stats})
+
+
 @shuttles.route(urls['get_distance_matrix'], methods=['GET'])
 def get_distance_matrix():
 
@@ -441,9 +1198,8 @@ def get_distance_matrix():
         return jsonify({'status': 'error', 'message': 'The origin and destination queries cannot be empty.'})
 
     try:
-        gmaps = googlemaps.Client(key=app.config['GMAPS_KEY'])
-
-        result = distance_matrix(gmaps, [origin], [destination])
+        result = maps_cache.fetch('distance_matrix', 'driving', [origin, destination],
+                                  partial(routing.distance_matrix, [origin], [destination]))
 
     except Exception as ex:
         return jsonify({'status': 'error', 'message': 'Could not get distance: \'{0}\''.format(ex)})
@@ -465,9 +1221,8 @@ def get_directions():
         return jsonify({'status': 'error', 'message': 'The origin and destination queries cannot be empty.'})
 
     try:
-        gmaps = googlemaps.Client(key=app.config['GMAPS_KEY'])
-
-        result = directions(gmaps, [origin], [destination], mode)
+        result = maps_cache.fetch('directions', mode, [origin, destination],
+                                  partial(routing.directions, origin, destination, mode))
 
     except Exception as ex:
         return jsonify({'status': 'error', 'message': 'Could not get directions: \'{0}\''.format(ex)})
@@ -475,6 +1230,15 @@ def get_directions():
     return jsonify({'status': 'success', 'data': result})
 
 
+@shuttles.route(urls['maps_stats'], methods=['GET'])
+@auth.login_required
+def get_maps_stats():
+
+    return jsonify({'status': 'success', 'data': {'gateway': maps_gateway.stats(), 'cache': maps_cache.stats(),
+                                                  'coalesced': maps_cache.flights.shared,
+                                                  'breaker': maps_gateway.breaker.snapshot()}})
+
+
 def update_entry(payload, entry_object, skip_values=None):
     """
     :param payload:
@@ -485,6 +1249,8 @@ def update_entry(payload, entry_object, skip_values=None):
     """
 
     skip_values = skip_values or []
+    # related rows (e.g. a shuttle's user) are never replaced from a payload
+    relationships = inspect(entry_object).mapper.relationships.keys()
 
     if 'created' not in skip_values:
         skip_values.append('created')
@@ -496,13 +1262,69 @@ def update_entry(payload, entry_object, skip_values=None):
 
         converted_prop = convert_to_snake_case(obj)
 
-        if converted_prop in skip_values:
+        if converted_prop in skip_values or converted_prop in relationships:
             continue
 
         if not hasattr(entry_object, converted_prop):
             continue
         setattr(entry_object, converted_prop, payload[obj])
 
+    disabled = payload.get('status') in (StatusEnum.disabled.value, StatusEnum.blocked.value)
+    changes = record_change(entry_object, ChangeActionEnum.disabled if disabled else ChangeActionEnum.updated)
+
     db.session.commit()
+    bump_versions(changes)
 
     return True
+
+
+def affected_entities(entry_object):
+    """
+    :param entry_object:
+    :return: list of (collection, id) of the shuttles and locations whose responses include entry_object
+    """
+    if isinstance(entry_object, Shuttle):
+        return [('shuttle', entry_object.id)]
+
+    if isinstance(entry_object, Location):
+        return [('location', entry_object.id)]
+
+    if isinstance(entry_object, Directions):
+        return [('location', entry_object.location_id)]
+
+    if isinstance(entry_object, User):
+        # shuttles include their driver
+        shuttles_query = db.session.query(Shuttle.id).filter_by(user_id=entry_object.user_id)
+        return [('shuttle', shuttle_id) for shuttle_id, in shuttles_query]
+
+    return []
+
+
+def record_change(entry_object, action):
+    """
+    Adds change log rows for entry_object to the session, to be committed along with the change itself.
+    :param entry_object:
+    :param action: ChangeActionEnum; changes to related rows (a driver, directions) are always updates
+    :return: the affected (collection, id) pairs, for bump_versions once committed
+    """
+    # new rows need their ids
+    db.session.flush()
+    changes = affected_entities(entry_object)
+
+    if not isinstance(entry_object, (Shuttle, Location)):
+        action = ChangeActionEnum.updated
+
+    for collection, entity_id in changes:
+        db.session.add(ChangeLog(collection, entity_id, action))
+
+    return changes
+
+
+def bump_versions(changes):
+    """
+    Bumps the version counters of the responses that include the changed rows. Call after committing.
+    :param changes: (collection, id) pairs from record_change
+    :return:
+    """
+    for collection in set(collection for collection, _ in changes):
+        versions.bump(collection, *[entity_id for changed, entity_id in changes if changed == collection])
@@ -7,7 +7,8 @@ URLS = {
         'confirm': '/<username>/confirm',
         'get_drivers': '/drivers',
         'update': '/<user_id>',
-        'login': '/login'
+        'login': '/login',
+        'signup_stats': '/signup-stats'
     },
     'drivers': {
         'get': '/'
@@ -19,14 +20,20 @@ URLS = {
         'update': '/<shuttle_id>',
         'switch_mode': '/<shuttle_id>/mode/<driver_id>',
         'update_location': '/<shuttle_id>/location/<driver_id>',
+        'batch_update_location': '/locations',
+        'history': '/<shuttle_id>/history',
+        'stream': '/stream',
+        'changes': '/changes',
         'get_distance_matrix': '/distance-matrix',
-        'get_directions': '/directions'
+        'get_directions': '/directions',
+        'maps_stats': '/maps-stats'
     },
     'locations': {
         'create': '/',
         'get': '/<location_id>',
         'get_all': '/',
         'update': '/<location_id>',
-        'add_directions': '/<location_id>/directions'
+        'add_directions': '/<location_id>/directions',
+        'changes': '/changes'
     }
 }
@@ -1,4 +1,4 @@
-from time import sleep
+from functools import partial
 
 from flask import (abort,
                    Blueprint,
@@ -7,10 +7,9 @@ from flask import (abort,
                    request,
                    url_for,
                    current_app as app)
-from requests import HTTPError
 from sqlalchemy.exc import SQLAlchemyError
 
-from app import auth, cache, db
+from app import auth, auth_tokens, cache, db, fragments, jobs, passwords, versions
 from app.api.urls import URLS
 from app.api.shuttles.shuttles import update_entry
 from app.api.users.schemas import (
@@ -20,6 +19,11 @@ from app.api.users.schemas import (
 )
 
 from app.lib.email import send_email
+from app.lib.fragments import fragment_page_response, fragment_response
+from app.lib.metrics import Metrics
+from app.lib.pagination import page_args, paginate
+from app.lib.streaming import stream_chunks
+from app.lib.tokens import REVOKED_STATUSES
 from app.lib.validation import validate_schema
 from app.models.users import User, AccountTypeEnum, StatusEnum as UserStatusEnum, verify_password
 
@@ -29,32 +33,45 @@ drivers = Blueprint('drivers', __name__, url_prefix='/drivers')
 urls = URLS['users']
 driver_urls = URLS['drivers']
 
+# time each signup holds a worker for
+signup_metrics = Metrics()
+
 
 @users.route(urls['token'], methods=['GET'])
 @auth.login_required
 def get_auth_token():
     token = g.user.generate_auth_token()
 
+    # the token was valid but its user has been deleted
+    if token is None:
+        abort(401)
+
     return jsonify({'token': token.decode('ascii')})
 
 
 @users.route(urls['get'], methods=['GET'])
 @auth.login_required
 def get_user(user_id):
-    user = db.session.query(User).filter_by(user_id=int(user_id)).first()
+    # an id that isn't a number can't match a user
+    fragment = fragments.render('user', User.user_id, int(user_id), db.session.query(User)) \
+        if user_id.isdigit() else None
 
-    if user is None:
+    if fragment is None:
         message = 'User {0} not found.'.format(user_id)
         app.logger.info(message)
         return jsonify({'status': 'error', 'message': message, 'code': 400})
 
-    return jsonify(user.serialize)
+    return fragment_response(fragment)
 
 
 @users.route(urls['register'], methods=["POST"])
 @validate_schema(register_user_schema)
 def register_user():
-    sleep(1)  # try to avoid email enumeration attacks
+    with signup_metrics.timer('register'):
+        return _register_user()
+
+
+def _register_user():
     first_name = request.json.get('firstName')
     last_name = request.json.get('lastName')
     password = request.json.get('password')
@@ -62,6 +79,8 @@ def register_user():
     account_type = request.json.get('accountType')
 
     if db.session.query(User).filter_by(email=email).first() is not None:
+        # hash anyway, so that this answer takes as long as a signup and the timing doesn't give away the email
+        passwords.hash(password)
         email_exists = 'Sorry, a user with this email already exists.'
         app.logger.info(email_exists)
         return jsonify({'status': 'error', 'message': email_exists, 'code': 409})
@@ -76,25 +95,11 @@ def register_user():
         app.logger.error(unknown_error)
         return jsonify({'status': 'error', 'message': unknown_error, 'code': 500})
 
-    # send confirmation email
-    # try:
-    #     resp = send_email(
-    #         to=user.email,
-    #         subject='Thank you for registering!',
-    #         body='Registration code: {registration_code}'.format(
-    #             registration_code=user.registration_code)
-    #     )
-    #     resp.raise_for_status()
-    # except HTTPError as ex:
-    #     message = 'Failed to email registration code to '
-    #     '{email}: {ex}'.format(email=user.email, ex=ex)
-    #     app.logger.error(message)
-    #     error_resp = jsonify({
-    #         'errorMsg': message.split(':')[0],
-    #     })
-    #     error_resp.status_code = 500
-    #
-    #     return error_resp
+    # the email is sent in the background, with retries
+    try:
+        jobs.enqueue('registration_email', {'user_id': user.user_id}, key='registration_email:{0}'.format(user.user_id))
+    except SQLAlchemyError as ex:
+        app.logger.error('Could not queue the registration email for user {0}: {1}'.format(user.user_id, ex))
 
     user_obj = user.serialize
     user_obj['uri'] = url_for('users.get_user', user_id=user.user_id, external=True)
@@ -104,6 +109,22 @@ def register_user():
     return jsonify(return_obj)
 
 
+@jobs.handler('registration_email')
+def send_registration_email(user_id):
+    user = db.session.query(User).get(user_id)
+
+    if user is None or user.registration_confirmed:
+        return
+
+    resp = send_email(
+        to=user.email,
+        subject='Thank you for registering!',
+        body='Registration code: {registration_code}'.format(
+            registration_code=user.registration_code)
+    )
+    resp.raise_for_status()
+
+
 @users.route(urls['login'], methods=["POST"])
 @validate_schema(login_schema)
 def login():
@@ -142,15 +163,25 @@ def login():
     return jsonify({'status': 'success', 'data': {'user': user.serialize, 'token': token.decode('ascii')}})
 
 
+@users.route(urls['signup_stats'], methods=['GET'])
+@auth.login_required
+def get_signup_stats():
+
+    return jsonify({'status': 'success', 'data': signup_metrics.snapshot()})
+
+
 @drivers.route(driver_urls['get'], methods=['GET'])
 def get_all_drivers():
 
-    result = db.session.query(User).filter_by(account_type=AccountTypeEnum.driver).all()
+    try:
+        limit, after = page_args(request.args, app.config.get('PAGE_MAX_LIMIT', 100))
+    except ValueError as ex:
+        return jsonify({'code': 400, 'status': 'error', 'message': str(ex)})
 
-    if len(result) <= 0:
-        return jsonify({'code': 500, 'status': 'error', 'message': 'No drivers were found.'})
+    response = user_list_response(db.session.query(User.user_id).filter_by(account_type=AccountTypeEnum.driver),
+                                  limit, after)
 
-    return jsonify({'status': 'success', 'data': [driver.serialize for driver in result]})
+    return response or jsonify({'code': 500, 'status': 'error', 'message': 'No drivers were found.'})
 
 
 @users.route(urls['get_all'], methods=['GET'])
@@ -167,12 +198,33 @@ def get_all_users():
     if account_type_query is not None:
         query_args['account_type'] = account_type_query
 
-    users = db.session.query(User).filter_by(**query_args).all()
+    try:
+        limit, after = page_args(request.args, app.config.get('PAGE_MAX_LIMIT', 100))
+    except ValueError as ex:
+        return jsonify({'code': 400, 'status': 'error', 'message': str(ex)})
+
+    response = user_list_response(db.session.query(User.user_id).filter_by(**query_args), limit, after)
+
+    return response or jsonify({'code': 500, 'status': 'error', 'message': 'No users were found.'})
 
-    if len(users) <= 0:
-        return jsonify({'code': 500, 'status': 'error', 'message': 'No users were found.'})
 
-    return jsonify({'status': 'success', 'data': [user.serialize for user in users]})
+def user_list_response(ids_query, limit, after):
+    """
+    Lists users from cached fragments; only their ids are queried.
+    :param ids_query: filtered query for User.user_id
+    :param limit: page size, or None to stream every user
+    :param after:
+    :return: response, or None if there are no users
+    """
+    render = partial(fragments.render_many, 'user', User.user_id, query=db.session.query(User))
+
+    if limit is None:
+        return stream_chunks([user_id for user_id, in ids_query.order_by(User.user_id)], render,
+                             app.config.get('LIST_CHUNK_SIZE', 500))
+
+    rows, next_cursor = paginate(ids_query, User.user_id, limit, after)
+
+    return fragment_page_response(render([row.user_id for row in rows]), limit, next_cursor) if rows else None
 
 
 @users.route(urls['update'], methods=['PUT'])
@@ -195,6 +247,11 @@ def update_user(user_id):
         app.logger.error(unknown_error)
         return jsonify({'status': 'error', 'message': unknown_error, 'code': 500})
 
+    versions.bump('user', user.user_id)
+
+    if payload.get('status') in REVOKED_STATUSES:
+        auth_tokens.revoke(user.user_id)
+
     return jsonify({"status": 'success', 'data': user.serialize})
 
 
@@ -219,6 +276,8 @@ def confirm_registration(username):
             )
             abort(500)
 
+        versions.bump('user', user.user_id)
+
         return jsonify(user.serialize)
     else:
         app.logger.info(
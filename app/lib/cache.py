@@ -1,4 +1,18 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from functools import partial
+
+import redis
 from flask_cache import Cache
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+from sqlalchemy.orm.util import identity_key
+
+from app.lib.concurrency import SingleFlight
+from app.lib.geo import parse_coordinates
 
 
 def build_cache_from_config(app):
@@ -21,3 +35,406 @@ def build_cache_from_config(app):
     cache = Cache(config=cache_config)
 
     return cache
+
+
+class MapsResultCache(object):
+    """
+    TTL cache for maps API results. Coordinates are snapped to a grid of MAPS_CACHE_GRID degrees so that
+    riders standing at the same stop share entries, and each travel mode has its own TTL.
+    Falls through to the maps API when the app has no cache backend.
+
+    Misses are coalesced: concurrent loads of the same snapped lookup share one maps API call, within a
+    process through single-flight and across processes through a Redis lock (over MAPS_COALESCE_REDIS_URL,
+    or CACHE_REDIS_URL with the Redis cache). Callers that find the lock taken poll the cache for the
+    holder's result for up to MAPS_COALESCE_WAIT seconds, then make the call themselves. Everything here
+    works outside the app context, so it can be used from the fan-out pool.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.backend = None
+        self.grid = 0.001
+        self.ttls = {}
+        self.default_ttl = 300
+        self.redis_url = None
+        self.lock_prefix = 'maps-lock:'
+        self.wait = 10
+        self.flights = SingleFlight()
+        self._lock = threading.Lock()
+        self._hits = defaultdict(int)
+        self._misses = defaultdict(int)
+        self._redis = None
+        self._pid = None
+
+    def init_app(self, app, backend):
+        cfg = app.config
+        self.app = app
+        # the werkzeug cache behind Flask-Cache, usable outside the app context
+        self.backend = app.extensions['cache'][backend] if backend is not None else None
+        self.grid = cfg.get('MAPS_CACHE_GRID', self.grid)
+        self.ttls = cfg.get('MAPS_CACHE_TTL', self.ttls)
+        self.default_ttl = cfg.get('MAPS_CACHE_DEFAULT_TTL', self.default_ttl)
+        self.redis_url = cfg.get('MAPS_COALESCE_REDIS_URL') or (
+            cfg.get('CACHE_REDIS_URL') if cfg.get('CACHE_TYPE') == 'redis' else None)
+        self.lock_prefix = '{0}maps-lock:'.format(cfg.get('CACHE_KEY_PREFIX', ''))
+        self.wait = cfg.get('MAPS_COALESCE_WAIT', self.wait)
+
+    def quantize(self, location):
+        """
+        Snaps a "lat,lng" string to the cache grid. Addresses are only normalised.
+        :param location:
+        :return: string
+        """
+        coordinates = parse_coordinates(location)
+
+        if coordinates is None:
+            return ' '.join(location.lower().split())
+
+        return ','.join('{0:.6f}'.format(round(value / self.grid) * self.grid) for value in coordinates)
+
+    def key(self, method, mode, locations):
+        return 'maps:{0}:{1}:{2}'.format(method, mode or 'driving', '|'.join(self.quantize(l) for l in locations))
+
+    def get_many(self, method, mode, locations_list):
+        """
+        :param method: maps API method, e.g. directions
+        :param mode: travel mode
+        :param locations_list: one list of locations per lookup
+        :return: list of cached results, None for misses
+        """
+        if self.backend is None or not locations_list:
+            return [None] * len(locations_list)
+
+        results = self.backend.get_many(*[self.key(method, mode, locations) for locations in locations_list])
+        hits = len([result for result in results if result is not None])
+
+        with self._lock:
+            self._hits[method] += hits
+            self._misses[method] += len(results) - hits
+
+        return results
+
+    def set(self, method, mode, locations, result):
+        if self.backend is None:
+            return
+
+        self.backend.set(self.key(method, mode, locations), result,
+                         timeout=self.ttls.get(mode or 'driving', self.default_ttl))
+
+    def fetch(self, method, mode, locations, loader):
+        """
+        Returns the cached result for this lookup, calling loader and caching what it returns on a miss.
+        :param method:
+        :param mode:
+        :param locations:
+        :param loader: function making the maps API call
+        :return:
+        """
+        result = self.get_many(method, mode, [locations])[0]
+
+        if result is None:
+            result = self.load(method, mode, locations, loader)
+
+        return result
+
+    def load(self, method, mode, locations, loader):
+        """
+        Calls loader and caches what it returns, sharing the call with concurrent loads of the same lookup.
+        :param method:
+        :param mode:
+        :param locations:
+        :param loader: function making the maps API call
+        :return:
+        """
+        key = self.key(method, mode, locations)
+
+        return self.flights.do(key, partial(self._load, key, loader, self.ttls.get(mode or 'driving', self.default_ttl)))
+
+    def _load(self, key, loader, timeout):
+        if self.backend is None:
+            return loader()
+
+        if self.redis_url is None:
+            result = loader()
+            self.backend.set(key, result, timeout=timeout)
+            return result
+
+        lock = self._get_redis().lock(self.lock_prefix + key, timeout=self.wait)
+
+        try:
+            acquired = lock.acquire(blocking=False)
+        except redis.RedisError as ex:
+            self.app.logger.error('Could not take the maps lock, calling anyway: {0}'.format(ex))
+            acquired = False
+        else:
+            if not acquired:
+                # another worker is making this call; its result will land in the cache
+                result = self._wait_for(key)
+
+                if result is not None:
+                    return result
+
+        try:
+            # it may have landed while we were taking the lock
+            result = self.backend.get(key)
+
+            if result is None:
+                result = loader()
+                self.backend.set(key, result, timeout=timeout)
+
+            return result
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except redis.RedisError:
+                    # expired while we were calling; the next caller will have taken over
+                    pass
+
+    def _wait_for(self, key):
+        deadline = time.time() + self.wait
+
+        while time.time() < deadline:
+            time.sleep(0.05)
+            result = self.backend.get(key)
+
+            if result is not None:
+                return result
+
+            try:
+                if not self._get_redis().exists(self.lock_prefix + key):
+                    # the holder failed
+                    return None
+            except redis.RedisError:
+                return None
+
+        return None
+
+    def _get_redis(self):
+        if self._redis is None or self._pid != os.getpid():
+            self._redis = redis.StrictRedis.from_url(self.redis_url)
+            self._pid = os.getpid()
+
+        return self._redis
+
+    def stats(self):
+        with self._lock:
+            return dict((method, {'hits': self._hits[method], 'misses': self._misses[method]})
+                        for method in set(self._hits.keys()) | set(self._misses.keys()))
+
+
+class EntityCache(object):
+    """
+    Cache-aside reads of single rows by primary key, in two tiers: a bounded in-process LRU whose entries
+    live ENTITY_CACHE_LOCAL_TTL seconds, in front of the app cache (Redis) where they live ENTITY_CACHE_TTL.
+    Rows are stored as their column values and handed back merged into the caller's session, so they can
+    be changed and committed like rows loaded by a query.
+
+    Watched models are invalidated from SQLAlchemy's after_insert/after_update/after_delete events once the
+    transaction commits: the entry is dropped from both tiers, and the keys are published on a Redis channel
+    so other workers drop their local copies too. Bulk UPDATEs skip those events and have to call
+    invalidate() themselves. Without ENTITY_CACHE_REDIS_URL (or a Redis app cache) nothing is broadcast, and
+    other workers can serve a stale row for up to ENTITY_CACHE_LOCAL_TTL seconds.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.backend = None
+        self.size = 1024
+        self.local_ttl = 5
+        self.ttl = 60
+        self.redis_url = None
+        self.channel = 'entity-invalidations'
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._models = {}
+        self._redis = None
+        self._redis_pid = None
+        self._pid = None
+
+    def init_app(self, app, backend):
+        cfg = app.config
+        self.app = app
+        self.backend = app.extensions['cache'][backend] if backend is not None else None
+        self.size = cfg.get('ENTITY_CACHE_SIZE', self.size)
+        self.local_ttl = cfg.get('ENTITY_CACHE_LOCAL_TTL', self.local_ttl)
+        self.ttl = cfg.get('ENTITY_CACHE_TTL', self.ttl)
+        self.redis_url = cfg.get('ENTITY_CACHE_REDIS_URL') or (
+            cfg.get('CACHE_REDIS_URL') if cfg.get('CACHE_TYPE') == 'redis' else None)
+        self.channel = cfg.get('ENTITY_CACHE_CHANNEL', self.channel)
+
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_rollback', self._after_rollback)
+
+    def watch(self, model, keys=None):
+        """
+        Invalidates cached rows whenever a row of model is inserted, updated or deleted.
+        :param model:
+        :param keys: function from a changed row to the (model name, id) keys it makes stale; defaults to
+        the row's own key
+        :return:
+        """
+        self._models[model.__name__] = model
+        keys = keys or (lambda target: [(model.__name__, inspect(model).primary_key_from_instance(target)[0])])
+
+        def listener(mapper, connection, target):
+            session = object_session(target)
+
+            if session is not None:
+                session.info.setdefault('entity_cache', set()).update(keys(target))
+
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(model, name, listener)
+
+    def get(self, model, ident, loader):
+        """
+        :param model: a watched model
+        :param ident: primary key
+        :param loader: function querying the row, called on a miss
+        :return: the row attached to the current session, or None
+        """
+        from app import db
+
+        # a row this session has already loaded is at least as fresh as the cache
+        current = db.session.identity_map.get(identity_key(model, ident))
+
+        if current is not None:
+            return current
+
+        if self.redis_url:
+            self._ensure_relay()
+
+        key = (model.__name__, int(ident))
+        values = self._get_local(key)
+
+        if values is None and self.backend is not None:
+            values = self.backend.get(self._key(key))
+
+            if values is not None:
+                self._set_local(key, values)
+
+        if values is None:
+            row = loader()
+
+            if row is None:
+                return None
+
+            values = dict((column.key, getattr(row, column.key)) for column in inspect(model).column_attrs)
+            self._set_local(key, values)
+
+            if self.backend is not None:
+                self.backend.set(self._key(key), values, timeout=self.ttl)
+
+            return row
+
+        row = inspect(model).class_manager.new_instance()
+
+        for name, value in values.items():
+            setattr(row, name, value)
+
+        make_transient_to_detached(row)
+
+        return db.session.merge(row, load=False)
+
+    def invalidate(self, keys, broadcast=True):
+        """
+        :param keys: (model name, id) pairs
+        :param broadcast: also tell other workers
+        :return:
+        """
+        keys = [(name, int(ident)) for name, ident in keys]
+
+        if not keys:
+            return
+
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+
+        if not broadcast:
+            return
+
+        if self.backend is not None:
+            self.backend.delete_many(*[self._key(key) for key in keys])
+
+        if self.redis_url:
+            try:
+                self._get_redis().publish(self.channel, json.dumps(keys))
+            except redis.RedisError as ex:
+                self.app.logger.error('Could not broadcast cache invalidations: {0}'.format(ex))
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+
+            if entry is None:
+                return None
+
+            if entry[1] < time.time():
+                del self._local[key]
+                return None
+
+            # most recently used last
+            del self._local[key]
+            self._local[key] = entry
+
+            return entry[0]
+
+    def _set_local(self, key, values):
+        with self._lock:
+            self._local.pop(key, None)
+            self._local[key] = (values, time.time() + self.local_ttl)
+
+            while len(self._local) > self.size:
+                self._local.popitem(last=False)
+
+    def _key(self, key):
+        return 'entity:{0}:{1}'.format(*key)
+
+    def _after_commit(self, session):
+        keys = session.info.pop('entity_cache', None)
+
+        if keys:
+            self.invalidate(keys)
+
+    def _after_rollback(self, session):
+        session.info.pop('entity_cache', None)
+
+    def _get_redis(self):
+        # broadcasts can come before the relay starts, so the client's process is tracked on its own
+        if self._redis is None or self._redis_pid != os.getpid():
+            self._redis = redis.StrictRedis.from_url(self.redis_url)
+            self._redis_pid = os.getpid()
+
+        return self._redis
+
+    def _ensure_relay(self):
+        # Threads don't survive a fork, so each worker process starts its own.
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._redis = None
+            thread = threading.Thread(target=self._relay, name='entity-cache-relay')
+            thread.daemon = True
+            thread.start()
+
+    def _relay(self):
+        while True:
+            try:
+                pubsub = self._get_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+
+                for message in pubsub.listen():
+                    self.invalidate([tuple(key) for key in json.loads(message['data'])], broadcast=False)
+            except redis.RedisError as ex:
+                self.app.logger.error('Lost the cache invalidation channel, reconnecting: {0}'.format(ex))
+                time.sleep(1)
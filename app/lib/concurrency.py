@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+
+class FanOut(object):
+    """
+    Runs independent blocking calls (e.g. maps API requests) on a shared, bounded thread pool and collects
+    whatever finishes before a deadline. The pool is created lazily so that each forked worker gets its own.
+    Calls run outside the app context, so they must not touch current_app, the cache or the db session.
+    Calls still queued when their deadline passes are dropped instead of run for nobody.
+    """
+
+    def __init__(self, size=8):
+        self.size = size
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ThreadPool(self.size)
+                self._pid = os.getpid()
+
+            return self._pool
+
+    def run(self, calls, timeout):
+        """
+        :param calls: dict of key -> function taking no arguments
+        :param timeout: seconds to wait for all the calls, in total
+        :return: (results, errors), both dicts keyed like calls
+        """
+        results = {}
+        errors = {}
+
+        if not calls:
+            return results, errors
+
+        pool = self._get_pool()
+        deadline = time.time() + timeout
+        pending = dict((key, pool.apply_async(_before, (deadline, call))) for key, call in calls.items())
+
+        for key, async_result in pending.items():
+            try:
+                results[key] = async_result.get(max(deadline - time.time(), 0))
+            except TimeoutError:
+                errors[key] = TimeoutError('Deadline of {0}s exceeded.'.format(timeout))
+            except Exception as ex:
+                errors[key] = ex
+
+        return results, errors
+
+
+def _before(deadline, call):
+    # the caller has given up on calls that only leave the queue after the deadline
+    if time.time() >= deadline:
+        raise TimeoutError('Deadline passed before the call started.')
+
+    return call()
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls with the same key into one: the first caller runs the function, and callers
+    arriving while it runs wait for it and get the same result (or exception).
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """
+        :param key: hashable key identifying the call
+        :param func: function taking no arguments
+        :return: what func returned, for this call or for the one already running under key
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+            else:
+                self.shared += 1
+
+        if not leader:
+            call['done'].wait()
+
+            if call['error'] is not None:
+                raise call['error']
+
+            return call['result']
+
+        try:
+            call['result'] = func()
+        except Exception as ex:
+            call['error'] = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+            call['done'].set()
+
+        return call['result']
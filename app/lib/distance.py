@@ -0,0 +1,89 @@
+import numpy as np
+
+from app.lib.geo import EARTH_RADIUS_KM
+
+
+def coordinate_arrays(rows):
+    """
+    Turns (id, latitude, longitude) rows, e.g. from db.session.query(Shuttle.id, Shuttle.latitude,
+    Shuttle.longitude), into arrays. Missing coordinates become NaN.
+    :param rows:
+    :return: (ids, latitudes, longitudes)
+    """
+    rows = list(rows)
+
+    ids = np.array([row[0] for row in rows])
+    coordinates = np.array([(row[1], row[2]) for row in rows], dtype=float).reshape(len(rows), 2)
+
+    return ids, coordinates[:, 0], coordinates[:, 1]
+
+
+def great_circle_distances(lat, lng, latitudes, longitudes):
+    """
+    Haversine distance in kilometres from one origin to every point, in a single vectorized pass.
+    :param lat: origin latitude
+    :param lng: origin longitude
+    :param latitudes: array of latitudes
+    :param longitudes: array of longitudes
+    :return: numpy array
+    """
+    lat, lng = np.radians(lat), np.radians(lng)
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+
+    a = np.sin((latitudes - lat) / 2) ** 2 + \
+        np.cos(lat) * np.cos(latitudes) * np.sin((longitudes - lng) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def bearings(lat, lng, latitudes, longitudes):
+    """
+    Initial compass bearing in degrees (0 is north, 90 is east) from one origin to every point.
+    :param lat: origin latitude
+    :param lng: origin longitude
+    :param latitudes: array of latitudes
+    :param longitudes: array of longitudes
+    :return: numpy array
+    """
+    lat, lng = np.radians(lat), np.radians(lng)
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+    delta = longitudes - lng
+
+    x = np.sin(delta) * np.cos(latitudes)
+    y = np.cos(lat) * np.sin(latitudes) - np.sin(lat) * np.cos(latitudes) * np.cos(delta)
+
+    return np.degrees(np.arctan2(x, y)) % 360
+
+
+def rank_by_distance(origin, ids, latitudes, longitudes, limit=None, radius_km=None):
+    """
+    Sorts points by distance from origin, dropping points without coordinates or outside radius_km.
+    :param origin: (latitude, longitude)
+    :param ids: array of ids matching the coordinate arrays
+    :param latitudes:
+    :param longitudes:
+    :param limit: maximum number of results
+    :param radius_km: maximum distance
+    :return: list of (id, distance_km, bearing)
+    """
+    if len(ids) == 0:
+        return []
+
+    distances = great_circle_distances(origin[0], origin[1], latitudes, longitudes)
+    keep = ~np.isnan(distances)
+
+    if radius_km is not None:
+        with np.errstate(invalid='ignore'):
+            keep &= distances <= radius_km
+
+    candidates = np.flatnonzero(keep)
+
+    if limit is not None and limit < len(candidates):
+        # Partial sort: only the closest `limit` points need ordering.
+        candidates = candidates[np.argpartition(distances[candidates], limit - 1)[:limit]]
+
+    candidates = candidates[np.argsort(distances[candidates], kind='mergesort')]
+    directions = bearings(origin[0], origin[1], latitudes[candidates], longitudes[candidates])
+    ids = np.asarray(ids).tolist()
+
+    return [(ids[i], float(distances[i]), float(direction)) for i, direction in zip(candidates, directions)]
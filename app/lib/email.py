@@ -12,8 +12,10 @@ def send_email(to=None, subject=None, body=None):
         domain=domain)
 
     return requests.post(
-        'https://api.mailgun.net/v3/{email_domain}/messages'.format(
+        '{api_url}/{email_domain}/messages'.format(
+            api_url=app.config.get('MAILGUN_API_URL', 'https://api.mailgun.net/v3'),
             email_domain=domain),
+        timeout=app.config.get('MAILGUN_TIMEOUT', 10),
         auth=("api", app.config['MAIL_GUN_KEY']),
         data={"from": from_address,
               "to": to,
@@ -0,0 +1,90 @@
+from flask import Response, json
+
+
+class FragmentCache(object):
+    """
+    Keeps the JSON of fully serialized entities in the app cache, keyed by collection, id and the entity's
+    version counter. Handlers that change an entity bump its counter after committing (update_entry,
+    switch_driver_mode, update_shuttle_location, the location buffer), which retires its fragments; old
+    ones simply expire after FRAGMENT_CACHE_TTL. Detail and list responses are stitched together from
+    fragments, so a warm request reads versions and fragments from the cache and builds no ORM objects.
+
+    Fragments hold every field; sparse fieldsets and responses with computed fields (distances, travel
+    times) are serialized as before. When there are no version counters, fragments are off.
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.versions = None
+        self.ttl = 600
+
+    def init_app(self, app, backend, versions):
+        self.backend = app.extensions['cache'][backend] if backend is not None else None
+        self.versions = versions
+        self.ttl = app.config.get('FRAGMENT_CACHE_TTL', self.ttl)
+
+    def render(self, collection, column, entity_id, query):
+        """
+        :param collection: version counter collection, e.g. 'shuttle'
+        :param column: primary key column
+        :param entity_id:
+        :param query: query for the model, with any eager loads serialize needs
+        :return: the entity's JSON, or None if it doesn't exist
+        """
+        fragments = self.render_many(collection, column, [entity_id], query)
+
+        return fragments[0] if fragments else None
+
+    def render_many(self, collection, column, entity_ids, query):
+        """
+        :param collection:
+        :param column: primary key column
+        :param entity_ids:
+        :param query: query for the model; rows missing from the cache are loaded with one IN query
+        :return: JSON of each entity that exists, in the order of entity_ids
+        """
+        entity_ids = [int(entity_id) for entity_id in entity_ids]
+        entity_versions = self.versions.get_many(collection, entity_ids) if self.backend is not None else None
+
+        if entity_versions is None:
+            rows = query.filter(column.in_(entity_ids)).all() if entity_ids else []
+            by_id = dict((getattr(row, column.key), json.dumps(row.serialize)) for row in rows)
+
+            return [by_id[entity_id] for entity_id in entity_ids if entity_id in by_id]
+
+        keys = dict((entity_id, 'fragment:{0}:{1}:{2}'.format(collection, entity_id, version))
+                    for entity_id, version in zip(entity_ids, entity_versions))
+        fragments = dict(zip(entity_ids, self.backend.get_many(*[keys[entity_id] for entity_id in entity_ids])))
+        missing = [entity_id for entity_id in entity_ids if fragments[entity_id] is None]
+
+        if missing:
+            loaded = dict((getattr(row, column.key), json.dumps(row.serialize))
+                          for row in query.filter(column.in_(missing)).all())
+            fragments.update(loaded)
+
+            if loaded:
+                self.backend.set_many(dict((keys[entity_id], fragment) for entity_id, fragment in loaded.items()),
+                                      timeout=self.ttl)
+
+        return [fragments[entity_id] for entity_id in entity_ids if fragments[entity_id] is not None]
+
+
+def fragment_response(fragment):
+    """
+    :param fragment: JSON string
+    :return: response
+    """
+    return Response(fragment, mimetype='application/json')
+
+
+def fragment_page_response(fragments, limit, next_cursor):
+    """
+    Like page_response, for entities already serialized to JSON.
+    :param fragments: JSON strings
+    :param limit: page size, or None when the client didn't ask for pages
+    :param next_cursor:
+    :return: response
+    """
+    page = ', "next": {0}'.format(json.dumps(next_cursor)) if limit is not None else ''
+
+    return fragment_response('{{"status": "success", "data": [{0}]{1}}}'.format(', '.join(fragments), page))
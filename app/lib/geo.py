@@ -0,0 +1,184 @@
+import math
+import threading
+import time
+from collections import defaultdict
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Great-circle distance between two points in kilometres.
+    :param lat1:
+    :param lng1:
+    :param lat2:
+    :param lng2:
+    :return: float
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, [lat1, lng1, lat2, lng2])
+
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def parse_coordinates(value):
+    """
+    Parses a "lat,lng" string (the format the maps API accepts) into a tuple of floats.
+    Returns None for anything else, e.g. a street address.
+    :param value:
+    :return: tuple|None
+    """
+    if value is None:
+        return None
+
+    parts = value.split(',')
+
+    if len(parts) != 2:
+        return None
+
+    try:
+        lat, lng = float(parts[0]), float(parts[1])
+    except ValueError:
+        return None
+
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+
+    return lat, lng
+
+
+class GridIndex(object):
+    """
+    In-memory geospatial index that buckets points into fixed-size lat/lng cells, so nearest and radius
+    queries only visit the cells around the origin instead of every point.
+    Safe to share between request threads.
+    """
+
+    def __init__(self, cell_size=0.01):
+        """
+        :param cell_size: Cell edge in degrees. 0.01 is roughly 1.1km.
+        """
+        self.cell_size = cell_size
+        self.built = None
+        self._lock = threading.RLock()
+        self._cells = defaultdict(dict)
+        self._points = {}
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, key):
+        return key in self._points
+
+    def _cell(self, lat, lng):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lng / self.cell_size))
+
+    def rebuild(self, points, cell_size=None):
+        """
+        Replaces the contents of the index.
+        :param points: iterable of (key, latitude, longitude)
+        :param cell_size:
+        :return:
+        """
+        with self._lock:
+            if cell_size is not None:
+                self.cell_size = cell_size
+            self._cells = defaultdict(dict)
+            self._points = {}
+
+            for key, lat, lng in points:
+                self.update(key, lat, lng)
+
+            self.built = time.time()
+
+    def is_stale(self, max_age):
+        return self.built is None or (time.time() - self.built) > max_age
+
+    def update(self, key, lat, lng):
+        if lat is None or lng is None:
+            self.remove(key)
+            return
+
+        cell = self._cell(lat, lng)
+
+        with self._lock:
+            self.remove(key)
+            self._points[key] = (lat, lng, cell)
+            self._cells[cell][key] = (lat, lng)
+
+    def remove(self, key):
+        with self._lock:
+            point = self._points.pop(key, None)
+
+            if point is None:
+                return
+
+            cell = point[2]
+            bucket = self._cells.get(cell)
+
+            if bucket is not None:
+                bucket.pop(key, None)
+                if not bucket:
+                    del self._cells[cell]
+
+    def nearest(self, lat, lng, limit=None, radius_km=None):
+        """
+        Finds the points closest to (lat, lng) by searching rings of cells outward from the origin cell.
+        :param lat:
+        :param lng:
+        :param limit: maximum number of points to return
+        :param radius_km: only return points within this distance
+        :return: list of (key, distance_km) sorted by distance
+        """
+        with self._lock:
+            if not self._cells:
+                return []
+
+            row, col = self._cell(lat, lng)
+            rows = [cell[0] for cell in self._cells]
+            cols = [cell[1] for cell in self._cells]
+            max_ring = max(abs(row - min(rows)), abs(row - max(rows)), abs(col - min(cols)), abs(col - max(cols)))
+
+            found = []
+            ring = 0
+
+            while ring <= max_ring:
+                for cell in _ring_cells(row, col, ring):
+                    for key, (p_lat, p_lng) in self._cells.get(cell, {}).items():
+                        distance = haversine(lat, lng, p_lat, p_lng)
+                        if radius_km is None or distance <= radius_km:
+                            found.append((key, distance))
+
+                # Every point outside ring r is at least r cell widths away. Longitude cells shrink towards the
+                # poles, so use the narrowest width the ring reaches.
+                edge_lat = min(abs(lat) + (ring + 1) * self.cell_size, 90)
+                covered_km = ring * self.cell_size * KM_PER_DEGREE * math.cos(math.radians(edge_lat))
+
+                if radius_km is not None and covered_km >= radius_km:
+                    break
+
+                if limit is not None and len([f for f in found if f[1] <= covered_km]) >= limit:
+                    break
+
+                ring += 1
+
+        found.sort(key=lambda f: f[1])
+
+        return found[:limit] if limit is not None else found
+
+
+def _ring_cells(row, col, ring):
+    if ring == 0:
+        yield row, col
+        return
+
+    for c in range(col - ring, col + ring + 1):
+        yield row - ring, c
+        yield row + ring, c
+
+    for r in range(row - ring + 1, row + ring):
+        yield r, col - ring
+        yield r, col + ring
@@ -0,0 +1,121 @@
+import atexit
+import os
+import threading
+import time
+from datetime import datetime
+
+
+class LocationBuffer(object):
+    """
+    Write-behind buffer for driver location pings, used when LOCATION_INGEST_MODE is 'buffered'.
+
+    Pings are acknowledged as soon as they are buffered. Only the latest ping per shuttle is kept, and a
+    background thread writes them all to the shuttle table in one bulk UPDATE every LOCATION_FLUSH_INTERVAL
+    seconds (and again when the process exits cleanly).
+
+    Lost-update window: if a worker process dies, the pings it accepted since its last flush are lost, so
+    the shuttle table can be up to LOCATION_FLUSH_INTERVAL seconds (plus the time of one flush) behind the
+    drivers. Drivers ping every few seconds, so a lost position is normally replaced by the next ping.
+    Each worker has its own buffer; the bulk UPDATE skips rows already holding a newer ping, so a slow
+    worker can't move a shuttle back in time.
+
+    Driver/shuttle ownership is checked against the database on the first ping and then trusted for
+    LOCATION_OWNERSHIP_TTL seconds, so pings from a driver who was just unassigned are accepted for at
+    most that long.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.interval = 2.0
+        self.ownership_ttl = 60
+        self._pending = {}
+        self._owners = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        cfg = app.config
+        self.app = app
+        self.enabled = cfg.get('LOCATION_INGEST_MODE', 'direct') == 'buffered'
+        self.interval = cfg.get('LOCATION_FLUSH_INTERVAL', self.interval)
+        self.ownership_ttl = cfg.get('LOCATION_OWNERSHIP_TTL', self.ownership_ttl)
+
+        if self.enabled:
+            atexit.register(self.flush)
+
+    def is_owner(self, shuttle_id, driver_id):
+        """
+        :return: True if driver_id was recently verified as the driver of shuttle_id
+        """
+        owner = self._owners.get(int(shuttle_id))
+
+        return owner is not None and owner[0] == int(driver_id) and time.time() - owner[1] < self.ownership_ttl
+
+    def set_owner(self, shuttle_id, driver_id):
+        self._owners[int(shuttle_id)] = (int(driver_id), time.time())
+
+    def add(self, shuttle_id, latitude, longitude):
+        with self._lock:
+            self._pending[int(shuttle_id)] = (latitude, longitude, datetime.now())
+
+        self._ensure_flusher()
+
+    def discard(self, shuttle_id):
+        """
+        Drops a buffered ping, e.g. because the shuttle's position is about to be written directly.
+        """
+        with self._lock:
+            self._pending.pop(int(shuttle_id), None)
+
+    def flush(self):
+        """
+        Writes every buffered ping in one bulk UPDATE. Pings are put back if the write fails.
+        :return: number of pings written
+        """
+        from app import versions
+        from app.models.shuttles import Shuttle
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return 0
+
+        positions = [{'shuttle_id': shuttle_id, 'lat': latitude, 'lng': longitude, 'received': received}
+                     for shuttle_id, (latitude, longitude, received) in pending.items()]
+
+        with self.app.app_context():
+            try:
+                Shuttle.update_locations(positions)
+            except Exception as ex:
+                self.app.logger.error('Could not flush {0} location pings: {1}'.format(len(positions), ex))
+
+                with self._lock:
+                    for shuttle_id, ping in pending.items():
+                        # keep anything newer that arrived while we were writing
+                        self._pending.setdefault(shuttle_id, ping)
+
+                return 0
+
+        versions.bump('shuttle', *pending.keys())
+
+        return len(positions)
+
+    def _ensure_flusher(self):
+        # Threads don't survive a fork, so each worker process starts its own flusher.
+        if self._thread is not None and self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='location-buffer-flusher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
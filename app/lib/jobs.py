@@ -0,0 +1,227 @@
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+
+class JobQueue(object):
+    """
+    Background jobs persisted in the job table, so they survive restarts and can be run by any process.
+
+    Handlers are registered by name with @jobs.handler('name') and called with the job's arguments inside an
+    app context. A worker takes a job by moving it to 'running' with a conditional UPDATE, so each job is run
+    by one worker at a time even with several processes polling. A job whose worker died is taken over once
+    its JOB_LEASE runs out.
+
+    A failing job is retried after JOB_BACKOFF * 2 ** (attempts - 1) seconds (at most JOB_BACKOFF_MAX),
+    and after JOB_MAX_ATTEMPTS attempts it is dead-lettered: left in the table with status 'dead' and the
+    last error, for someone to look at.
+
+    JOB_WORKERS threads per web process run jobs in the background; with 0 (the default), jobs only run
+    in dedicated workers started with `python manage.py jobs`.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.workers = 0
+        self.poll_interval = 1.0
+        self.lease = 300
+        self.max_attempts = 5
+        self.backoff = 2.0
+        self.backoff_max = 600
+        self.handlers = {}
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+
+    def init_app(self, app):
+        cfg = app.config
+        self.app = app
+        self.workers = cfg.get('JOB_WORKERS', self.workers)
+        self.poll_interval = cfg.get('JOB_POLL_INTERVAL', self.poll_interval)
+        self.lease = cfg.get('JOB_LEASE', self.lease)
+        self.max_attempts = cfg.get('JOB_MAX_ATTEMPTS', self.max_attempts)
+        self.backoff = cfg.get('JOB_BACKOFF', self.backoff)
+        self.backoff_max = cfg.get('JOB_BACKOFF_MAX', self.backoff_max)
+
+        # puts the job table in the metadata, for create_all and migrations
+        from app.models import jobs  # noqa
+
+    def handler(self, name):
+        """
+        Decorator registering a function as the handler for jobs called name.
+        :param name:
+        :return:
+        """
+        def decorator(f):
+            self.handlers[name] = f
+            return f
+        return decorator
+
+    def enqueue(self, name, arguments, key=None, delay=0):
+        """
+        Adds a job and commits it. Must be called inside an app context.
+        :param name: a registered handler
+        :param arguments: JSON-serializable dict of keyword arguments for the handler
+        :param key: if given, the job is skipped while another job with this key is waiting or running
+        :param delay: seconds to wait before running it
+        :return: the Job, or None if skipped
+        """
+        added = self.enqueue_many(name, [(arguments, key)], delay)
+
+        return added[0] if added else None
+
+    def enqueue_many(self, name, jobs, delay=0):
+        """
+        Adds several jobs of one kind with one query for their keys and one commit. Must be called inside
+        an app context.
+        :param name: a registered handler
+        :param jobs: list of (arguments, key); see enqueue
+        :param delay: seconds to wait before running them
+        :return: the Jobs added; jobs whose key is already waiting or running, or repeated, are skipped
+        """
+        from app import db
+        from app.models.jobs import Job, JobStatusEnum
+
+        if name not in self.handlers:
+            raise ValueError('No handler for {0} jobs.'.format(name))
+
+        keys = set(key for _, key in jobs if key is not None)
+        taken = set(key for key, in db.session.query(Job.key).filter(
+            Job.key.in_(keys), Job.status.in_([JobStatusEnum.pending, JobStatusEnum.running]))) if keys else set()
+
+        run_at = datetime.now() + timedelta(seconds=delay)
+        added = []
+
+        for arguments, key in jobs:
+            if key is not None:
+                if key in taken:
+                    continue
+
+                taken.add(key)
+
+            added.append(Job(name, arguments, key, run_at))
+
+        if not added:
+            return added
+
+        db.session.add_all(added)
+        db.session.commit()
+
+        if self.workers:
+            self._ensure_threads()
+            self._wakeup.set()
+
+        return added
+
+    def run_pending(self):
+        """
+        Runs due jobs on this thread until there are none left.
+        :return: number of jobs run
+        """
+        count = 0
+
+        while self._run_next():
+            count += 1
+
+        return count
+
+    def work(self, workers):
+        """
+        Runs jobs on `workers` threads until the process is stopped.
+        :param workers:
+        :return:
+        """
+        self.workers = workers
+        self._ensure_threads()
+
+        while True:
+            time.sleep(60)
+
+    def _run_next(self):
+        """
+        Takes one due job and runs it, in a fresh app context.
+        :return: True if a job was run
+        """
+        from app import db
+        from app.models.jobs import Job, JobStatusEnum
+
+        with self.app.app_context():
+            while True:
+                now = datetime.now()
+                job = db.session.query(Job).filter(Job.status.in_([JobStatusEnum.pending, JobStatusEnum.running]),
+                                                   Job.run_at <= now).order_by(Job.run_at).first()
+
+                if job is None:
+                    return False
+
+                # the status and attempts checks make this a no-op if another worker took it first
+                claimed = db.session.query(Job).filter_by(id=job.id, status=job.status, attempts=job.attempts).update(
+                    {'status': JobStatusEnum.running, 'attempts': job.attempts + 1,
+                     'run_at': now + timedelta(seconds=self.lease)}, synchronize_session=False)
+                db.session.commit()
+
+                if claimed:
+                    break
+
+            self._run(job)
+
+            return True
+
+    def _run(self, job):
+        from app import db
+        from app.models.jobs import JobStatusEnum
+
+        try:
+            if job.attempts > self.max_attempts:
+                raise RuntimeError('Lease expired on the last attempt.')
+
+            self.handlers[job.name](**job.arguments)
+        except Exception as ex:
+            db.session.rollback()
+            job.last_error = traceback.format_exc()
+
+            if job.attempts >= self.max_attempts:
+                job.status = JobStatusEnum.dead
+                self.app.logger.error('Job {0} ({1}) failed for good: {2}'.format(job.id, job.name, ex))
+            else:
+                delay = min(self.backoff * 2 ** (job.attempts - 1), self.backoff_max)
+                job.status = JobStatusEnum.pending
+                job.run_at = datetime.now() + timedelta(seconds=delay)
+                self.app.logger.info('Job {0} ({1}) failed, retrying in {2}s: {3}'.format(job.id, job.name, delay, ex))
+        else:
+            job.status = JobStatusEnum.done
+            job.last_error = None
+
+        db.session.commit()
+
+    def _loop(self):
+        while True:
+            try:
+                if self._run_next():
+                    continue
+            except Exception as ex:
+                self.app.logger.error('Job worker error: {0}'.format(ex))
+
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _ensure_threads(self):
+        # Threads don't survive a fork, so each worker process starts its own.
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._threads = []
+
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._loop, name='jobs-{0}'.format(number))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
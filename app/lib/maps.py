@@ -0,0 +1,258 @@
+import os
+import random
+import threading
+import time
+
+import requests
+from googlemaps import convert
+from googlemaps.exceptions import ApiError, HTTPError, Timeout, TransportError
+from requests.adapters import HTTPAdapter
+
+from app.lib.metrics import Metrics
+
+TRAVEL_MODES = ['driving', 'walking', 'bicycling', 'transit']
+
+_RETRIABLE_STATUSES = set([500, 503, 504])
+
+
+class RateLimiter(object):
+    """
+    Spaces calls out so that no more than `rate` start per second, across all threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling a service that has been failing.
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a failing service. After `threshold` consecutive failures the circuit opens and calls are
+    refused for `cooldown` seconds. Then one trial call is let through: if it succeeds the circuit closes,
+    if it fails it opens again. A threshold of 0 never opens it.
+    """
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+
+        return 'open' if time.time() < self.opened_at + self.cooldown else 'half-open'
+
+    @property
+    def is_open(self):
+        return self.state == 'open'
+
+    def allow(self):
+        """
+        :return: True if a call may be made now
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+
+            if time.time() < self.opened_at + self.cooldown or self._trial:
+                return False
+
+            self._trial = True
+
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+
+            if self._trial or (self.threshold and self.failures >= self.threshold):
+                self.opened_at = time.time()
+                self._trial = False
+
+    def snapshot(self):
+        return {'state': self.state, 'failures': self.failures}
+
+
+class MapsGateway(object):
+    """
+    App-scoped client for the Google Maps web services.
+    Every request (and the fan-out threads) shares one pooled keep-alive HTTP session. Calls are spaced out
+    to MAPS_QPS, retriable failures are retried up to MAPS_MAX_RETRIES times with exponential backoff, and
+    latency and errors are recorded per API method.
+    Calls that time out or fail at the HTTP level (after retries) trip a circuit breaker: after
+    MAPS_BREAKER_THRESHOLD of them in a row, calls raise CircuitOpen for MAPS_BREAKER_COOLDOWN seconds.
+    Configuration is copied in init_app, so the gateway can be used outside the app context.
+    """
+
+    def __init__(self):
+        self.base_url = 'https://maps.googleapis.com'
+        self.keys = {}
+        self.timeout = 5
+        self.max_retries = 2
+        self.backoff = 0.25
+        self.pool_size = 10
+        self.metrics = Metrics()
+        self.rate_limiter = RateLimiter(10)
+        self.breaker = CircuitBreaker()
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        cfg = app.config
+        self.base_url = cfg.get('MAPS_BASE_URL', self.base_url).rstrip('/')
+        self.keys = {
+            'GMAPS_KEY': cfg.get('GMAPS_KEY'),
+            'DIRECTIONS_KEY': cfg.get('DIRECTIONS_KEY')
+        }
+        self.timeout = cfg.get('MAPS_TIMEOUT', self.timeout)
+        self.max_retries = cfg.get('MAPS_MAX_RETRIES', self.max_retries)
+        self.backoff = cfg.get('MAPS_RETRY_BACKOFF', self.backoff)
+        self.pool_size = cfg.get('MAPS_POOL_SIZE', self.pool_size)
+        self.rate_limiter = RateLimiter(cfg.get('MAPS_QPS', 10))
+        self.breaker = CircuitBreaker(cfg.get('MAPS_BREAKER_THRESHOLD', 5), cfg.get('MAPS_BREAKER_COOLDOWN', 30))
+
+    @property
+    def session(self):
+        # Sockets can't be shared with a forked child, so each worker process builds its own session.
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                self._session = requests.Session()
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+                self._pid = os.getpid()
+
+            return self._session
+
+    def distance_matrix(self, origins, destinations, mode=None, key='GMAPS_KEY'):
+        """
+        :param origins: list of addresses or "lat,lng" strings
+        :param destinations: list of addresses or "lat,lng" strings
+        :param mode: travel mode
+        :param key: name of the config value holding the API key
+        :return: the distance matrix response
+        """
+        params = {
+            'origins': convert.location_list(origins),
+            'destinations': convert.location_list(destinations)
+        }
+
+        return self._get('distance_matrix', '/maps/api/distancematrix/json', params, mode, key)
+
+    def directions(self, origin, destination, mode=None, key='GMAPS_KEY'):
+        """
+        :param origin: address or "lat,lng" string
+        :param destination: address or "lat,lng" string
+        :param mode: travel mode
+        :param key: name of the config value holding the API key
+        :return: list of routes
+        """
+        params = {
+            'origin': convert.latlng(origin),
+            'destination': convert.latlng(destination)
+        }
+
+        return self._get('directions', '/maps/api/directions/json', params, mode, key)['routes']
+
+    def stats(self):
+        return self.metrics.snapshot()
+
+    def _get(self, method, path, params, mode, key):
+        if not self.keys.get(key):
+            raise ValueError('{0} is not configured.'.format(key))
+
+        if mode is not None:
+            if mode not in TRAVEL_MODES:
+                raise ValueError('Invalid travel mode: {0}.'.format(mode))
+            params['mode'] = mode
+
+        params['key'] = self.keys[key]
+
+        if not self.breaker.allow():
+            raise CircuitOpen('The maps API is failing; not calling it for now.')
+
+        try:
+            with self.metrics.timer(method):
+                body = self._call(path, params)
+        except ApiError as ex:
+            # the API is up; only rate limiting counts against it
+            if ex.status == 'OVER_QUERY_LIMIT':
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+        except Exception:
+            # timeouts, transport and HTTP errors, unreadable responses
+            self.breaker.failure()
+            raise
+
+        self.breaker.success()
+
+        return body
+
+    def _call(self, path, params):
+        error = None
+
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                # Exponential backoff with 50% jitter, so retries from different workers spread out.
+                time.sleep(self.backoff * 2 ** (attempt - 1) * (random.random() + 0.5))
+
+            self.rate_limiter.acquire()
+
+            try:
+                response = self.session.get(self.base_url + path, params=params, timeout=self.timeout)
+            except requests.exceptions.Timeout:
+                raise Timeout()
+            except requests.exceptions.RequestException as ex:
+                error = TransportError(ex)
+                continue
+
+            if response.status_code in _RETRIABLE_STATUSES:
+                error = HTTPError(response.status_code)
+                continue
+
+            if response.status_code != 200:
+                raise HTTPError(response.status_code)
+
+            body = response.json()
+            api_status = body['status']
+
+            if api_status in ('OK', 'ZERO_RESULTS'):
+                return body
+
+            error = ApiError(api_status, body.get('error_message'))
+
+            if api_status != 'OVER_QUERY_LIMIT':
+                raise error
+
+        raise error
@@ -0,0 +1,51 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Metrics(object):
+    """
+    Thread-safe call counters and latency totals, keyed by name (e.g. a maps API method).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+
+    def record(self, name, seconds, error=False):
+        with self._lock:
+            stats = self._stats[name]
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+
+            if error:
+                stats['errors'] += 1
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Records how long the block takes, and counts it as an error if it raises.
+        :param name:
+        :return:
+        """
+        start = time.time()
+
+        try:
+            yield
+        except Exception:
+            self.record(name, time.time() - start, error=True)
+            raise
+
+        self.record(name, time.time() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return dict((name, {
+                'count': stats['count'],
+                'errors': stats['errors'],
+                'avg_ms': round(stats['total'] * 1000 / stats['count'], 3) if stats['count'] else 0,
+                'max_ms': round(stats['max'] * 1000, 3),
+                'total_ms': round(stats['total'] * 1000, 3)
+            }) for name, stats in self._stats.items())
@@ -0,0 +1,91 @@
+import base64
+import json
+
+
+def encode_cursor(key):
+    """
+    :param key: primary key of the last row on a page
+    :return: opaque cursor string
+    """
+    return base64.urlsafe_b64encode(json.dumps([key])).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    :param cursor: string from encode_cursor
+    :return: primary key
+    """
+    try:
+        key, = json.loads(base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor.')
+
+    return key
+
+
+def page_args(args, max_limit=100):
+    """
+    Reads the `limit` and `after` query parameters.
+    :param args: request.args
+    :param max_limit: largest page size allowed
+    :return: (limit, after key); limit is None when the client didn't ask for pages
+    """
+    limit = args.get('limit')
+    after = args.get('after')
+
+    if limit is None and after is None:
+        return None, None
+
+    try:
+        limit = int(limit) if limit is not None else max_limit
+    except ValueError:
+        raise ValueError('limit must be a number.')
+
+    if not 1 <= limit <= max_limit:
+        raise ValueError('limit must be between 1 and {0}.'.format(max_limit))
+
+    return limit, decode_cursor(after) if after else None
+
+
+def paginate(query, key_column, limit, after=None):
+    """
+    Keyset pagination: rows are ordered by key_column (the primary key) and a page starts after the last key
+    of the previous one, so every page is an index range scan however deep it is.
+    :param query: filtered query
+    :param key_column: primary key column
+    :param limit: page size, or None for every row
+    :param after: key of the last row of the previous page
+    :return: (rows, cursor for the next page or None)
+    """
+    query = query.order_by(key_column)
+
+    if limit is None:
+        return query.all(), None
+
+    if after is not None:
+        query = query.filter(key_column > after)
+
+    # one extra row tells us whether there is another page
+    rows = query.limit(limit + 1).all()
+
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+
+    return rows, encode_cursor(getattr(rows[-1], key_column.key))
+
+
+def page_response(data, limit, next_cursor):
+    """
+    :param data: serialized rows
+    :param limit: page size, or None when the client didn't ask for pages
+    :param next_cursor: `after` value for the next page, None on the last page
+    :return: response dict
+    """
+    response = {'status': 'success', 'data': data}
+
+    if limit is not None:
+        response['next'] = next_cursor
+
+    return response
@@ -0,0 +1,119 @@
+import os
+import threading
+from multiprocessing import Pool, TimeoutError
+
+from flask import jsonify
+from passlib.context import CryptContext
+
+# the context each pool process builds for the policy it was handed
+_contexts = {}
+
+
+def _context(rounds):
+    if rounds not in _contexts:
+        # sha256_crypt is still accepted, as the old custom_app_context allowed it, but gets replaced on login
+        _contexts[rounds] = CryptContext(schemes=['sha512_crypt', 'sha256_crypt'],
+                                         default='sha512_crypt',
+                                         deprecated='auto',
+                                         sha512_crypt__default_rounds=rounds,
+                                         sha512_crypt__min_rounds=rounds)
+
+    return _contexts[rounds]
+
+
+def hash_password(rounds, password):
+    return _context(rounds).hash(password)
+
+
+def verify_password(rounds, password, hashed):
+    """
+    :return: (valid, new hash or None); a new hash is made when hashed doesn't meet the current policy
+    """
+    return _context(rounds).verify_and_update(password, hashed)
+
+
+class HasherBusy(Exception):
+    """
+    Raised when the hashing pool has too much queued work to take more.
+    """
+
+
+class PasswordHasher(object):
+    """
+    Hashes and verifies passwords on a bounded pool of processes, so a burst of logins spends the pool's
+    cores instead of the request workers'. At most PASSWORD_HASH_QUEUE calls may be queued or running per
+    worker process; past that, or when a call waits longer than PASSWORD_HASH_TIMEOUT seconds, HasherBusy is
+    raised and answered with a 503 so clients back off.
+
+    PASSWORD_HASH_ROUNDS sets the sha512_crypt cost. Hashes made under another policy (fewer rounds, or
+    sha256_crypt) still verify and are replaced on the user's next login. Set PASSWORD_HASH_WORKERS to 0
+    to hash on the request thread.
+    """
+
+    def __init__(self):
+        self.workers = None
+        self.max_queue = 64
+        self.timeout = 10
+        self.rounds = 535000
+        self._pool = None
+        self._pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        cfg = app.config
+        self.workers = cfg.get('PASSWORD_HASH_WORKERS', self.workers)
+        self.max_queue = cfg.get('PASSWORD_HASH_QUEUE', self.max_queue)
+        self.timeout = cfg.get('PASSWORD_HASH_TIMEOUT', self.timeout)
+        self.rounds = cfg.get('PASSWORD_HASH_ROUNDS', self.rounds)
+
+        app.register_error_handler(HasherBusy, self.busy_response)
+
+    def hash(self, password):
+        """
+        :param password:
+        :return: hash under the current policy
+        """
+        return self._run(hash_password, (self.rounds, password))
+
+    def verify(self, password, hashed):
+        """
+        :param password:
+        :param hashed: stored hash
+        :return: (valid, new hash or None), see verify_password
+        """
+        return self._run(verify_password, (self.rounds, password, hashed))
+
+    def busy_response(self, ex):
+        response = jsonify({'code': 503, 'status': 'error', 'message': 'We are busy right now, please try again shortly.'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+
+        return response
+
+    def _run(self, func, args):
+        if self.workers == 0:
+            return func(*args)
+
+        with self._lock:
+            if self._pending >= self.max_queue:
+                raise HasherBusy('{0} password hashes already queued.'.format(self._pending))
+
+            self._pending += 1
+
+        try:
+            return self._get_pool().apply_async(func, args).get(self.timeout)
+        except TimeoutError:
+            raise HasherBusy('Password hash took longer than {0}s.'.format(self.timeout))
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _get_pool(self):
+        # a pool's processes and threads don't survive a fork, so each worker process starts its own
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = Pool(self.workers)
+                self._pid = os.getpid()
+
+            return self._pool
@@ -0,0 +1,284 @@
+import heapq
+import json
+
+from app.lib.geo import GridIndex, haversine, parse_coordinates
+
+DEFAULT_SPEEDS = {
+    'driving': 8.3,
+    'walking': 1.4,
+    'bicycling': 4.2,
+    'transit': 5.5
+}
+
+
+class RoutingProvider(object):
+    """
+    Answers distance and directions queries. Results are shaped like the Google Maps responses so the
+    handlers don't need to know which provider is in use.
+    """
+
+    def distance_matrix(self, origins, destinations, mode=None):
+        """
+        :param origins: list of addresses or "lat,lng" strings
+        :param destinations: list of addresses or "lat,lng" strings
+        :param mode: travel mode
+        :return: distance matrix response
+        """
+        raise NotImplementedError
+
+    def directions(self, origin, destination, mode=None):
+        """
+        :param origin: address or "lat,lng" string
+        :param destination: address or "lat,lng" string
+        :param mode: travel mode
+        :return: list of routes
+        """
+        raise NotImplementedError
+
+    @property
+    def available(self):
+        """
+        :return: False while calls are known to fail, so callers can skip them
+        """
+        return True
+
+
+class GoogleRoutingProvider(RoutingProvider):
+    """
+    Routing through the Google Maps web services.
+    """
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    def distance_matrix(self, origins, destinations, mode=None):
+        return self.gateway.distance_matrix(origins, destinations, mode)
+
+    def directions(self, origin, destination, mode=None):
+        # Directions have their own key where one is configured.
+        key = 'DIRECTIONS_KEY' if self.gateway.keys.get('DIRECTIONS_KEY') else 'GMAPS_KEY'
+        return self.gateway.directions(origin, destination, mode, key=key)
+
+    @property
+    def available(self):
+        return not self.gateway.breaker.is_open
+
+
+class RoadGraph(object):
+    """
+    Road network loaded from a JSON file:
+
+        {"nodes": [[id, lat, lng], ...],
+         "edges": [[from_id, to_id], [from_id, to_id, length_m, {"oneway": true, "modes": ["walking"],
+                                                                  "speed": 5.5}], ...]}
+
+    Edge length defaults to the straight-line distance between its nodes. "modes" limits which travel
+    modes may use the edge and "speed" (m/s) caps the travel speed on it.
+    """
+
+    def __init__(self, nodes, edges, cell_size=0.002):
+        self.nodes = {}
+        self.adjacency = {}
+        self.index = GridIndex(cell_size)
+
+        for node_id, lat, lng in nodes:
+            self.nodes[node_id] = (lat, lng)
+            self.adjacency[node_id] = []
+
+        self.index.rebuild(((node_id, lat, lng) for node_id, lat, lng in nodes))
+
+        for edge in edges:
+            source, target = edge[0], edge[1]
+            length = edge[2] if len(edge) > 2 and edge[2] is not None else \
+                haversine(*(self.nodes[source] + self.nodes[target])) * 1000
+            options = edge[3] if len(edge) > 3 else {}
+            modes = frozenset(options['modes']) if options.get('modes') else None
+
+            self.adjacency[source].append((target, length, modes, options.get('speed')))
+            if not options.get('oneway'):
+                self.adjacency[target].append((source, length, modes, options.get('speed')))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as graph_file:
+            data = json.load(graph_file)
+
+        return cls(data['nodes'], data['edges'])
+
+    def snap(self, lat, lng):
+        """
+        :return: (node_id, distance in metres) of the closest node
+        """
+        nearest = self.index.nearest(lat, lng, limit=1)
+
+        if not nearest:
+            return None, None
+
+        node_id, distance = nearest[0]
+
+        return node_id, distance * 1000
+
+    def search(self, source, targets, mode, speed):
+        """
+        Fastest paths from source using A*, or Dijkstra when there are several targets.
+        :param source: node id
+        :param targets: node ids
+        :param mode: travel mode, for edge restrictions
+        :param speed: travel speed in m/s
+        :return: dict of target -> (seconds, metres)
+        """
+        targets = set(targets)
+        remaining = set(targets)
+        target = next(iter(targets)) if len(targets) == 1 else None
+
+        def heuristic(node_id):
+            if target is None:
+                return 0
+            # Nothing is faster than the mode's top speed in a straight line, so this never overestimates.
+            return haversine(*(self.nodes[node_id] + self.nodes[target])) * 1000 / speed
+
+        found = {}
+        best = {source: 0}
+        queue = [(heuristic(source), 0, 0, source)]
+
+        while queue and remaining:
+            _, seconds, metres, node_id = heapq.heappop(queue)
+
+            if seconds > best.get(node_id, float('inf')):
+                continue
+
+            if node_id in remaining:
+                found[node_id] = (seconds, metres)
+                remaining.discard(node_id)
+
+            for neighbour, length, modes, edge_speed in self.adjacency[node_id]:
+                if modes is not None and mode not in modes:
+                    continue
+
+                cost = seconds + length / min(speed, edge_speed or speed)
+
+                if cost < best.get(neighbour, float('inf')):
+                    best[neighbour] = cost
+                    heapq.heappush(queue, (cost + heuristic(neighbour), cost, metres + length, neighbour))
+
+        return found
+
+
+class GraphRoutingProvider(RoutingProvider):
+    """
+    Offline routing over a local RoadGraph. Only "lat,lng" locations can be routed; addresses come back as
+    NOT_FOUND since there is no geocoder.
+    """
+
+    def __init__(self, graph, speeds=None):
+        self.graph = graph
+        self.speeds = dict(DEFAULT_SPEEDS, **(speeds or {}))
+
+    def _leg(self, origin, destinations, mode):
+        mode = mode or 'driving'
+
+        if mode not in self.speeds:
+            raise ValueError('Invalid travel mode: {0}.'.format(mode))
+
+        speed = self.speeds[mode]
+        coordinates = parse_coordinates(origin)
+        source, source_offset = self.graph.snap(*coordinates) if coordinates else (None, None)
+
+        if source is None:
+            return [None] * len(destinations)
+
+        snapped = []
+
+        for destination in destinations:
+            destination_coordinates = parse_coordinates(destination)
+            snapped.append(self.graph.snap(*destination_coordinates) if destination_coordinates else (None, None))
+
+        found = self.graph.search(source, [node for node, _ in snapped if node is not None], mode, speed)
+        results = []
+
+        for node, offset in snapped:
+            if node not in found:
+                results.append(None)
+                continue
+
+            # Getting on and off the road network is costed as a straight line at the mode's speed.
+            seconds, metres = found[node]
+            metres += source_offset + offset
+            seconds += (source_offset + offset) / speed
+            results.append((seconds, metres))
+
+        return results
+
+    def distance_matrix(self, origins, destinations, mode=None):
+        rows = []
+
+        for origin in origins:
+            elements = []
+
+            for result in self._leg(origin, destinations, mode):
+                if result is None:
+                    elements.append({'status': 'NOT_FOUND'})
+                else:
+                    elements.append(dict(status='OK', **distance_and_duration(*result)))
+
+            rows.append({'elements': elements})
+
+        return {
+            'status': 'OK',
+            'origin_addresses': list(origins),
+            'destination_addresses': list(destinations),
+            'rows': rows
+        }
+
+    def directions(self, origin, destination, mode=None):
+        result = self._leg(origin, [destination], mode)[0]
+
+        if result is None:
+            return []
+
+        leg = distance_and_duration(*result)
+        start, end = parse_coordinates(origin), parse_coordinates(destination)
+        leg.update({
+            'start_location': {'lat': start[0], 'lng': start[1]},
+            'end_location': {'lat': end[0], 'lng': end[1]}
+        })
+        step = dict(leg, travel_mode=(mode or 'driving').upper())
+
+        return [{'summary': 'Local road graph', 'legs': [dict(leg, steps=[step])]}]
+
+
+def distance_and_duration(seconds, metres):
+    return {
+        'distance': {'value': int(round(metres)), 'text': '{0:.1f} km'.format(metres / 1000.0)},
+        'duration': {'value': int(round(seconds)), 'text': '{0} mins'.format(int(round(seconds / 60.0)) or 1)}
+    }
+
+
+class Routing(object):
+    """
+    The routing provider chosen by ROUTING_PROVIDER ('google' or 'graph').
+    """
+
+    def __init__(self):
+        self.provider = None
+
+    def init_app(self, app, gateway):
+        cfg = app.config
+        name = cfg.get('ROUTING_PROVIDER', 'google')
+
+        if name == 'google':
+            self.provider = GoogleRoutingProvider(gateway)
+        elif name == 'graph':
+            self.provider = GraphRoutingProvider(RoadGraph.load(cfg['ROUTING_GRAPH_PATH']), cfg.get('ROUTING_SPEEDS'))
+        else:
+            raise ValueError('Unknown routing provider: {0}.'.format(name))
+
+    def distance_matrix(self, origins, destinations, mode=None):
+        return self.provider.distance_matrix(origins, destinations, mode)
+
+    def directions(self, origin, destination, mode=None):
+        return self.provider.directions(origin, destination, mode)
+
+    @property
+    def available(self):
+        return self.provider.available
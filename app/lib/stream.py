@@ -0,0 +1,176 @@
+import binascii
+import json
+import os
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+import redis
+
+
+class EventBroker(object):
+    """
+    Fans shuttle position and mode changes out to live stream subscribers.
+
+    Events go into a fixed-size ring buffer under increasing sequence numbers. A subscriber holds only its
+    cursor (the last sequence it has seen) and waits on one shared condition, so thousands of idle
+    subscribers cost one parked thread or greenlet each and no per-subscriber queues. To hold that many
+    connections, run the app under an async worker (e.g. gunicorn -k gevent) rather than one thread per
+    request. A single heartbeat thread wakes every subscriber each STREAM_HEARTBEAT seconds so they can
+    send a keep-alive and find out if the client has gone.
+
+    Each worker process has its own buffer. When STREAM_REDIS_URL is set, events are published to a Redis
+    channel and every worker copies them into its buffer, so subscribers see changes made by any worker.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.size = 1024
+        self.heartbeat = 15
+        self.redis_url = None
+        self.channel = 'shuttle-events'
+        self._events = deque(maxlen=self.size)
+        self._sequence = 0
+        self._epoch = None
+        self._condition = threading.Condition()
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._redis = None
+        self._redis_pid = None
+        self._pid = None
+
+    def init_app(self, app):
+        cfg = app.config
+        self.app = app
+        self.size = cfg.get('STREAM_BUFFER_SIZE', self.size)
+        self.heartbeat = cfg.get('STREAM_HEARTBEAT', self.heartbeat)
+        self.redis_url = cfg.get('STREAM_REDIS_URL') or None
+        self.channel = cfg.get('STREAM_REDIS_CHANNEL', self.channel)
+        self._events = deque(maxlen=self.size)
+
+    @property
+    def cursor(self):
+        """
+        Opaque id of the latest event. Ids from another process (or from before a restart) never match.
+        """
+        self._ensure_threads()
+
+        return '{0}-{1}'.format(self._epoch, self._sequence)
+
+    def publish(self, event_type, data):
+        """
+        :param event_type: e.g. 'position' or 'mode'
+        :param data: JSON-serializable dict
+        :return:
+        """
+        event = {'type': event_type, 'data': data}
+
+        if self.redis_url:
+            try:
+                self._get_redis().publish(self.channel, json.dumps(event))
+                return
+            except redis.RedisError as ex:
+                self.app.logger.error('Could not publish shuttle event, delivering locally: {0}'.format(ex))
+
+        self._append(event)
+
+    def wait(self, cursor):
+        """
+        Blocks until there are events after cursor, or until the next heartbeat.
+        :param cursor: a value of self.cursor
+        :return: (cursor, events, missed); missed is True when events after cursor have already left the
+        buffer, and the subscriber should reload the fleet.
+        """
+        self._ensure_threads()
+        epoch, _, sequence = (cursor or '').partition('-')
+
+        with self._condition:
+            if epoch != self._epoch or not sequence.isdigit() or int(sequence) > self._sequence:
+                return self.cursor, [], True
+
+            sequence = int(sequence)
+
+            if sequence == self._sequence:
+                self._condition.wait()
+
+            # sequence numbers are contiguous, so the newest (self._sequence - sequence) entries are the new ones
+            first = self._sequence - len(self._events) + 1
+            count = min(self._sequence - sequence, len(self._events))
+            events = list(islice(reversed(self._events), count))[::-1]
+            missed = sequence + 1 < first
+
+            return self.cursor, events, missed
+
+    def _append(self, event):
+        with self._condition:
+            self._sequence += 1
+            self._events.append((self._sequence, event))
+            self._condition.notify_all()
+
+    def _get_redis(self):
+        # one client per process; publishers may never start the listener threads, so it is tracked separately
+        if self._redis is None or self._redis_pid != os.getpid():
+            self._redis = redis.StrictRedis.from_url(self.redis_url)
+            self._redis_pid = os.getpid()
+
+        return self._redis
+
+    def _ensure_threads(self):
+        # Threads don't survive a fork, so each worker process starts its own.
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._epoch = binascii.hexlify(os.urandom(4))
+            self._pid = os.getpid()
+            self._redis = None
+            self._start('shuttle-events-heartbeat', self._beat)
+
+            if self.redis_url:
+                self._start('shuttle-events-relay', self._relay)
+
+    def _start(self, name, target):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        self._threads[name] = thread
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat)
+
+            with self._condition:
+                self._condition.notify_all()
+
+    def _relay(self):
+        while True:
+            try:
+                pubsub = self._get_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+
+                for message in pubsub.listen():
+                    self._append(json.loads(message['data']))
+            except redis.RedisError as ex:
+                self.app.logger.error('Lost the shuttle events channel, reconnecting: {0}'.format(ex))
+                time.sleep(1)
+
+
+def event_in_bbox(event, bbox):
+    """
+    :param event:
+    :param bbox: (min_lat, min_lng, max_lat, max_lng) or None
+    :return: True if the event has no position or its position is inside bbox
+    """
+    if bbox is None:
+        return True
+
+    latitude, longitude = event['data'].get('latitude'), event['data'].get('longitude')
+
+    if latitude is None or longitude is None:
+        return True
+
+    return bbox[0] <= latitude <= bbox[2] and bbox[1] <= longitude <= bbox[3]
@@ -0,0 +1,51 @@
+from itertools import chain, islice
+
+from flask import Response, json, stream_with_context
+
+
+def stream_rows(query, serialize, chunk_size=500):
+    """
+    Streams {"status": "success", "data": [...]} for every row of query without building the list in memory.
+    Rows are fetched chunk_size at a time with yield_per, serialized, and written out a chunk at a time.
+    Objects loaded with yield_per are only held by the session's weak identity map, so they are freed once
+    written.
+    :param query: ordered query; eager loads must be many-to-one (joinedload) since yield_per can't batch
+    collections
+    :param serialize: function turning a row into a JSON-serializable value
+    :param chunk_size: rows per fetch and per write
+    :return: streaming Response, or None when the query has no rows
+    """
+    return stream_chunks(query.yield_per(chunk_size), lambda rows: [json.dumps(serialize(row)) for row in rows],
+                         chunk_size)
+
+
+def stream_chunks(items, render, chunk_size=500):
+    """
+    Streams {"status": "success", "data": [...]}, rendering items chunk_size at a time.
+    :param items: iterable, e.g. rows or ids
+    :param render: function turning a list of items into a list of JSON strings
+    :param chunk_size: items per write
+    :return: streaming Response, or None when there are no items
+    """
+    items = iter(items)
+    first = next(items, None)
+
+    if first is None:
+        return None
+
+    def generate():
+        yield '{"status": "success", "data": ['
+        remaining = chain([first], items)
+        separator = ''
+
+        for chunk in iter(lambda: list(islice(remaining, chunk_size)), []):
+            fragments = render(chunk)
+
+            if fragments:
+                yield separator + ', '.join(fragments)
+                separator = ', '
+
+        yield ']}'
+
+    # the rows are still being read from the database session, so keep the request context around
+    return Response(stream_with_context(generate()), mimetype='application/json')
@@ -0,0 +1,270 @@
+import atexit
+import os
+import threading
+import time
+from datetime import datetime
+
+# Positions are stored as integer micro-degrees (about 11cm) and timestamps as integer milliseconds.
+COORDINATE_SCALE = 1000000
+TIME_SCALE = 1000
+# Latest timestamp accepted (2100-01-01), well inside what datetime.fromtimestamp handles.
+MAX_TIMESTAMP = 4102444800
+
+
+def _write_varint(out, value):
+    # zigzag, so small negative deltas stay small
+    value = (value << 1) ^ (value >> 63)
+
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _read_varints(data):
+    value = 0
+    shift = 0
+
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+
+        if byte & 0x80:
+            shift += 7
+            continue
+
+        yield (value >> 1) ^ -(value & 1)
+        value = 0
+        shift = 0
+
+
+def encode_points(points):
+    """
+    Delta-encodes (timestamp, latitude, longitude) points as zigzag varints. A ping every couple of seconds
+    usually takes 5-6 bytes.
+    :param points: list of (timestamp in seconds, latitude, longitude)
+    :return: bytes
+    """
+    out = bytearray()
+    previous = (0, 0, 0)
+
+    for timestamp, latitude, longitude in points:
+        current = (int(round(timestamp * TIME_SCALE)),
+                   int(round(latitude * COORDINATE_SCALE)),
+                   int(round(longitude * COORDINATE_SCALE)))
+
+        for value, last in zip(current, previous):
+            _write_varint(out, value - last)
+
+        previous = current
+
+    return bytes(out)
+
+
+def decode_points(data):
+    """
+    :param data: bytes from encode_points
+    :return: list of (timestamp in seconds, latitude, longitude)
+    """
+    values = list(_read_varints(data))
+    points = []
+    timestamp = latitude = longitude = 0
+
+    for index in range(0, len(values), 3):
+        timestamp += values[index]
+        latitude += values[index + 1]
+        longitude += values[index + 2]
+        points.append((float(timestamp) / TIME_SCALE,
+                       float(latitude) / COORDINATE_SCALE,
+                       float(longitude) / COORDINATE_SCALE))
+
+    return points
+
+
+def downsample(points, max_points):
+    """
+    Splits the time range into max_points equal buckets and keeps the last point in each, so the result
+    is made of real positions.
+    :param points: list of (timestamp, latitude, longitude) sorted by timestamp
+    :param max_points:
+    :return: list of points
+    """
+    if max_points is None or len(points) <= max_points:
+        return points
+
+    start, end = points[0][0], points[-1][0]
+    width = (end - start) / float(max_points) or 1
+    buckets = {}
+
+    for point in points:
+        buckets[min(int((point[0] - start) / width), max_points - 1)] = point
+
+    return [buckets[bucket] for bucket in sorted(buckets)]
+
+
+class LocationHistory(object):
+    """
+    Location history for every shuttle, stored as delta-encoded chunks in the shuttle_location_chunk table.
+
+    Pings are gathered into an open chunk per shuttle in memory. A chunk is sealed, meaning encoded and
+    inserted as one row by a background thread, once it holds HISTORY_CHUNK_SIZE points or was opened
+    HISTORY_CHUNK_MAX_AGE seconds ago. Queries read the sealed chunks plus this worker's open chunk, so
+    points held by other workers show up within HISTORY_CHUNK_MAX_AGE seconds. Open chunks are sealed when
+    the process exits cleanly; a crash loses them. While the database can't be written, each shuttle keeps
+    at most HISTORY_MAX_UNSEALED points in memory, dropping the oldest.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.chunk_size = 256
+        self.max_age = 300
+        self.max_unsealed = 10000
+        self._open = {}
+        self._opened = {}
+        self._full = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        cfg = app.config
+        self.app = app
+        self.chunk_size = cfg.get('HISTORY_CHUNK_SIZE', self.chunk_size)
+        self.max_age = cfg.get('HISTORY_CHUNK_MAX_AGE', self.max_age)
+        self.max_unsealed = cfg.get('HISTORY_MAX_UNSEALED', self.max_unsealed)
+
+        atexit.register(self.seal_all)
+
+    def append(self, shuttle_id, latitude, longitude, timestamp=None):
+        """
+        :param shuttle_id:
+        :param latitude:
+        :param longitude:
+        :param timestamp: seconds since the epoch, defaults to now
+        :return:
+        """
+        if latitude is None or longitude is None:
+            return
+
+        point = (timestamp if timestamp is not None else time.time(), latitude, longitude)
+
+        with self._lock:
+            if int(shuttle_id) not in self._open:
+                self._open[int(shuttle_id)] = []
+                self._opened[int(shuttle_id)] = time.time()
+
+            chunk = self._open[int(shuttle_id)]
+            chunk.append(point)
+
+            if len(chunk) >= self.chunk_size:
+                self._full.append((int(shuttle_id), self._open.pop(int(shuttle_id))))
+                self._wake.set()
+
+        self._ensure_sweeper()
+
+    def query(self, shuttle_id, start=None, end=None, max_points=None):
+        """
+        :param shuttle_id:
+        :param start: seconds since the epoch
+        :param end: seconds since the epoch
+        :param max_points: downsample to at most this many points
+        :return: (points, stats)
+        """
+        from app.models.shuttles import ShuttleLocationChunk
+
+        for value in (start, end):
+            # also false for NaN
+            if value is not None and not 0 <= value <= MAX_TIMESTAMP:
+                raise ValueError('start and end must be epoch seconds.')
+
+        chunks = ShuttleLocationChunk.in_range(shuttle_id,
+                                               datetime.fromtimestamp(start) if start is not None else None,
+                                               datetime.fromtimestamp(end) if end is not None else None)
+        points = []
+
+        for chunk in chunks:
+            points.extend(decode_points(chunk.data))
+
+        with self._lock:
+            open_points = list(self._open.get(int(shuttle_id), []))
+            open_points.extend(point for full_id, full in self._full if full_id == int(shuttle_id) for point in full)
+
+        points.extend(open_points)
+        points = sorted(point for point in points
+                        if (start is None or point[0] >= start) and (end is None or point[0] <= end))
+
+        stored_points = sum(chunk.count for chunk in chunks)
+        stats = {
+            'chunks': len(chunks),
+            'stored_points': stored_points,
+            'unsealed_points': len(open_points),
+            'bytes_per_point': round(sum(len(chunk.data) for chunk in chunks) / float(stored_points), 2)
+            if stored_points else None
+        }
+
+        return downsample(points, max_points), stats
+
+    def seal_all(self, older_than=None):
+        """
+        Writes full chunks, and open chunks, to the database. Runs outside any request, in its own app context.
+        :param older_than: only seal open chunks opened at least this many seconds ago
+        :return:
+        """
+        now = time.time()
+
+        with self._lock:
+            ready = [shuttle_id for shuttle_id in self._open
+                     if older_than is None or now - self._opened[shuttle_id] >= older_than]
+            sealing = self._full + [(shuttle_id, self._open.pop(shuttle_id)) for shuttle_id in ready]
+            self._full = []
+
+        self._seal(sealing)
+
+    def _seal(self, chunks):
+        from app import db
+        from app.models.shuttles import ShuttleLocationChunk
+
+        if not chunks:
+            return
+
+        with self.app.app_context():
+            try:
+                for shuttle_id, points in chunks:
+                    db.session.add(ShuttleLocationChunk(shuttle_id, sorted(points)))
+                db.session.commit()
+            except Exception as ex:
+                self.app.logger.error('Could not store location history: {0}'.format(ex))
+
+                dropped = 0
+
+                with self._lock:
+                    for shuttle_id, points in chunks:
+                        points = sorted(points + self._open.get(shuttle_id, []))
+                        dropped += max(len(points) - self.max_unsealed, 0)
+                        self._open[shuttle_id] = points[-self.max_unsealed:]
+                        self._opened.setdefault(shuttle_id, time.time())
+
+                if dropped:
+                    self.app.logger.error('Dropped the {0} oldest unsealed location history points.'.format(dropped))
+
+    def _ensure_sweeper(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='location-history-sweeper')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(max(self.max_age / 10.0, 1))
+            self._wake.clear()
+            self.seal_all(older_than=self.max_age)
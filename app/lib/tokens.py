@@ -0,0 +1,152 @@
+import threading
+import time
+
+from itsdangerous import BadSignature, SignatureExpired, TimedJSONWebSignatureSerializer
+
+REVOKED_STATUSES = ('disabled', 'blocked')
+
+
+class Principal(object):
+    """
+    The user an auth token was issued to, built from the token's claims without touching the database.
+    """
+
+    def __init__(self, tokens, user_id, account_type, status):
+        self.tokens = tokens
+        self.user_id = user_id
+        self.account_type = account_type
+        self.status = status
+
+    @property
+    def user(self):
+        """
+        The full User row, from the entity cache.
+        """
+        return self.tokens.get_user(self.user_id)
+
+    def generate_auth_token(self, expiration=None):
+        """
+        :param expiration:
+        :return: a fresh token, or None if the user has been deleted
+        """
+        user = self.user
+
+        return self.tokens.issue(user, expiration) if user is not None else None
+
+
+class AuthTokens(object):
+    """
+    Issues and verifies auth tokens. A token carries the user's id, account type and status, so verifying
+    it needs no database query; a single serializer is reused for every token of the default lifetime.
+
+    Revocation: disabling or blocking an account records the time in a deny list in the app cache, and
+    tokens issued before then are refused. Each worker remembers deny list lookups for
+    AUTH_DENY_LIST_REFRESH seconds, so a revoked token can work on another worker for at most that long.
+    Entries expire with the tokens they could affect.
+
+    Endpoints that need the whole User row get it through User.get_user, i.e. the entity cache.
+    """
+
+    def __init__(self):
+        self.secret_key = None
+        self.expiration = 600
+        self.deny_refresh = 5
+        self.backend = None
+        self._serializer = None
+        self._denied = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app, backend):
+        cfg = app.config
+        self.secret_key = cfg['SECRET_KEY']
+        self.expiration = cfg.get('AUTH_TOKEN_TTL', self.expiration)
+        self.deny_refresh = cfg.get('AUTH_DENY_LIST_REFRESH', self.deny_refresh)
+        self.backend = app.extensions['cache'][backend] if backend is not None else None
+        self._serializer = TimedJSONWebSignatureSerializer(self.secret_key, expires_in=self.expiration)
+
+    def issue(self, user, expiration=None):
+        """
+        :param user: User
+        :param expiration: seconds, defaults to AUTH_TOKEN_TTL
+        :return: token
+        """
+        serializer = self._serializer
+
+        if expiration is not None and expiration != self.expiration:
+            serializer = TimedJSONWebSignatureSerializer(self.secret_key, expires_in=expiration)
+
+        return serializer.dumps({
+            'userId': user.user_id,
+            'accountType': user.account_type.value if user.account_type is not None else None,
+            'status': user.status.value if user.status is not None else None
+        })
+
+    def verify(self, token):
+        """
+        :param token:
+        :return: Principal, or None if the token is invalid, expired or revoked
+        """
+        try:
+            data, header = self._serializer.loads(token, return_header=True)
+        except (SignatureExpired, BadSignature):
+            return None
+
+        user_id = data['userId']
+
+        if self.is_revoked(user_id, header.get('iat', 0)):
+            return None
+
+        # tokens from before the claims were added
+        if 'accountType' not in data:
+            user = self.get_user(user_id)
+
+            if user is None:
+                return None
+
+            data = {'accountType': user.account_type.value if user.account_type is not None else None,
+                    'status': user.status.value if user.status is not None else None}
+
+        if data['status'] in REVOKED_STATUSES:
+            return None
+
+        return Principal(self, user_id, data['accountType'], data['status'])
+
+    def revoke(self, user_id):
+        """
+        Refuses every token issued to user_id until now.
+        :param user_id:
+        :return:
+        """
+        revoked_at = int(time.time()) + 1
+
+        if self.backend is not None:
+            self.backend.set('auth:deny:{0}'.format(user_id), revoked_at, timeout=self.expiration + 1)
+
+        with self._lock:
+            self._denied[int(user_id)] = (revoked_at, time.time())
+
+    def is_revoked(self, user_id, issued_at):
+        """
+        :param user_id:
+        :param issued_at: the token's iat
+        :return: True if the token was issued before the user's tokens were revoked
+        """
+        cached = self._denied.get(int(user_id))
+
+        # without a cache backend the deny list is this worker's own
+        if self.backend is not None and (cached is None or time.time() - cached[1] >= self.deny_refresh):
+            cached = (self.backend.get('auth:deny:{0}'.format(user_id)), time.time())
+
+            with self._lock:
+                self._denied[int(user_id)] = cached
+
+        return cached is not None and cached[0] is not None and issued_at < cached[0]
+
+    def get_user(self, user_id):
+        """
+        :param user_id:
+        :return: the User, attached to the current session, or None
+        """
+        from app.models.users import User
+
+        return User.get_user(user_id)
@@ -0,0 +1,118 @@
+import hashlib
+import time
+from functools import wraps
+
+from flask import make_response, request
+
+
+class VersionCounters(object):
+    """
+    Version counters for collections and their entities, kept in the app cache so every worker sees the
+    same values (with an in-process cache such as 'simple', only run one worker). The handlers that change
+    a row bump both the row's counter and its collection's counter.
+
+    A missing counter (never set, or evicted) is seeded from the clock, so it never returns to a value an
+    old ETag was made from. When there is no cache backend, counters are off and nothing gets an ETag.
+    """
+
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app, backend):
+        # the werkzeug cache behind Flask-Cache, usable outside the app context
+        self.backend = app.extensions['cache'][backend] if backend is not None else None
+
+    def get(self, collection, entity_id=None):
+        """
+        :param collection: e.g. 'shuttle'
+        :param entity_id: row id, or None for the whole collection
+        :return: the current version, or None if counters are off
+        """
+        if self.backend is None:
+            return None
+
+        key = self._key(collection, entity_id)
+        version = self.backend.get(key)
+
+        if version is None:
+            self.backend.set(key, int(time.time() * 1000), timeout=0)
+            version = self.backend.get(key)
+
+        return version
+
+    def get_many(self, collection, entity_ids):
+        """
+        :param collection:
+        :param entity_ids: row ids
+        :return: their current versions in the same order, or None if counters are off
+        """
+        if self.backend is None:
+            return None
+
+        keys = [self._key(collection, entity_id) for entity_id in entity_ids]
+        values = self.backend.get_many(*keys) if keys else []
+
+        for index, (key, version) in enumerate(zip(keys, values)):
+            if version is None:
+                self.backend.set(key, int(time.time() * 1000), timeout=0)
+                values[index] = self.backend.get(key)
+
+        return values
+
+    def bump(self, collection, *entity_ids):
+        """
+        Bumps the collection's counter and, if given, the counters of the changed rows.
+        :param collection:
+        :param entity_ids:
+        :return:
+        """
+        if self.backend is None:
+            return
+
+        for key in [self._key(collection)] + [self._key(collection, entity_id) for entity_id in entity_ids]:
+            if self.backend.get(key) is None:
+                self.backend.set(key, int(time.time() * 1000), timeout=0)
+
+            self.backend.inc(key)
+
+    def conditional(self, collection, id_arg=None, skip_args=()):
+        """
+        Decorator adding strong ETags and If-None-Match handling to a GET handler. The ETag is made from the
+        version counter and the request's query string, so a matching request is answered with a 304
+        before the handler queries or serializes anything.
+        :param collection:
+        :param id_arg: name of the view argument holding the entity id, for single-entity handlers
+        :param skip_args: query parameters that bring in data the counters don't track (e.g. maps results);
+        requests using them are passed through untouched
+        :return:
+        """
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if any(arg in request.args for arg in skip_args):
+                    return f(*args, **kwargs)
+
+                # read before the handler runs, so a change made meanwhile can only make the ETag older
+                version = self.get(collection, kwargs.get(id_arg) if id_arg else None)
+
+                if version is None:
+                    return f(*args, **kwargs)
+
+                etag = hashlib.sha1('{0}:{1}:{2}'.format(version, request.path, request.query_string)).hexdigest()
+
+                if etag in request.if_none_match:
+                    response = make_response('', 304)
+                else:
+                    response = make_response(f(*args, **kwargs))
+
+                response.set_etag(etag)
+
+                return response
+            return wrapper
+        return decorator
+
+    def _key(self, collection, entity_id=None):
+        if entity_id is None:
+            return 'version:{0}'.format(collection)
+
+        return 'version:{0}:{1}'.format(collection, entity_id)
@@ -0,0 +1,59 @@
+import enum
+import json
+from datetime import datetime
+
+from app import db
+
+
+class JobStatusEnum(enum.Enum):
+    pending = 'pending'
+    running = 'running'
+    done = 'done'
+    dead = 'dead'
+
+
+class Job(db.Model):
+    """
+    A unit of background work. Pending jobs are due at run_at; for a running job, run_at is when its lease
+    runs out and another worker may take it over.
+    """
+    __tablename__ = 'job'
+    __table_args__ = (db.Index('ix_job_status_run_at', 'status', 'run_at'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    key = db.Column(db.String(255), index=True)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.Enum(JobStatusEnum), nullable=False, default=JobStatusEnum.pending)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False)
+    last_error = db.Column(db.Text)
+    created = db.Column(db.DateTime)
+    updated = db.Column(db.DateTime, onupdate=datetime.now)
+
+    @property
+    def arguments(self):
+        return json.loads(self.payload)
+
+    @property
+    def serialize(self):
+        return {
+            '_id': self.id,
+            'name': self.name,
+            'key': self.key,
+            'status': self.status.value,
+            'attempts': self.attempts,
+            'runAt': self.run_at,
+            'lastError': self.last_error,
+            'created': self.created,
+            'updated': self.updated
+        }
+
+    def __init__(self, name, arguments, key=None, run_at=None):
+        self.name = name
+        self.key = key
+        self.payload = json.dumps(arguments)
+        self.status = JobStatusEnum.pending
+        self.attempts = 0
+        self.created = datetime.now()
+        self.run_at = run_at or self.created
@@ -1,7 +1,11 @@
 import enum
 from datetime import datetime
 
-from app import db
+from sqlalchemy import bindparam, inspect, or_
+from sqlalchemy.orm import joinedload, load_only
+
+from app import db, entity_cache
+from app.lib.timeseries import encode_points
 from .users import User
 
 
@@ -22,7 +26,86 @@ class LocationTypeEnum(enum.Enum):
     building = 'building'
 
 
-class Shuttle(db.Model):
+class ChangeActionEnum(enum.Enum):
+    created = 'created'
+    updated = 'updated'
+    disabled = 'disabled'
+
+
+class SparseFields(object):
+    """
+    Lets a model serialize only some of its fields, and load only the columns those fields need.
+    Models map each serialized field name to an attribute in `serialized_fields`.
+    """
+    serialized_fields = {}
+
+    @classmethod
+    def parse_fields(cls, value):
+        """
+        :param value: comma-separated field names, e.g. from ?fields=
+        :return: list of field names, or None for every field
+        """
+        if value is None:
+            return None
+
+        names = [name.strip() for name in value.split(',') if name.strip()]
+        unknown = [name for name in names if name not in cls.serialized_fields]
+
+        if unknown or not names:
+            raise ValueError('Unknown fields: {0}. Available fields: {1}.'.format(
+                ', '.join(unknown), ', '.join(sorted(cls.serialized_fields))))
+
+        return names
+
+    @classmethod
+    def load_fields(cls, fields=None, extra=()):
+        """
+        :param fields: field names, or None for every field
+        :param extra: attribute names to load as well, e.g. for filtering or ranking
+        :return: query options that select only the needed columns and join only the requested relationships
+        """
+        mapper = inspect(cls)
+        attributes = [cls.serialized_fields[name] for name in fields or cls.serialized_fields]
+        related = [attribute for attribute in attributes if attribute in mapper.relationships]
+        options = [joinedload(getattr(cls, attribute)) for attribute in related]
+
+        if fields is None:
+            return options
+
+        columns = set(attribute for attribute in attributes if attribute not in related)
+        columns.update(extra)
+
+        # relationships are loaded through their foreign keys
+        for attribute in related:
+            columns.update(mapper.get_property_by_column(column).key
+                           for column in mapper.relationships[attribute].local_columns)
+
+        return [load_only(*columns)] + options
+
+    @property
+    def serialize(self):
+        return self.serialize_fields()
+
+    def serialize_fields(self, fields=None):
+        """
+        :param fields: field names, or None for every field
+        :return: dict
+        """
+        return dict((name, serialize_value(getattr(self, self.serialized_fields[name])))
+                    for name in fields or self.serialized_fields)
+
+
+def serialize_value(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+
+    if isinstance(value, db.Model):
+        return value.serialize
+
+    return value
+
+
+class Shuttle(SparseFields, db.Model):
     """
     Shuttle Model
     """
@@ -40,27 +123,69 @@ class Shuttle(db.Model):
     status = db.Column(db.Enum(StatusEnum), default=StatusEnum.enabled)
     created = db.Column(db.DateTime())
     updated = db.Column(db.DateTime(), onupdate=datetime.now)
+    # when the position was taken, as reported by the device; edits to the shuttle don't touch it
+    location_updated = db.Column(db.DateTime())
+
+    user = db.relationship(User)
 
     @classmethod
     def get_shuttle_by_id(cls, shuttle_id):
-        return db.session.query(cls).filter_by(id=shuttle_id, status=StatusEnum.enabled).first()
+        try:
+            shuttle_id = int(shuttle_id)
+        except (TypeError, ValueError):
+            return None
 
-    @property
-    def serialize(self):
-        return {
-            'shuttle_id': self.id,
-            'brand': self.brand,
-            'size': self.size.value,
-            'ac': self.ac,
-            'en_route': self.en_route,
-            'user': join_table(self, Shuttle, User, 'user_id'),
-            'longitude': self.longitude,
-            'latitude': self.latitude,
-            'no_of_seats': self.no_of_seats,
-            'status': self.status.value,
-            'created': self.created,
-            'updated': self.updated
-        }
+        shuttle = entity_cache.get(cls, shuttle_id, lambda: db.session.query(cls).filter_by(id=shuttle_id).first())
+
+        return shuttle if shuttle is not None and shuttle.status is StatusEnum.enabled else None
+
+    @classmethod
+    def update_locations(cls, positions):
+        """
+        Writes many shuttle positions in one bulk UPDATE. Shuttles whose position was taken after a position
+        was received are left alone, so an older position never overwrites a newer one.
+        :param positions: list of dicts with shuttle_id, lat, lng and received (a datetime)
+        :return: ids of the shuttles whose position was written; the others were stale
+        """
+        table = cls.__table__
+        statement = table.update().where(table.c.id == bindparam('shuttle_id')).where(
+            or_(table.c.location_updated.is_(None), table.c.location_updated <= bindparam('received'))
+        ).values(
+            latitude=bindparam('lat'),
+            longitude=bindparam('lng'),
+            location_updated=bindparam('received')
+        )
+
+        # an executemany has no per-row count, so the stale rows are found first, under a lock held until commit
+        updated = dict(db.session.query(cls.id, cls.location_updated).with_for_update()
+                       .filter(cls.id.in_([position['shuttle_id'] for position in positions])))
+        written = [position['shuttle_id'] for position in positions
+                   if position['shuttle_id'] in updated and (updated[position['shuttle_id']] is None or
+                                                             updated[position['shuttle_id']] <= position['received'])]
+
+        db.session.execute(statement, positions)
+        db.session.commit()
+
+        # a bulk UPDATE doesn't fire the ORM events the entity cache listens to
+        entity_cache.invalidate([(cls.__name__, shuttle_id) for shuttle_id in written])
+
+        return written
+
+    serialized_fields = {
+        'shuttle_id': 'id',
+        'brand': 'brand',
+        'size': 'size',
+        'ac': 'ac',
+        'en_route': 'en_route',
+        'user': 'user',
+        'longitude': 'longitude',
+        'latitude': 'latitude',
+        'no_of_seats': 'no_of_seats',
+        'status': 'status',
+        'created': 'created',
+        'updated': 'updated',
+        'location_updated': 'location_updated'
+    }
 
     def __init__(self, user_id, size, brand, ac, no_of_seats):
         self.user_id = user_id
@@ -71,7 +196,105 @@ class Shuttle(db.Model):
         self.created = datetime.now()
 
 
-class Location(db.Model):
+class ShuttleLocationChunk(db.Model):
+    """
+    A run of a shuttle's past positions, delta-encoded into one blob. See app.lib.timeseries.
+    """
+    __tablename__ = 'shuttle_location_chunk'
+    __table_args__ = (db.Index('ix_shuttle_location_chunk_shuttle_start', 'shuttle_id', 'start'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    shuttle_id = db.Column(db.Integer, db.ForeignKey('shuttle.id'), nullable=False)
+    start = db.Column(db.DateTime, nullable=False)
+    end = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    @classmethod
+    def in_range(cls, shuttle_id, start=None, end=None):
+        query = db.session.query(cls).filter_by(shuttle_id=shuttle_id)
+
+        if start is not None:
+            query = query.filter(cls.end >= start)
+
+        if end is not None:
+            query = query.filter(cls.start <= end)
+
+        return query.order_by(cls.start).all()
+
+    def __init__(self, shuttle_id, points):
+        """
+        :param shuttle_id:
+        :param points: list of (timestamp, latitude, longitude) sorted by timestamp
+        """
+        self.shuttle_id = shuttle_id
+        self.start = datetime.fromtimestamp(points[0][0])
+        self.end = datetime.fromtimestamp(points[-1][0])
+        self.count = len(points)
+        self.data = encode_points(points)
+
+
+class ChangeLog(db.Model):
+    """
+    One row for every time a shuttle or location is created, updated or disabled, written in the same
+    transaction as the change. The id is the version delta-sync clients pass back as ?since=.
+
+    Ids are assigned at flush, so a transaction can commit after one holding a later id. Changes are only
+    handed out once they are older than a settle window, and never past a newer one, so a client's version
+    can't move past a change that was still being committed.
+    """
+    __tablename__ = 'change_log'
+    __table_args__ = (db.Index('ix_change_log_collection_id', 'collection', 'id'),
+                      db.Index('ix_change_log_collection_created', 'collection', 'created'))
+
+    id = db.Column(db.Integer, primary_key=True)
+    collection = db.Column(db.String(32), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.Enum(ChangeActionEnum), nullable=False)
+    created = db.Column(db.DateTime)
+
+    @classmethod
+    def since(cls, collection, version, limit, settled):
+        """
+        :param collection: 'shuttle' or 'location'
+        :param version: changes after this id
+        :param limit:
+        :param settled: only changes created at or before this datetime
+        :return: changes, oldest first, stopping short of the first unsettled one
+        """
+        changes = db.session.query(cls).filter(cls.collection == collection, cls.id > version)\
+            .order_by(cls.id).limit(limit).all()
+
+        for index, change in enumerate(changes):
+            if change.created > settled:
+                return changes[:index]
+
+        return changes
+
+    @classmethod
+    def latest(cls, collection, settled):
+        """
+        :param collection:
+        :param settled: only changes created at or before this datetime
+        :return: id just before the collection's oldest unsettled change, or of its latest change; 0 if
+        there are none
+        """
+        unsettled = db.session.query(db.func.min(cls.id))\
+            .filter(cls.collection == collection, cls.created > settled).scalar()
+
+        if unsettled is not None:
+            return unsettled - 1
+
+        return db.session.query(db.func.max(cls.id)).filter(cls.collection == collection).scalar() or 0
+
+    def __init__(self, collection, entity_id, action):
+        self.collection = collection
+        self.entity_id = entity_id
+        self.action = action
+        self.created = datetime.now()
+
+
+class Location(SparseFields, db.Model):
 
     __tablename__ = 'location'
 
@@ -85,19 +308,28 @@ class Location(db.Model):
     created = db.Column(db.DateTime)
     updated = db.Column(db.DateTime, onupdate=datetime.now)
 
-    @property
-    def serialize(self):
-        return {
-            '_id': self.id,
-            'name': self.name,
-            'description': self.description,
-            'latitude': self.latitude,
-            'longitude': self.longitude,
-            'directions': join_table(self, Location, Directions, 'id', 'location_id'),
-            'type': self.type.value,
-            'created': self.created,
-            'updated': self.updated
-        }
+    directions = db.relationship('Directions', uselist=False)
+
+    @classmethod
+    def get_location_by_id(cls, location_id):
+        try:
+            location_id = int(location_id)
+        except (TypeError, ValueError):
+            return None
+
+        return entity_cache.get(cls, location_id, lambda: db.session.query(cls).filter_by(id=location_id).first())
+
+    serialized_fields = {
+        '_id': 'id',
+        'name': 'name',
+        'description': 'description',
+        'latitude': 'latitude',
+        'longitude': 'longitude',
+        'directions': 'directions',
+        'type': 'type',
+        'created': 'created',
+        'updated': 'updated'
+    }
 
     def __init__(self, name, location_type, description, latitude, longitude):
         self.name = name
@@ -139,24 +371,66 @@ class Directions(db.Model):
         self.created = datetime.now()
 
 
-def join_table(model, model_class, join_model, field, join_model_field=None):
+class TravelTime(db.Model):
     """
-    Use this to perform a join to another model
-    :param model:
-    :param model_class:
-    :param join_model:
-    :param join_model_field:
-    :param field:
-    :return:
+    Precomputed travel times from a bus stop to a building: one row per pair, holding each travel mode's
+    duration (seconds) and distance (metres), NULL where the mode has no route. Kept up to date by the
+    refresh_travel_times job.
     """
-    self_field = getattr(model, field)
-    join_field = getattr(join_model, join_model_field or field)
+    __tablename__ = 'travel_time'
+
+    modes = ['driving', 'walking', 'transit']
+
+    origin_id = db.Column(db.Integer, db.ForeignKey('location.id'), primary_key=True)
+    destination_id = db.Column(db.Integer, db.ForeignKey('location.id'), primary_key=True, index=True)
+    driving_duration = db.Column(db.Integer)
+    driving_distance = db.Column(db.Integer)
+    walking_duration = db.Column(db.Integer)
+    walking_distance = db.Column(db.Integer)
+    transit_duration = db.Column(db.Integer)
+    transit_distance = db.Column(db.Integer)
+    updated = db.Column(db.DateTime)
+
+    @classmethod
+    def from_origin(cls, origin_id, destination_ids):
+        """
+        :param origin_id: bus stop id
+        :param destination_ids:
+        :return: dict of destination id -> TravelTime, for the pairs that have been computed
+        """
+        if not destination_ids:
+            return {}
+
+        rows = db.session.query(cls).filter(cls.origin_id == origin_id, cls.destination_id.in_(destination_ids))
+
+        return dict((row.destination_id, row) for row in rows)
+
+    def leg(self, mode):
+        """
+        :param mode: travel mode
+        :return: (seconds, metres), or None if there is no route
+        """
+        duration = getattr(self, '{0}_duration'.format(mode))
+
+        return None if duration is None else (duration, getattr(self, '{0}_distance'.format(mode)))
 
-    result = db.session.query(join_model, model_class).filter(join_field == self_field).first()
+    def __init__(self, origin_id, destination_id, legs):
+        """
+        :param origin_id:
+        :param destination_id:
+        :param legs: dict of travel mode -> (seconds, metres) or None
+        """
+        self.origin_id = origin_id
+        self.destination_id = destination_id
 
-    if result is None:
-        return result
+        for mode in self.modes:
+            duration, distance = legs.get(mode) or (None, None)
+            setattr(self, '{0}_duration'.format(mode), duration)
+            setattr(self, '{0}_distance'.format(mode), distance)
 
-    join_model_result, self_result = result
+        self.updated = datetime.now()
 
-    return join_model_result.serialize
+entity_cache.watch(Shuttle)
+entity_cache.watch(Location)
+# locations are serialized with their directions
+entity_cache.watch(Directions, lambda directions: [(Location.__name__, directions.location_id)])
@@ -2,19 +2,16 @@ from datetime import datetime
 import random
 import enum
 
-from flask import g, current_app as app
-from itsdangerous import (BadSignature,
-                          SignatureExpired,
-                          TimedJSONWebSignatureSerializer,)
-from passlib.apps import custom_app_context
+from flask import g
 
-from app import auth, db
+from app import auth, auth_tokens, db, entity_cache, passwords
 
 
 @auth.verify_password
 def verify_password(userid_or_token, password):
 
     if (type(userid_or_token) != long) and (type(userid_or_token) != int):
+        # a Principal built from the token's claims; its .user loads the row when a handler needs it
         user = User.verify_auth_token(userid_or_token)
         if not user:
             return False
@@ -59,31 +56,24 @@ class User(db.Model):
 
     @staticmethod
     def hash_password(password):
-        return custom_app_context.encrypt(password)
+        return passwords.hash(password)
 
     def verify_password(self, password):
-        return custom_app_context.verify(password, self.password)
+        valid, new_hash = passwords.verify(password, self.password)
 
-    def generate_auth_token(self, expiration=600):
-        signature = TimedJSONWebSignatureSerializer(
-            app.config['SECRET_KEY'],
-            expires_in=expiration
-        )
-        return signature.dumps({'userId': self.user_id})
+        if valid and new_hash is not None:
+            # hashed under an older policy; store it under the current one
+            self.password = new_hash
+            db.session.commit()
 
-    @staticmethod
-    def verify_auth_token(token):
-        signature = TimedJSONWebSignatureSerializer(app.config['SECRET_KEY'])
-        try:
-            data = signature.loads(token)
-        except SignatureExpired:
-            return None
-        except BadSignature:
-            return None
+        return valid
 
-        user = db.session.query(User).get(data['userId'])
+    def generate_auth_token(self, expiration=None):
+        return auth_tokens.issue(self, expiration)
 
-        return user
+    @staticmethod
+    def verify_auth_token(token):
+        return auth_tokens.verify(token)
 
     @property
     def confirm_admin(self):
@@ -104,8 +94,12 @@ class User(db.Model):
 
     @classmethod
     def get_user(cls, user_id):
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
 
-        return db.session.query(cls).filter_by(user_id=user_id).first()
+        return entity_cache.get(cls, user_id, lambda: db.session.query(cls).filter_by(user_id=user_id).first())
 
     def __init__(self, first_name, last_name, password, email, account_type):
         self.first_name = first_name
@@ -116,3 +110,6 @@ class User(db.Model):
         self.created = datetime.now()
         self.registration_code = random.randint(10000, 99999)
         self.registration_confirmed = False
+
+
+entity_cache.watch(User)
@@ -0,0 +1,51 @@
+"""
+Compares ranking a fleet by distance one item at a time against the vectorized pass in app.lib.distance.
+
+    $ python -m benchmarks.distance --points 10000 --round-trip-ms 200
+
+The per-item path used to be one maps API round trip per shuttle. That can't be timed offline, so it is
+reported as the pure Python haversine loop plus --round-trip-ms per item.
+"""
+import argparse
+import random
+import timeit
+
+from app.lib.distance import coordinate_arrays, rank_by_distance
+from app.lib.geo import haversine
+
+
+def per_item(origin, rows):
+    return sorted((haversine(origin[0], origin[1], lat, lng), row_id) for row_id, lat, lng in rows)
+
+
+def vectorized(origin, rows):
+    ids, latitudes, longitudes = coordinate_arrays(rows)
+    return rank_by_distance(origin, ids, latitudes, longitudes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--points', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--round-trip-ms', type=float, default=200.0)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    origin = (7.3163, 5.0923)
+    rows = [(i, origin[0] + rng.uniform(-0.5, 0.5), origin[1] + rng.uniform(-0.5, 0.5)) for i in range(args.points)]
+
+    assert [row_id for _, row_id in per_item(origin, rows)] == [row[0] for row in vectorized(origin, rows)]
+
+    loop = min(timeit.repeat(lambda: per_item(origin, rows), number=1, repeat=args.repeat))
+    vector = min(timeit.repeat(lambda: vectorized(origin, rows), number=1, repeat=args.repeat))
+
+    print('{0} points'.format(args.points))
+    print('per-item haversine:  {0:10.3f} ms'.format(loop * 1000))
+    print('per-item maps calls: {0:10.3f} ms (estimated at {1}ms per round trip)'.format(
+        loop * 1000 + args.points * args.round_trip_ms, args.round_trip_ms))
+    print('vectorized:          {0:10.3f} ms ({1:.1f}x faster than the haversine loop)'.format(
+        vector * 1000, loop / vector))
+
+
+if __name__ == '__main__':
+    main()
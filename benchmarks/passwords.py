@@ -0,0 +1,59 @@
+"""
+Measures password verification (the CPU cost of a login) on the request thread and on the hashing pool.
+
+    $ python -m benchmarks.passwords --logins 64 --rounds 535000
+
+Logins/sec per core is the rate to plan capacity with: a worker box sustains roughly that times its cores.
+"""
+import argparse
+import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from app.lib.passwords import PasswordHasher, hash_password
+
+
+def logins_per_second(hasher, hashed, logins, concurrency):
+    clients = ThreadPool(concurrency)
+    started = time.time()
+    results = clients.map(lambda _: hasher.verify('password', hashed)[0], range(logins))
+    elapsed = time.time() - started
+    clients.close()
+
+    assert all(results)
+
+    return logins / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--logins', type=int, default=64)
+    parser.add_argument('--rounds', type=int, default=535000)
+    parser.add_argument('--workers', type=int, default=cpu_count())
+    args = parser.parse_args()
+
+    hashed = hash_password(args.rounds, 'password')
+
+    inline = PasswordHasher()
+    inline.workers = 0
+    inline.rounds = args.rounds
+
+    pooled = PasswordHasher()
+    pooled.workers = args.workers
+    pooled.rounds = args.rounds
+    pooled.max_queue = args.logins
+
+    # start the pool processes before timing
+    pooled.verify('password', hashed)
+
+    single = logins_per_second(inline, hashed, args.logins // 4 or 1, 1)
+    pool = logins_per_second(pooled, hashed, args.logins, args.workers * 2)
+
+    print('sha512_crypt, {0} rounds'.format(args.rounds))
+    print('request thread:       {0:8.1f} logins/s'.format(single))
+    print('pool of {0:2d} processes: {1:8.1f} logins/s ({2:.1f} logins/s per core)'.format(
+        args.workers, pool, pool / args.workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Compares the routing providers on random trips around campus.
+
+    $ python -m benchmarks.routing --trips 50
+    $ GMAPS_KEY=... python -m benchmarks.routing --trips 20
+
+The graph provider runs on a synthetic grid road network. The Google provider is only timed when
+GMAPS_KEY is set in the environment, since it makes real API calls.
+"""
+import argparse
+import os
+import random
+import time
+
+from flask import Flask
+
+from app.lib.maps import MapsGateway
+from app.lib.routing import GoogleRoutingProvider, GraphRoutingProvider, RoadGraph
+
+
+def grid_graph(origin, size, spacing):
+    nodes = []
+    edges = []
+
+    for row in range(size):
+        for col in range(size):
+            node_id = row * size + col
+            nodes.append([node_id, origin[0] + row * spacing, origin[1] + col * spacing])
+            if col:
+                edges.append([node_id - 1, node_id])
+            if row:
+                edges.append([node_id - size, node_id])
+
+    return RoadGraph(nodes, edges)
+
+
+def time_provider(name, provider, trips, destinations):
+    start = time.time()
+    for origin, destination in trips:
+        provider.directions(origin, destination, 'driving')
+    directions_time = time.time() - start
+
+    start = time.time()
+    provider.distance_matrix([trips[0][0]], destinations, 'driving')
+    matrix_time = time.time() - start
+
+    print('{0:8} directions: {1:8.2f} ms/trip   distance matrix (1x{2}): {3:8.2f} ms'.format(
+        name, directions_time * 1000 / len(trips), len(destinations), matrix_time * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--trips', type=int, default=50)
+    parser.add_argument('--grid', type=int, default=100, help='the road network is a grid x grid lattice')
+    args = parser.parse_args()
+
+    origin, spacing = (7.30, 5.08), 0.0005
+    extent = args.grid * spacing
+    rng = random.Random(0)
+
+    def point():
+        return '{0:.6f},{1:.6f}'.format(origin[0] + rng.uniform(0, extent), origin[1] + rng.uniform(0, extent))
+
+    trips = [(point(), point()) for _ in range(args.trips)]
+    destinations = [point() for _ in range(25)]
+
+    start = time.time()
+    graph = grid_graph(origin, args.grid, spacing)
+    print('graph: {0} nodes loaded in {1:.2f} ms'.format(len(graph.nodes), (time.time() - start) * 1000))
+
+    time_provider('graph', GraphRoutingProvider(graph), trips, destinations)
+
+    if os.environ.get('GMAPS_KEY'):
+        app = Flask(__name__)
+        app.config['GMAPS_KEY'] = os.environ['GMAPS_KEY']
+        gateway = MapsGateway()
+        gateway.init_app(app)
+        time_provider('google', GoogleRoutingProvider(gateway), trips, destinations)
+    else:
+        print('google   skipped, set GMAPS_KEY to time it')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 from flask_migrate import Migrate, MigrateCommand
-from flask_script import Command, Manager
+from flask_script import Command, Manager, Option
 
-from app import init_app, db
+from app import init_app, db, jobs
 
 app = init_app()
 # $ flask db --help
@@ -15,8 +15,38 @@ class InitDB(Command):
         db.session.commit()
 
 
+class RunJobs(Command):
+    """Runs background jobs"""
+
+    option_list = (
+        Option('--workers', '-w', type=int, default=2),
+        Option('--once', action='store_true', help='run the jobs that are due and exit'),
+    )
+
+    def run(self, workers, once):
+        if once:
+            print('Ran {0} jobs.'.format(jobs.run_pending()))
+        else:
+            jobs.work(workers)
+
+
+class PrecomputeTravelTimes(Command):
+    """Precomputes travel times from bus stops to buildings"""
+
+    option_list = (
+        Option('--location', '-l', type=int, help='only recompute the pairs to and from this location'),
+    )
+
+    def run(self, location):
+        from app.api.shuttles.shuttles import refresh_travel_times
+
+        print('Stored {0} travel times.'.format(refresh_travel_times(location)))
+
+
 manager.add_command('db', MigrateCommand)
 manager.add_command('initdb', InitDB())
+manager.add_command('jobs', RunJobs())
+manager.add_command('travel-times', PrecomputeTravelTimes())
 
 if __name__ == '__main__':
     manager.run()
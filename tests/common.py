@@ -1,5 +1,8 @@
+from contextlib import contextmanager
+
 from flask_testing import TestCase
 from base64 import b64encode
+from sqlalchemy import event
 
 from app import db, init_app
 
@@ -51,3 +54,19 @@ class BaseTest(TestCase):
 
     def create_app(self):
         return self._app
+
+    @contextmanager
+    def count_queries(self):
+        """
+        Collects the SQL statements run inside the block.
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
@@ -0,0 +1,147 @@
+import threading
+from datetime import datetime
+
+import mock
+
+from app import db, entity_cache, maps_cache
+from app.models.shuttles import Shuttle
+from app.models.users import User, AccountTypeEnum
+from common import BaseTest
+
+
+class TestMapsResultCache(BaseTest):
+    """
+    Maps result cache tests.
+    """
+
+    def setUp(self):
+        maps_cache.backend.clear()
+
+    def test_nearby_origins_share_an_entry(self):
+        loader = mock.MagicMock(return_value={'rows': []})
+
+        maps_cache.fetch('directions', 'walking', ['7.31631,5.09234', '7.3,5.1'], loader)
+        maps_cache.fetch('directions', 'walking', ['7.31629, 5.09228', '7.3,5.1'], loader)
+        self.assertEquals(loader.call_count, 1)
+
+        maps_cache.fetch('directions', 'driving', ['7.31629,5.09228', '7.3,5.1'], loader)
+        self.assertEquals(loader.call_count, 2)
+
+    def test_addresses_are_normalised(self):
+        self.assertEquals(maps_cache.quantize('  Covenant  University '), maps_cache.quantize('covenant university'))
+
+    def test_hit_and_miss_counters(self):
+        before = maps_cache.stats().get('distance_matrix', {'hits': 0, 'misses': 0})
+
+        maps_cache.set('distance_matrix', 'driving', ['7.3,5.1', '7.4,5.2'], {'status': 'OK'})
+        results = maps_cache.get_many('distance_matrix', 'driving', [['7.3,5.1', '7.4,5.2'], ['7.5,5.1', '7.4,5.2']])
+
+        self.assertEquals(results, [{'status': 'OK'}, None])
+        after = maps_cache.stats()['distance_matrix']
+        self.assertEquals(after['hits'] - before['hits'], 1)
+        self.assertEquals(after['misses'] - before['misses'], 1)
+
+    def test_concurrent_misses_share_one_call(self):
+        """
+        Assert that identical lookups made while one is in flight wait for it instead of calling the API.
+        """
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {'status': 'OK'}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            maps_cache.fetch('directions', 'transit', ['7.31631,5.09234', '7.3,5.1'], loader))) for _ in range(4)]
+        threads[0].start()
+        started.wait(5)
+
+        for thread in threads[1:]:
+            thread.start()
+
+        release.set()
+
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(results, [{'status': 'OK'}] * 4)
+
+
+class TestEntityCache(BaseTest):
+    """
+    Two-tier entity cache tests.
+    """
+
+    def setUp(self):
+        entity_cache.backend.clear()
+        entity_cache.clear()
+        driver = User('cached', 'driver', 'password', 'cached@test.com', AccountTypeEnum.driver)
+        db.session.add(driver)
+        db.session.commit()
+        shuttle = Shuttle(driver.user_id, 'small', 'brand', True, 14)
+        db.session.add(shuttle)
+        db.session.commit()
+        self.user_id, self.shuttle_id = driver.user_id, shuttle.id
+        db.session.remove()
+
+    def tearDown(self):
+        Shuttle.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_broadcasts_reuse_one_redis_client(self):
+        with mock.patch.object(entity_cache, 'redis_url', 'redis://127.0.0.1:6379/0'), \
+                mock.patch.object(entity_cache, '_redis', None):
+            self.assertIs(entity_cache._get_redis(), entity_cache._get_redis())
+
+    def test_reads_are_cached_across_sessions(self):
+        """
+        Assert that a row read once is served without a query, from either tier.
+        """
+        User.get_user(self.user_id)
+        db.session.remove()
+
+        with self.count_queries() as statements:
+            user = User.get_user(self.user_id)
+        self.assertEquals(statements, [])
+        self.assertEquals(user.email, 'cached@test.com')
+        db.session.remove()
+
+        # another worker's empty local tier falls back to the shared one
+        entity_cache.clear()
+        with self.count_queries() as statements:
+            user = User.get_user(self.user_id)
+        self.assertEquals(statements, [])
+        self.assertIn(user, db.session)
+
+    def test_commit_invalidates(self):
+        """
+        Assert that committing a change to a cached row drops it from both tiers.
+        """
+        user = User.get_user(self.user_id)
+        user.first_name = 'renamed'
+        db.session.commit()
+        db.session.remove()
+
+        with self.count_queries() as statements:
+            user = User.get_user(self.user_id)
+        self.assertEquals(len(statements), 1)
+        self.assertEquals(user.first_name, 'renamed')
+
+    def test_bulk_update_invalidates(self):
+        """
+        Assert that bulk location writes, which skip ORM events, still invalidate cached shuttles.
+        """
+        self.assertIsNone(Shuttle.get_shuttle_by_id(self.shuttle_id).latitude)
+        db.session.remove()
+
+        Shuttle.update_locations([{'shuttle_id': self.shuttle_id, 'lat': 6.5, 'lng': 3.3, 'received': datetime.now()}])
+        db.session.remove()
+
+        self.assertEquals(Shuttle.get_shuttle_by_id(self.shuttle_id).latitude, 6.5)
@@ -0,0 +1,44 @@
+import time
+from multiprocessing import TimeoutError
+from unittest import TestCase
+
+from app.lib.concurrency import FanOut
+
+
+class TestFanOut(TestCase):
+    """
+    Fan-out pool tests.
+    """
+
+    def setUp(self):
+        self.pool = FanOut(4)
+
+    def test_calls_past_the_deadline_are_left_out(self):
+        def fail():
+            raise ValueError('no route')
+
+        start = time.time()
+        results, errors = self.pool.run({'fast': lambda: 1, 'slow': lambda: time.sleep(1) or 2, 'failing': fail}, 0.2)
+
+        self.assertLess(time.time() - start, 0.9)
+        self.assertEquals(results, {'fast': 1})
+        self.assertIsInstance(errors['slow'], TimeoutError)
+        self.assertIsInstance(errors['failing'], ValueError)
+
+    def test_queued_calls_past_the_deadline_are_skipped(self):
+        pool = FanOut(1)
+        started = []
+
+        def call(key):
+            started.append(key)
+            time.sleep(0.3)
+
+        results, errors = pool.run(dict((key, lambda key=key: call(key)) for key in range(3)), 0.1)
+        # let the queue drain
+        pool.run({'last': lambda: None}, 1)
+
+        self.assertEquals((results, len(errors)), ({}, 3))
+        self.assertEquals(len(started), 1)
+
+    def test_no_calls(self):
+        self.assertEquals(self.pool.run({}, 1), ({}, {}))
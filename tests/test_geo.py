@@ -0,0 +1,77 @@
+import random
+from unittest import TestCase
+
+from app.lib.distance import bearings, coordinate_arrays, rank_by_distance
+from app.lib.geo import GridIndex, haversine, parse_coordinates
+
+
+class TestGridIndex(TestCase):
+    """
+    Grid index unit tests.
+    """
+    origin = (7.3163, 5.0923)
+
+    def setUp(self):
+        rng = random.Random(42)
+        self.points = [(i, self.origin[0] + rng.uniform(-0.2, 0.2), self.origin[1] + rng.uniform(-0.2, 0.2))
+                       for i in range(2000)]
+        self.index = GridIndex(cell_size=0.01)
+        self.index.rebuild(self.points)
+
+    def _brute_force(self, limit=None, radius_km=None):
+        distances = sorted((haversine(self.origin[0], self.origin[1], lat, lng), key)
+                           for key, lat, lng in self.points)
+        if radius_km is not None:
+            distances = [d for d in distances if d[0] <= radius_km]
+        return [key for _, key in distances][:limit]
+
+    def test_nearest_matches_brute_force(self):
+        result = self.index.nearest(self.origin[0], self.origin[1], limit=10)
+        self.assertEquals([key for key, _ in result], self._brute_force(limit=10))
+
+    def test_radius(self):
+        result = self.index.nearest(self.origin[0], self.origin[1], radius_km=3)
+        self.assertEquals([key for key, _ in result], self._brute_force(radius_km=3))
+
+    def test_update_moves_point(self):
+        self.index.update('new', self.origin[0] + 1, self.origin[1])
+        self.assertNotEquals(self.index.nearest(self.origin[0], self.origin[1], limit=1)[0][0], 'new')
+
+        self.index.update('new', self.origin[0], self.origin[1])
+        self.assertEquals(self.index.nearest(self.origin[0], self.origin[1], limit=1)[0][0], 'new')
+        self.assertEquals(len(self.index), len(self.points) + 1)
+
+    def test_remove(self):
+        self.index.remove(0)
+        self.assertNotIn(0, self.index)
+        self.assertNotIn(0, [key for key, _ in self.index.nearest(self.origin[0], self.origin[1])])
+
+    def test_parse_coordinates(self):
+        self.assertEquals(parse_coordinates('7.31, 5.09'), (7.31, 5.09))
+        self.assertIsNone(parse_coordinates('Covenant University, Ota'))
+        self.assertIsNone(parse_coordinates('91,5'))
+
+
+class TestDistance(TestCase):
+    """
+    Vectorized distance unit tests.
+    """
+    origin = (7.3163, 5.0923)
+
+    def test_rank_matches_haversine(self):
+        rows = [(1, 7.33, 5.09), (2, 7.31, 5.1), (3, None, None), (4, 7.5, 5.5)]
+        ids, latitudes, longitudes = coordinate_arrays(rows)
+
+        ranked = rank_by_distance(self.origin, ids, latitudes, longitudes, limit=2)
+
+        self.assertEquals([row[0] for row in ranked], [2, 1])
+        self.assertAlmostEqual(ranked[0][1], haversine(self.origin[0], self.origin[1], 7.31, 5.1))
+
+    def test_radius_skips_missing_coordinates(self):
+        ids, latitudes, longitudes = coordinate_arrays([(1, None, None), (2, 7.5, 5.5), (3, 7.32, 5.09)])
+        self.assertEquals([row[0] for row in rank_by_distance(self.origin, ids, latitudes, longitudes,
+                                                              radius_km=5)], [3])
+
+    def test_bearings(self):
+        result = bearings(0, 0, [1, 0, -1, 0], [0, 1, 0, -1])
+        self.assertEquals([round(b) for b in result], [0, 90, 180, 270])
@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+import mock
+
+from app import db
+from app.lib.ingest import LocationBuffer
+from app.models.shuttles import Shuttle
+from common import BaseTest
+
+
+class TestLocationBuffer(BaseTest):
+    """
+    Write-behind location buffer tests.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestLocationBuffer, cls).setUpClass()
+
+        # one buffer for the class, as init_app registers its exit flush
+        with mock.patch.dict(cls._app.config, {'LOCATION_INGEST_MODE': 'buffered'}):
+            cls.buffer = LocationBuffer()
+            cls.buffer.init_app(cls._app)
+
+    def setUp(self):
+        self.shuttles = [Shuttle(None, 'small', 'brand', True, 14) for _ in range(3)]
+        db.session.add_all(self.shuttles)
+        db.session.commit()
+
+        self.buffer._pending.clear()
+        self.buffer._owners.clear()
+
+    def tearDown(self):
+        Shuttle.query.delete()
+        db.session.commit()
+
+    def test_flush_keeps_latest_ping_per_shuttle(self):
+        ids = [shuttle.id for shuttle in self.shuttles]
+        self.buffer.add(ids[0], 7.1, 5.1)
+        self.buffer.add(ids[0], 7.2, 5.2)
+        self.buffer.add(ids[1], 7.3, 5.3)
+
+        self.assertEquals(self.buffer.flush(), 2)
+        self.assertEquals(self.buffer.flush(), 0)
+
+        # the flush runs in its own app context, so load fresh copies
+        first, second, third = [Shuttle.query.get(shuttle_id) for shuttle_id in ids]
+        self.assertEquals((first.latitude, first.longitude), (7.2, 5.2))
+        self.assertEquals((second.latitude, second.longitude), (7.3, 5.3))
+        self.assertIsNone(third.latitude)
+
+    def test_older_ping_does_not_overwrite_newer_position(self):
+        shuttle = self.shuttles[0]
+        now = datetime.now()
+        Shuttle.update_locations([{'shuttle_id': shuttle.id, 'lat': 7.5, 'lng': 5.5, 'received': now}])
+        Shuttle.update_locations([{'shuttle_id': shuttle.id, 'lat': 7.4, 'lng': 5.4,
+                                   'received': now - timedelta(seconds=5)}])
+
+        db.session.expire_all()
+        self.assertEquals((shuttle.latitude, shuttle.longitude), (7.5, 5.5))
+
+    def test_edit_does_not_make_pings_stale(self):
+        shuttle = self.shuttles[0]
+        received = datetime.now() - timedelta(seconds=5)
+
+        # bumps the updated audit column, but the shuttle has no newer position
+        shuttle.brand = 'edited'
+        db.session.commit()
+
+        self.assertEquals(Shuttle.update_locations([{'shuttle_id': shuttle.id, 'lat': 7.1, 'lng': 5.1,
+                                                     'received': received}]), [shuttle.id])
+
+    def test_ownership_is_remembered(self):
+        self.assertFalse(self.buffer.is_owner(1, 2))
+        self.buffer.set_owner(1, 2)
+        self.assertTrue(self.buffer.is_owner('1', '2'))
+        self.assertFalse(self.buffer.is_owner(1, 3))
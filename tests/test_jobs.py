@@ -0,0 +1,130 @@
+import json
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime
+
+import mock
+from flask import url_for
+
+from app import db, jobs
+from app.models.jobs import Job, JobStatusEnum
+from app.models.users import User
+from common import BaseTest
+
+
+class FakeMailgun(BaseHTTPRequestHandler):
+    """
+    Records the messages posted to it and answers with `status`.
+    """
+    status = 200
+    messages = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        FakeMailgun.messages.append((self.path, urlparse.parse_qs(body)))
+        self.send_response(self.status)
+        self.end_headers()
+        self.wfile.write('{"message": "Queued. Thank you."}')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestJobs(BaseTest):
+    """
+    Background job tests, against a local fake Mailgun.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestJobs, cls).setUpClass()
+        cls.mailgun = HTTPServer(('127.0.0.1', 0), FakeMailgun)
+        thread = threading.Thread(target=cls.mailgun.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mailgun.shutdown()
+        super(TestJobs, cls).tearDownClass()
+
+    def setUp(self):
+        FakeMailgun.status = 200
+        FakeMailgun.messages = []
+        self.config = mock.patch.dict(self.app.config, {
+            'MAILGUN_API_URL': 'http://127.0.0.1:{0}/v3'.format(self.mailgun.server_port),
+            'FROM_EMAIL_DOMAIN': 'test.com',
+            'FROM_EMAIL_ADDRESS': 'hello'
+        })
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+        Job.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def _register(self):
+        return self.client.post(url_for('users.register_user', _external=True), headers=self.headers,
+                                data=json.dumps({'firstName': 'job', 'lastName': 'user', 'password': 'password',
+                                                 'email': 'job@test.com', 'accountType': 'user'}))
+
+    def test_registration_email_is_sent_in_background(self):
+        """
+        Assert that signing up queues the registration email, and a worker sends it.
+        """
+        resp = self._register()
+        self.assertEquals(resp.json['status'], 'success')
+        self.assertEquals(FakeMailgun.messages, [])
+
+        self.assertEquals(jobs.run_pending(), 1)
+
+        user = User.query.filter_by(email='job@test.com').first()
+        path, message = FakeMailgun.messages[0]
+        self.assertEquals(path, '/v3/test.com/messages')
+        self.assertEquals(message['to'], ['job@test.com'])
+        self.assertEquals(message['text'], ['Registration code: {0}'.format(user.registration_code)])
+        self.assertEquals(Job.query.one().status, JobStatusEnum.done)
+
+    def test_failing_job_is_retried_then_dead_lettered(self):
+        """
+        Assert that a failing job backs off between attempts and is marked dead after the last one.
+        """
+        FakeMailgun.status = 500
+        self._register()
+
+        self.assertEquals(jobs.run_pending(), 1)
+        job = Job.query.one()
+        self.assertEquals(job.status, JobStatusEnum.pending)
+        self.assertEquals(job.attempts, 1)
+        self.assertIn('500', job.last_error)
+        self.assertGreater(job.run_at, datetime.now())
+
+        # not due yet
+        self.assertEquals(jobs.run_pending(), 0)
+
+        with mock.patch.object(jobs, 'max_attempts', 2):
+            Job.query.update({'run_at': datetime.now()})
+            db.session.commit()
+            self.assertEquals(jobs.run_pending(), 1)
+
+        job = Job.query.one()
+        self.assertEquals(job.status, JobStatusEnum.dead)
+        self.assertEquals(job.attempts, 2)
+        self.assertEquals(len(FakeMailgun.messages), 2)
+
+    def test_enqueue_many_skips_taken_keys(self):
+        """
+        Assert that a batch of jobs is added in one commit, leaving out keys that are already queued.
+        """
+        arguments = {'origin': 'a', 'destination': 'b', 'mode': 'walking'}
+        jobs.enqueue('prefetch_directions', arguments, key='one')
+
+        with mock.patch.object(db.session, 'commit', wraps=db.session.commit) as commit:
+            added = jobs.enqueue_many('prefetch_directions', [(arguments, 'one'), (arguments, 'two'),
+                                                              (arguments, 'two'), (arguments, None)])
+
+        self.assertEquals(commit.call_count, 1)
+        self.assertEquals([job.key for job in added], ['two', None])
+        self.assertEquals(sorted(key for key, in db.session.query(Job.key)), [None, 'one', 'two'])
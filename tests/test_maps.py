@@ -0,0 +1,147 @@
+import json
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from unittest import TestCase
+from urlparse import parse_qs, urlparse
+
+from flask import Flask
+from googlemaps.exceptions import ApiError, HTTPError
+
+from app.lib.maps import CircuitOpen, MapsGateway
+
+
+class FakeMapsServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for the Google Maps web services. `responses` is a list of (status_code, body) replies,
+    served in order; the last one repeats.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeMapsHandler)
+        self.responses = [(200, {'status': 'OK', 'rows': [], 'routes': []})]
+        self.requests = []
+        self.connections = set()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+
+class FakeMapsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        server.requests.append((url.path, parse_qs(url.query)))
+        server.connections.add(self.client_address)
+
+        status, body = server.responses[min(len(server.requests), len(server.responses)) - 1]
+        payload = json.dumps(body)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMapsGateway(TestCase):
+    """
+    Maps gateway tests, run against a local fake maps server.
+    """
+
+    def setUp(self):
+        self.server = FakeMapsServer()
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+
+        app = Flask(__name__)
+        app.config.update({
+            'MAPS_BASE_URL': self.server.url,
+            'GMAPS_KEY': 'test-key',
+            'MAPS_QPS': 1000,
+            'MAPS_MAX_RETRIES': 2,
+            'MAPS_RETRY_BACKOFF': 0.01,
+            'MAPS_BREAKER_THRESHOLD': 2,
+            'MAPS_BREAKER_COOLDOWN': 0.2
+        })
+        self.app = app
+        self.gateway = MapsGateway()
+        self.gateway.init_app(app)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuses_connections(self):
+        for _ in range(3):
+            self.gateway.distance_matrix(['7.31,5.09'], ['7.3,5.1'], 'walking')
+
+        self.assertEquals(len(self.server.requests), 3)
+        self.assertEquals(len(self.server.connections), 1)
+
+        path, params = self.server.requests[0]
+        self.assertEquals(path, '/maps/api/distancematrix/json')
+        self.assertEquals(params['key'], ['test-key'])
+        self.assertEquals(params['mode'], ['walking'])
+
+    def test_retries_then_succeeds(self):
+        self.server.responses = [(500, {}), (200, {'status': 'OVER_QUERY_LIMIT'}), (200, {'status': 'OK',
+                                                                                         'routes': ['route']})]
+
+        self.assertEquals(self.gateway.directions('7.31,5.09', '7.3,5.1'), ['route'])
+        self.assertEquals(len(self.server.requests), 3)
+        self.assertEquals(self.gateway.stats()['directions']['errors'], 0)
+
+    def test_retries_are_bounded(self):
+        self.server.responses = [(503, {})]
+
+        self.assertRaises(HTTPError, self.gateway.directions, '7.31,5.09', '7.3,5.1')
+        self.assertEquals(len(self.server.requests), 3)
+
+        stats = self.gateway.stats()['directions']
+        self.assertEquals(stats['count'], 1)
+        self.assertEquals(stats['errors'], 1)
+
+    def test_api_errors_are_not_retried(self):
+        self.server.responses = [(200, {'status': 'REQUEST_DENIED', 'error_message': 'Bad key'})]
+
+        self.assertRaises(ApiError, self.gateway.distance_matrix, ['7.31,5.09'], ['7.3,5.1'])
+        self.assertEquals(len(self.server.requests), 1)
+
+    def test_rate_limit(self):
+        self.app.config['MAPS_QPS'] = 50
+        self.gateway.init_app(self.app)
+
+        start = time.time()
+        for _ in range(6):
+            self.gateway.distance_matrix(['7.31,5.09'], ['7.3,5.1'])
+
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+    def test_circuit_opens_after_failures(self):
+        self.server.responses = [(503, {})]
+
+        for _ in range(2):
+            self.assertRaises(HTTPError, self.gateway.directions, '7.31,5.09', '7.3,5.1')
+
+        requests = len(self.server.requests)
+        self.assertRaises(CircuitOpen, self.gateway.directions, '7.31,5.09', '7.3,5.1')
+        self.assertEquals(len(self.server.requests), requests)
+        self.assertEquals(self.gateway.breaker.state, 'open')
+
+        # after the cooldown one trial call goes through, and closes it
+        self.server.responses = [(200, {'status': 'OK', 'routes': ['route']})]
+        self.server.requests = []
+        time.sleep(0.2)
+
+        self.assertEquals(self.gateway.directions('7.31,5.09', '7.3,5.1'), ['route'])
+        self.assertEquals(self.gateway.breaker.state, 'closed')
@@ -0,0 +1,73 @@
+import json
+import mock
+
+from flask import url_for
+from passlib.hash import sha256_crypt
+
+from app import db, passwords
+from app.models.users import User, AccountTypeEnum, verify_password
+from common import BaseTest
+
+
+class TestPasswords(BaseTest):
+    """
+    Password hashing pool tests.
+    """
+
+    def setUp(self):
+        user = User('hash', 'user', 'password', 'hash@test.com', AccountTypeEnum.user)
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.user_id
+
+    def tearDown(self):
+        User.query.delete()
+        db.session.commit()
+
+    def test_login_rehashes_legacy_hash(self):
+        """
+        Assert that a hash from an older policy is replaced after a successful login.
+        """
+        user = User.query.get(self.user_id)
+        user.password = sha256_crypt.using(rounds=5000).hash('password')
+        db.session.commit()
+
+        self.assertFalse(verify_password(self.user_id, 'wrong'))
+        self.assertTrue(User.query.get(self.user_id).password.startswith('$5$'))
+
+        self.assertTrue(verify_password(self.user_id, 'password'))
+        new_hash = User.query.get(self.user_id).password
+        self.assertTrue(new_hash.startswith('$6$rounds={0}$'.format(passwords.rounds)))
+        self.assertTrue(verify_password(self.user_id, 'password'))
+        self.assertEquals(User.query.get(self.user_id).password, new_hash)
+
+    def test_saturated_pool_answers_503(self):
+        """
+        Assert that hashing is refused quickly once the queue is full.
+        """
+        max_queue, passwords.max_queue = passwords.max_queue, 0
+        try:
+            resp = self.client.post(url_for('users.register_user', _external=True), headers=self.headers,
+                                    data=json.dumps({'firstName': 'busy', 'lastName': 'user', 'password': 'password',
+                                                     'email': 'busy@test.com', 'accountType': 'user'}))
+        finally:
+            passwords.max_queue = max_queue
+
+        self.assertEquals(resp.status_code, 503)
+        self.assertEquals(resp.json['code'], 503)
+        self.assertIsNone(User.query.filter_by(email='busy@test.com').first())
+
+    def test_signup_hashes_on_both_branches(self):
+        """
+        Assert that a signup for an existing email does the same hashing work as a new signup.
+        """
+        from app.api.users.users import signup_metrics
+
+        with mock.patch.object(passwords, 'hash', wraps=passwords.hash) as hash_password:
+            for email in ('first@test.com', 'first@test.com'):
+                self.client.post(url_for('users.register_user', _external=True), headers=self.headers,
+                                 data=json.dumps({'firstName': 'sign', 'lastName': 'up', 'password': 'password',
+                                                  'email': email, 'accountType': 'user'}))
+
+        self.assertEquals(hash_password.call_count, 2)
+        self.assertGreaterEqual(signup_metrics.snapshot()['register']['count'], 2)
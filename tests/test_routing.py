@@ -0,0 +1,37 @@
+from unittest import TestCase
+
+from app.lib.routing import GraphRoutingProvider, RoadGraph
+
+
+class TestGraphRoutingProvider(TestCase):
+    """
+    Offline routing tests on a small road graph:
+
+        1 --- 2 --- 3
+        |           |
+        4 --------- 5   (4-5 is a footpath)
+    """
+
+    def setUp(self):
+        nodes = [[1, 7.300, 5.100], [2, 7.300, 5.101], [3, 7.300, 5.102], [4, 7.299, 5.100], [5, 7.299, 5.102]]
+        edges = [[1, 2], [2, 3], [1, 4], [3, 5], [4, 5, None, {'modes': ['walking']}]]
+        self.provider = GraphRoutingProvider(RoadGraph(nodes, edges))
+
+    def test_directions_follow_allowed_edges(self):
+        walking = self.provider.directions('7.299,5.100', '7.299,5.102', 'walking')[0]['legs'][0]
+        driving = self.provider.directions('7.299,5.100', '7.299,5.102', 'driving')[0]['legs'][0]
+
+        self.assertAlmostEqual(walking['distance']['value'], 221, delta=2)
+        self.assertAlmostEqual(driving['distance']['value'], 221 + 2 * 111, delta=3)
+        self.assertEquals(driving['steps'][0]['distance'], driving['distance'])
+
+    def test_distance_matrix(self):
+        result = self.provider.distance_matrix(['7.300,5.100', 'Somewhere'], ['7.300,5.102', '7.299,5.102'])
+
+        first, second = result['rows']
+        self.assertEquals([e['status'] for e in first['elements']], ['OK', 'OK'])
+        self.assertEquals([e['status'] for e in second['elements']], ['NOT_FOUND', 'NOT_FOUND'])
+        self.assertLess(first['elements'][0]['duration']['value'], first['elements'][1]['duration']['value'])
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, self.provider.directions, '7.3,5.1', '7.3,5.102', 'flying')
@@ -0,0 +1,392 @@
+import json
+import time
+
+import mock
+from flask import url_for
+
+from app import db, location_buffer, maps_gateway, routing
+from app.models.shuttles import ChangeLog, Directions, Location, LocationTypeEnum, Shuttle, TravelTime
+from app.models.users import AccountTypeEnum, User
+from common import BaseTest
+
+
+class TestShuttlesApi(BaseTest):
+    """
+    Shuttles API Functional Tests.
+    """
+
+    def setUp(self):
+        self.drivers = [User('driver', str(i), 'password', 'driver{0}@test.com'.format(i), AccountTypeEnum.driver)
+                        for i in range(2)]
+        db.session.add_all(self.drivers)
+        db.session.commit()
+
+        self.shuttles = [Shuttle(driver.user_id, 'small', 'brand', True, 14) for driver in self.drivers]
+        db.session.add_all(self.shuttles)
+        db.session.commit()
+
+    def tearDown(self):
+        TravelTime.query.delete()
+        ChangeLog.query.delete()
+        Directions.query.delete()
+        Location.query.delete()
+        Shuttle.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def _add_shuttles(self, count):
+        driver = User.query.filter_by(email='driver0@test.com').first()
+        db.session.add_all([Shuttle(driver.user_id, 'small', 'brand', True, 14) for _ in range(count)])
+        db.session.commit()
+
+    def _add_locations(self, count):
+        locations = [Location('stop {0}'.format(i), LocationTypeEnum.bus_stop, '', 7.3, 5.1) for i in range(count)]
+        db.session.add_all(locations)
+        db.session.commit()
+        db.session.add_all([Directions(location.id, 'left', 'right', 'bus') for location in locations])
+        db.session.commit()
+
+    def _ping(self, shuttle, driver, lat, lng, timestamp):
+        return {'shuttle_id': shuttle.id, 'driver_id': driver.user_id, 'lat': lat, 'lng': lng,
+                'timestamp': timestamp}
+
+    def test_non_numeric_ids_are_not_found(self):
+        for endpoint, args, field in [('shuttles.get_shuttle', {'shuttle_id': 'abc'}, 'brand'),
+                                      ('locations.get_location', {'location_id': 'abc'}, 'name')]:
+            for fields in [None, field]:
+                resp = self.client.get(url_for(endpoint, fields=fields, _external=True, **args))
+                self.assertEquals((resp.status_code, resp.json['code']), (200, 400))
+
+    def test_location_update_with_non_numeric_ids(self):
+        position = {'lat': 6.5, 'lng': 3.3, 'latitude': 6.5, 'longitude': 3.3}
+
+        with mock.patch.object(location_buffer, 'enabled', True):
+            for shuttle_id, driver_id in [('abc', self.drivers[0].user_id), (self.shuttles[0].id, 'abc')]:
+                resp = self.client.put(url_for('shuttles.update_shuttle_location', shuttle_id=shuttle_id,
+                                               driver_id=driver_id, _external=True),
+                                       headers=self.headers, data=json.dumps(position))
+                self.assertEquals((resp.status_code, resp.json['code']), (200, 400))
+
+    def test_batch_location_update(self):
+        now = time.time()
+        first, second = self.shuttles
+        pings = [
+            self._ping(first, self.drivers[0], 7.2, 5.2, now),
+            self._ping(first, self.drivers[0], 7.1, 5.1, now - 10),
+            self._ping(second, self.drivers[1], 7.3, 5.3, now - 5),
+            self._ping(second, self.drivers[0], 9.9, 9.9, now)
+        ]
+
+        resp = self.client.put(url_for('shuttles.batch_update_shuttle_locations', _external=True),
+                               headers=self.headers, data=json.dumps({'pings': pings}))
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(resp.json['data']['accepted'], sorted([first.id, second.id]))
+        self.assertEquals([r['index'] for r in resp.json['data']['rejected']], [3])
+
+        db.session.expire_all()
+        self.assertEquals((first.latitude, first.longitude), (7.2, 5.2))
+        self.assertEquals((second.latitude, second.longitude), (7.3, 5.3))
+
+    def test_batch_location_update_validates_pings(self):
+        resp = self.client.put(url_for('shuttles.batch_update_shuttle_locations', _external=True),
+                               headers=self.headers, data=json.dumps({'pings': [{'shuttle_id': 1}]}))
+
+        self.assertEquals(resp.status_code, 400)
+
+        for ping in [{'timestamp': 1e20}, {'lat': 91}, {'lng': -181}]:
+            payload = dict(self._ping(self.shuttles[0], self.drivers[0], 7.2, 5.2, time.time()), **ping)
+            resp = self.client.put(url_for('shuttles.batch_update_shuttle_locations', _external=True),
+                                   headers=self.headers, data=json.dumps({'pings': [payload]}))
+
+            self.assertEquals(resp.status_code, 400)
+
+    def test_batch_location_update_reports_stale_pings(self):
+        now = time.time()
+        first = self.shuttles[0]
+        url = url_for('shuttles.batch_update_shuttle_locations', _external=True)
+
+        self.client.put(url, headers=self.headers,
+                        data=json.dumps({'pings': [self._ping(first, self.drivers[0], 7.2, 5.2, now)]}))
+        resp = self.client.put(url, headers=self.headers,
+                               data=json.dumps({'pings': [self._ping(first, self.drivers[0], 7.1, 5.1, now - 60)]}))
+
+        self.assertEquals(resp.json['data']['accepted'], [])
+        self.assertEquals(resp.json['data']['stale'], [first.id])
+
+        db.session.expire_all()
+        self.assertEquals((first.latitude, first.longitude), (7.2, 5.2))
+
+    def test_list_shuttles_query_count_is_constant(self):
+        db.session.remove()
+        with self.count_queries() as few:
+            resp = self.client.get(url_for('shuttles.get_all_shuttles', _external=True))
+
+        self.assertEquals(resp.json['data'][0]['user']['email'], 'driver0@test.com')
+
+        self._add_shuttles(20)
+        db.session.remove()
+        with self.count_queries() as many:
+            resp = self.client.get(url_for('shuttles.get_all_shuttles', _external=True))
+
+        self.assertEquals(len(resp.json['data']), 22)
+        self.assertEquals(len(many), len(few))
+
+    def test_list_locations_query_count_is_constant(self):
+        self._add_locations(2)
+        db.session.remove()
+        with self.count_queries() as few:
+            resp = self.client.get(url_for('locations.get_all_locations', _external=True))
+
+        self.assertEquals(resp.json['data'][0]['directions']['transit'], 'bus')
+
+        self._add_locations(20)
+        db.session.remove()
+        with self.count_queries() as many:
+            resp = self.client.get(url_for('locations.get_all_locations', _external=True))
+
+        self.assertEquals(len(resp.json['data']), 22)
+        self.assertEquals(len(many), len(few))
+
+    def test_locations_are_degraded_while_maps_circuit_is_open(self):
+        """
+        Assert that locations near an origin come back with straight-line distances, flagged as degraded,
+        without calling the maps API while its circuit is open.
+        """
+        self._add_locations(2)
+
+        with mock.patch.object(maps_gateway.breaker, 'opened_at', time.time()), \
+                mock.patch.object(maps_gateway, '_call') as call:
+            resp = self.client.get(url_for('locations.get_all_locations', origin='7.31,5.1', _external=True))
+
+        self.assertFalse(call.called)
+        self.assertTrue(resp.json['degraded'])
+        self.assertEquals(len(resp.json['data']), 2)
+        self.assertAlmostEquals(resp.json['data'][0]['straight_line_distance'], 1.112, places=2)
+
+    def test_locations_are_incomplete_when_directions_fail(self):
+        """
+        Assert that travel times that fail or miss the fan-out deadline are left out and flagged.
+        """
+        self._add_locations(1)
+
+        def directions(origin, destination, mode=None):
+            if mode == 'transit':
+                raise ValueError('No route.')
+            if mode == 'walking':
+                time.sleep(1)
+            return []
+
+        with mock.patch.object(routing, 'directions', side_effect=directions), \
+                mock.patch.dict(self.app.config, {'MAPS_FANOUT_DEADLINE': 0.2}):
+            resp = self.client.get(url_for('locations.get_all_locations', origin='7.5,5.5', _external=True))
+
+        self.assertTrue(resp.json['incomplete'])
+        # the walking call ran out of time
+        self.assertTrue(resp.json['degraded'])
+        self.assertEquals(resp.json['data'][0]['directions']['transit'], {'instructions': 'bus'})
+
+    def test_locations_from_a_stop_use_precomputed_travel_times(self):
+        """
+        Assert that travel times from a bus stop are computed in batches, then served without maps calls.
+        """
+        from app.api.shuttles.shuttles import refresh_travel_times
+
+        stop = Location('stop', LocationTypeEnum.bus_stop, '', 7.3, 5.1)
+        buildings = [Location('building {0}'.format(i), LocationTypeEnum.building, '', 7.31, 5.1 + i * 0.01)
+                     for i in range(2)]
+        db.session.add_all([stop] + buildings)
+        db.session.commit()
+        building_ids = [building.id for building in buildings]
+
+        def distance_matrix(origins, destinations, mode=None):
+            element = {'status': 'OK', 'duration': {'value': 600}, 'distance': {'value': 1500}}
+            return {'rows': [{'elements': [element if mode != 'transit' else {'status': 'ZERO_RESULTS'}
+                                           for _ in destinations]}]}
+
+        with mock.patch.object(routing, 'distance_matrix', side_effect=distance_matrix) as matrix:
+            self.assertEquals(refresh_travel_times(), 2)
+
+        self.assertEquals(matrix.call_count, 3)
+
+        with mock.patch.object(routing, 'directions', return_value=[]) as directions:
+            resp = self.client.get(url_for('locations.get_all_locations', origin='7.3001,5.1', type='building',
+                                           _external=True))
+
+        # there is no transit route, and that is served as it is rather than asked for again
+        self.assertFalse(directions.called)
+        self.assertEquals([location['_id'] for location in resp.json['data']], building_ids)
+        walking = resp.json['data'][0]['directions']['walking']
+        self.assertEquals(walking['duration'], {'value': 600, 'text': '10 mins'})
+        self.assertEquals(walking['distance'], {'value': 1500, 'text': '1.5 km'})
+        self.assertNotIn('duration', resp.json['data'][0]['directions']['transit'])
+
+        # disabling a building drops its pairs
+        with mock.patch.object(routing, 'distance_matrix', side_effect=distance_matrix):
+            Location.query.filter_by(id=building_ids[1]).update({'status': 'disabled'})
+            db.session.commit()
+            self.assertEquals(refresh_travel_times(building_ids[1]), 0)
+
+        self.assertEquals([row.destination_id for row in TravelTime.query], building_ids[:1])
+
+    def test_nearest_shuttles_limit(self):
+        now = time.time()
+        self.client.put(url_for('shuttles.batch_update_shuttle_locations', _external=True), headers=self.headers,
+                        data=json.dumps({'pings': [self._ping(shuttle, driver, 7.3, 5.1, now)
+                                                   for shuttle, driver in zip(self.shuttles, self.drivers)]}))
+        url = url_for('shuttles.get_all_shuttles', user_location='7.3,5.1', _external=True)
+
+        for nearest in [0, -1]:
+            self.assertEquals(self.client.get(url + '&nearest={0}'.format(nearest)).json['code'], 400)
+
+        with mock.patch.dict(self.app.config, {'NEAREST_SHUTTLES_MAX': 1}):
+            self.assertEquals(len(self.client.get(url + '&nearest=5').json['data']), 1)
+
+    def test_list_shuttles_in_pages(self):
+        self._add_shuttles(5)
+        url = url_for('shuttles.get_all_shuttles', _external=True)
+        seen = []
+        after = ''
+
+        while True:
+            resp = self.client.get(url + '?limit=3&after=' + after)
+            seen.extend(shuttle['shuttle_id'] for shuttle in resp.json['data'])
+
+            if resp.json['next'] is None:
+                break
+            after = resp.json['next']
+
+        self.assertEquals(len(seen), 7)
+        self.assertEquals(seen, sorted(seen))
+
+        resp = self.client.get(url + '?limit=3&after=not-a-cursor')
+        self.assertEquals(resp.json['code'], 400)
+
+        resp = self.client.get(url + '?limit=500')
+        self.assertEquals(resp.json['code'], 400)
+
+    def test_list_shuttles_is_streamed_in_chunks(self):
+        self._add_shuttles(4)
+        self.app.config['LIST_CHUNK_SIZE'] = 3
+
+        try:
+            resp = self.client.get(url_for('shuttles.get_all_shuttles', _external=True))
+        finally:
+            self.app.config['LIST_CHUNK_SIZE'] = 500
+
+        self.assertTrue(resp.is_streamed)
+        self.assertEquals(len(json.loads(resp.data)['data']), 6)
+
+        resp = self.client.get(url_for('shuttles.get_all_shuttles', _external=True) + '?status=blocked')
+        self.assertEquals(resp.json['code'], 500)
+
+    def test_list_shuttles_with_sparse_fields(self):
+        url = url_for('shuttles.get_all_shuttles', _external=True)
+
+        with self.count_queries() as statements:
+            resp = self.client.get(url + '?fields=shuttle_id,latitude,longitude,en_route')
+
+        self.assertEquals(sorted(resp.json['data'][0].keys()), ['en_route', 'latitude', 'longitude', 'shuttle_id'])
+        self.assertEquals(len(statements), 1)
+        self.assertNotIn('JOIN', statements[0])
+        self.assertNotIn('brand', statements[0])
+
+        resp = self.client.get(url + '?fields=shuttle_id,user')
+        self.assertEquals(resp.json['data'][0]['user']['email'], 'driver0@test.com')
+
+        resp = self.client.get(url + '?fields=shuttle_id,colour')
+        self.assertEquals(resp.json['code'], 400)
+
+    def test_conditional_get(self):
+        url = url_for('shuttles.get_all_shuttles', _external=True)
+        resp = self.client.get(url + '?en_route=false', buffered=True)
+        etag = resp.headers['ETag']
+
+        # the test client can't read an empty body without buffering
+        with self.count_queries() as statements:
+            resp = self.client.get(url + '?en_route=false', headers={'If-None-Match': etag}, buffered=True)
+
+        self.assertEquals(resp.status_code, 304)
+        self.assertEquals(statements, [])
+
+        # a different query gets its own ETag
+        resp = self.client.get(url + '?en_route=true', headers={'If-None-Match': etag}, buffered=True)
+        self.assertEquals(resp.status_code, 200)
+
+        shuttle = self.shuttles[0]
+        resp = self.client.put(url_for('shuttles.update_shuttle', shuttle_id=shuttle.id, _external=True),
+                               headers=self.headers, data=json.dumps({'brand': 'other'}))
+        self.assertEquals(resp.status_code, 200)
+
+        resp = self.client.get(url + '?en_route=false', headers={'If-None-Match': etag}, buffered=True)
+        self.assertEquals(resp.status_code, 200)
+        self.assertNotEquals(resp.headers['ETag'], etag)
+
+    def test_shuttle_detail_from_fragments(self):
+        shuttle_id, driver_id = self.shuttles[0].id, self.drivers[0].user_id
+        url = url_for('shuttles.get_shuttle', shuttle_id=shuttle_id, _external=True)
+        self.client.get(url)
+
+        with self.count_queries() as statements:
+            resp = self.client.get(url)
+
+        self.assertEquals(statements, [])
+        self.assertEquals(resp.json['user']['email'], 'driver0@test.com')
+
+        position = {'lat': 6.5, 'lng': 3.3, 'latitude': 6.5, 'longitude': 3.3}
+        self.client.put(url_for('shuttles.update_shuttle_location', shuttle_id=shuttle_id, driver_id=driver_id,
+                                _external=True), headers=self.headers, data=json.dumps(position))
+        self.assertEquals(self.client.get(url).json['latitude'], 6.5)
+
+        # shuttles include their driver
+        self.client.put(url_for('users.update_user', user_id=driver_id, _external=True),
+                        headers=self.headers, data=json.dumps({'firstName': 'renamed'}))
+        self.assertEquals(self.client.get(url).json['user']['firstName'], 'renamed')
+
+    def test_shuttle_changes_since_version(self):
+        with mock.patch.dict(self.app.config, {'CHANGES_SETTLE_SECONDS': 0}):
+            url = url_for('shuttles.get_shuttle_changes', _external=True)
+            version = self.client.get(url).json['data']['version']
+            first, second = self.shuttles
+
+            for payload in [{'brand': 'one'}, {'brand': 'two'}, {'status': 'disabled'}]:
+                self.client.put(url_for('shuttles.update_shuttle', shuttle_id=first.id, _external=True),
+                                headers=self.headers, data=json.dumps(payload))
+
+            self.client.put(url_for('shuttles.update_shuttle', shuttle_id=second.id, _external=True),
+                            headers=self.headers, data=json.dumps({'brand': 'three'}))
+
+            data = self.client.get(url + '?since={0}'.format(version)).json['data']
+
+            self.assertEquals([(change['data']['shuttle_id'], change['action']) for change in data['changes']],
+                              [(first.id, 'disabled'), (second.id, 'updated')])
+            self.assertEquals(data['changes'][0]['data']['brand'], 'two')
+            self.assertFalse(data['more'])
+
+            data = self.client.get(url + '?since={0}&limit=2'.format(version)).json['data']
+            self.assertTrue(data['more'])
+
+            resp = self.client.get(url + '?since={0}'.format(data['version'] + 2))
+            self.assertEquals(resp.json['data']['changes'], [])
+
+            for limit in [0, -3]:
+                resp = self.client.get(url + '?since=0&limit={0}'.format(limit))
+                self.assertEquals(resp.json['code'], 400)
+
+    def test_shuttle_changes_wait_to_settle(self):
+        """
+        Assert that changes younger than CHANGES_SETTLE_SECONDS are held back, and versions stop short of them.
+        """
+        url = url_for('shuttles.get_shuttle_changes', _external=True)
+
+        with mock.patch.dict(self.app.config, {'CHANGES_SETTLE_SECONDS': 0}):
+            version = self.client.get(url).json['data']['version']
+
+        self.client.put(url_for('shuttles.update_shuttle', shuttle_id=self.shuttles[0].id, _external=True),
+                        headers=self.headers, data=json.dumps({'brand': 'fresh'}))
+
+        with mock.patch.dict(self.app.config, {'CHANGES_SETTLE_SECONDS': 60}):
+            self.assertEquals(self.client.get(url).json['data']['version'], version)
+
+            data = self.client.get(url + '?since={0}'.format(version)).json['data']
+            self.assertEquals((data['version'], data['changes']), (version, []))
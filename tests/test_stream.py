@@ -0,0 +1,74 @@
+import json
+
+import mock
+
+from app import shuttle_events
+from app.lib.stream import EventBroker
+from common import BaseTest
+
+
+class TestShuttleEvents(BaseTest):
+    """
+    Live shuttle event stream tests.
+    """
+
+    def setUp(self):
+        self.config = mock.patch.dict(self.app.config, {'STREAM_BUFFER_SIZE': 4, 'STREAM_HEARTBEAT': 0.05})
+        self.config.start()
+        self.broker = EventBroker()
+        self.broker.init_app(self.app)
+
+    def tearDown(self):
+        self.config.stop()
+
+    def test_subscriber_reads_events_after_its_cursor(self):
+        cursor = self.broker.cursor
+        self.broker.publish('position', {'shuttle_id': 1, 'latitude': 7.3, 'longitude': 5.1})
+        self.broker.publish('mode', {'shuttle_id': 1, 'en_route': True})
+
+        cursor, events, missed = self.broker.wait(cursor)
+
+        self.assertFalse(missed)
+        self.assertEquals([event['type'] for _, event in events], ['position', 'mode'])
+
+        # nothing new: the heartbeat wakes the subscriber with no events
+        self.assertEquals(self.broker.wait(cursor), (cursor, [], False))
+
+    def test_slow_subscriber_is_told_to_reload(self):
+        cursor = self.broker.cursor
+
+        for shuttle_id in range(6):
+            self.broker.publish('position', {'shuttle_id': shuttle_id, 'latitude': 7.3, 'longitude': 5.1})
+
+        _, events, missed = self.broker.wait(cursor)
+        self.assertTrue(missed)
+
+        _, _, missed = self.broker.wait('unknown-1')
+        self.assertTrue(missed)
+
+    def test_publisher_reuses_its_redis_client(self):
+        self.broker.redis_url = 'redis://127.0.0.1:6379/0'
+
+        self.assertIs(self.broker._get_redis(), self.broker._get_redis())
+
+    def test_stream_filters_by_bbox(self):
+        response = self.client.get('/shuttles/stream?bbox=7.0,5.0,7.5,5.5')
+        body = iter(response.response)
+
+        self.assertEquals(response.mimetype, 'text/event-stream')
+        self.assertEquals(next(body), 'retry: 3000\n\n')
+
+        shuttle_events.publish('position', {'shuttle_id': 1, 'latitude': 9.0, 'longitude': 5.1})
+        shuttle_events.publish('position', {'shuttle_id': 2, 'latitude': 7.2, 'longitude': 5.2})
+
+        message = next(body)
+        response.close()
+
+        self.assertIn('event: position\n', message)
+        data = [json.loads(line[len('data: '):]) for line in message.split('\n') if line.startswith('data: ')]
+        self.assertEquals([event['shuttle_id'] for event in data], [2])
+
+    def test_invalid_bbox(self):
+        response = self.client.get('/shuttles/stream?bbox=7.5,5.0,7.0')
+
+        self.assertEquals(json.loads(response.data)['code'], 400)
@@ -0,0 +1,94 @@
+import mock
+from flask import url_for
+from sqlalchemy.exc import OperationalError
+
+from app import db
+from app.lib.timeseries import LocationHistory, decode_points, downsample, encode_points
+from app.models.shuttles import Shuttle, ShuttleLocationChunk
+from common import BaseTest
+
+
+class TestLocationHistory(BaseTest):
+    """
+    Location history encoding and range query tests.
+    """
+
+    def setUp(self):
+        self.shuttle = Shuttle(None, 'small', 'brand', True, 14)
+        db.session.add(self.shuttle)
+        db.session.commit()
+        # sealing runs in its own app context, which detaches the shuttle
+        self.shuttle_id = self.shuttle.id
+
+        self.app.config['HISTORY_CHUNK_SIZE'] = 50
+        self.history = LocationHistory()
+        self.history.init_app(self.app)
+
+        # a ping every 2 seconds, drifting north-east
+        self.points = [(1500000000 + i * 2, 7.3 + i * 0.00005, 5.1 + i * 0.00004) for i in range(120)]
+
+    def tearDown(self):
+        ShuttleLocationChunk.query.delete()
+        Shuttle.query.delete()
+        db.session.commit()
+
+    def test_encoding_round_trip(self):
+        data = encode_points(self.points)
+        decoded = decode_points(data)
+
+        self.assertEquals(len(decoded), len(self.points))
+        for (timestamp, lat, lng), expected in zip(decoded, self.points):
+            self.assertAlmostEquals(timestamp, expected[0], places=3)
+            self.assertAlmostEquals(lat, expected[1], places=6)
+            self.assertAlmostEquals(lng, expected[2], places=6)
+
+        self.assertLess(len(data) / float(len(self.points)), 8)
+
+    def test_downsample_keeps_real_points(self):
+        sampled = downsample(self.points, 10)
+
+        self.assertEquals(len(sampled), 10)
+        self.assertEquals(sampled[-1], self.points[-1])
+        self.assertTrue(set(sampled) <= set(self.points))
+
+    def test_range_query_reads_sealed_and_open_chunks(self):
+        for timestamp, lat, lng in self.points:
+            self.history.append(self.shuttle_id, lat, lng, timestamp)
+
+        # two full chunks waiting to be sealed, twenty points still open
+        self.history.seal_all(older_than=float('inf'))
+
+        points, stats = self.history.query(self.shuttle_id, 1500000040, 1500000200)
+
+        self.assertEquals(stats['chunks'], 2)
+        self.assertEquals(stats['stored_points'], 100)
+        self.assertEquals(stats['unsealed_points'], 20)
+        self.assertLess(stats['bytes_per_point'], 8)
+        self.assertEquals(len(points), 81)
+        self.assertAlmostEquals(points[0][0], 1500000040)
+
+        points, _ = self.history.query(self.shuttle_id, max_points=12)
+        self.assertEquals(len(points), 12)
+
+    def test_unsealed_points_are_capped_while_the_database_is_down(self):
+        self.history.max_unsealed = 30
+
+        # no sweeper thread, so the full chunks are only sealed below
+        with mock.patch.object(self.history, '_ensure_sweeper'):
+            for timestamp, lat, lng in self.points:
+                self.history.append(self.shuttle_id, lat, lng, timestamp)
+
+        with mock.patch.object(db.session, 'commit', side_effect=OperationalError('INSERT', {}, 'down')):
+            self.history.seal_all()
+
+        points, stats = self.history.query(self.shuttle_id)
+        self.assertEquals(stats['unsealed_points'], 30)
+        self.assertEquals(points, [tuple(point) for point in self.points[-30:]])
+
+    def test_out_of_range_times_are_rejected(self):
+        self.assertRaises(ValueError, self.history.query, self.shuttle_id, 1e20)
+
+        for query in ['start=1e20', 'end=inf', 'start=nan']:
+            resp = self.client.get(url_for('shuttles.get_shuttle_history', shuttle_id=self.shuttle_id,
+                                           _external=True) + '?' + query)
+            self.assertEquals(resp.json['code'], 400)
@@ -0,0 +1,81 @@
+import json
+
+from flask import url_for
+
+from app import auth_tokens, db, entity_cache
+from app.models.users import User, AccountTypeEnum
+from common import BaseTest
+
+
+class TestAuthTokens(BaseTest):
+    """
+    Auth token fast path tests.
+    """
+
+    def setUp(self):
+        user = User('token', 'user', 'password', 'token@test.com', AccountTypeEnum.driver)
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.user_id
+
+    def tearDown(self):
+        auth_tokens.backend.delete('auth:deny:{0}'.format(self.user_id))
+        auth_tokens._denied.clear()
+        User.query.delete()
+        db.session.commit()
+        # a bulk delete doesn't fire the events the entity cache listens to
+        entity_cache.invalidate([(User.__name__, self.user_id)])
+
+    def _token(self):
+        return User.query.get(self.user_id).generate_auth_token()
+
+    def test_verify_without_queries(self):
+        """
+        Assert that a token is verified from its claims alone.
+        """
+        token = self._token()
+
+        with self.count_queries() as statements:
+            principal = User.verify_auth_token(token)
+
+        self.assertEquals(statements, [])
+        self.assertEquals(principal.user_id, self.user_id)
+        self.assertEquals(principal.account_type, 'driver')
+        self.assertEquals(principal.status, 'enabled')
+
+    def test_token_refresh(self):
+        """
+        Assert that a new token can be fetched with an existing one.
+        """
+        resp = self.client.get(url_for('users.get_auth_token', _external=True),
+                               headers=self._headers_with_auth_token(self._token()))
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(User.verify_auth_token(resp.json['token']).user_id, self.user_id)
+
+    def test_disabling_user_revokes_tokens(self):
+        """
+        Assert that tokens issued before a user is disabled are refused.
+        """
+        token = self._token()
+        self.assertIsNotNone(User.verify_auth_token(token))
+
+        resp = self.client.put(url_for('users.update_user', user_id=self.user_id, _external=True),
+                               headers=self.headers, data=json.dumps({'status': 'disabled'}))
+        self.assertEquals(resp.json['status'], 'success')
+
+        self.assertIsNone(User.verify_auth_token(token))
+        self.assertIsNone(User.verify_auth_token(self._token()))
+
+    def test_token_refresh_for_deleted_user(self):
+        """
+        Assert that a still-valid token for a deleted user can't be refreshed.
+        """
+        token = self._token()
+        db.session.delete(User.query.get(self.user_id))
+        db.session.commit()
+
+        resp = self.client.get(url_for('users.get_auth_token', _external=True),
+                               headers=self._headers_with_auth_token(token))
+
+        self.assertEquals(resp.status_code, 401)